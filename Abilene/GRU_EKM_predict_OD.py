@@ -9,9 +9,28 @@ import os
 import time
 import random
 from sklearn.cluster import KMeans
+from common.od_cache import load_OD_cache
+from common.window import WindowDataset, get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.grouped_rnn import train_grouped
+from common.parallel_od import map_ODs, THREADS
+from common.checkpoint import save_model, is_done, mark_done, get_checkpoint_name, get_prediction_name, \
+    save_predictions, load_predictions
+from common.early_stopping import train_early_stopping, get_validation_len, log_report, evaluate
+from common.warm_start import WindowPool, fit, pretrain, compare_warm_start, FINE_TUNE_EPOCH
+from common.od_grouping import get_daily_profile, group_ODs, get_group_members, save_groups, log_grouping
+from common.device import get_device
 
 BATCH_SIZE = 50
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+
+# number of ODs trained at once by train_grouped
+GROUP_SIZE = 64
+
 class EmbedRNN(nn.Module):
     '''
     combine GRU with hour and day embedding
@@ -95,71 +114,36 @@ class PridictTM():
 
         self.model = EmbedRNN(traffic_dim, hour_embed_dim, week_day_embed_dim,
                               rnn_hidden_size, rnn_num_layers, k)
-        self.model.cuda()
+        self.model.to(DEVICE)
         print(self.model)
 
     def get_OD_list(self, file_name):
-        df = pd.read_csv(file_name)
-        OD_list = df.columns.values.tolist()
-        del OD_list[0]
-        del OD_list[-1]
-        del OD_list[-1]
+        OD_list = load_OD_cache(file_name).get_OD_list()
 
         return OD_list
 
     def read_data(self, file_name, OD):
-        df = pd.read_csv(file_name)
-        data = np.array(df[OD])
-
-        # min-max normalization
+        data = np.array(load_OD_cache(file_name).get_OD(OD))
 
-        max_value = np.max(data)
-        min_value = np.min(data)
-        if not (max_value == 0 and min_value == 0):
-            data = (data - min_value) / (max_value - min_value)
-        '''
-
-        # z-score
-        
-        u = np.average(data)
-        sigma = np.std(data)
-        for i in range(len(data)):
-            data[i] = (data[i] - u) / sigma
-        '''
-        return data, max_value, min_value
+        # min-max normalization fitted on the training span, Normalizer("z-score") for z-score
+        train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+        normalizer = Normalizer("min-max").fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, normalizer
 
 
     # generate normalized time series data
-    # list of ([x1, x2, ..., xk, hour_k+1, week_day_k+1], [xk+1])
+    # list of ([x1, x2, ..., xk, week_day_k+1, hour_k+1], [xk+1])
     # using first k data to predict the k+1 data
-    def generate_series(self, data, week_day_data, hour_data, k):
-        x_data = []
-        y_data = []
-        length = len(data)
-        data = data.tolist()
-        week_day_data = week_day_data.tolist()
-        hour_data = hour_data.tolist()
-        for i in range(length - k):
-            x = data[i: i + k]
-            x.append(week_day_data[i + k])
-            x.append(hour_data[i + k])
-            x = np.array(x)
-            y = data[i + k]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
+    def generate_series(self, data, calendar_data, k):
+        return WindowDataset(data, k, extra=calendar_data)
 
     # generate batch data
-    def generate_batch_loader(self, x_data, y_data):
-        torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
-            dataset=torch_dataset,      # torch TensorDataset format
+    def generate_batch_loader(self, torch_dataset):
+        loader = BatchLoader(
+            dataset=torch_dataset,      # WindowDataset format
             batch_size=self.BATCH_SIZE,      # mini batch size
             shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
         )
         return loader
 
@@ -170,33 +154,270 @@ class PridictTM():
             csvwriter.writerow(data)
 
     # save TM result
-    def save_TM(self, result_list):
-        test_data_length = len(result_list[0])
+    def save_TM(self, result_list, model="GRU-EKM_OD_pair"):
         size = int(math.sqrt(len(result_list)))
-        for i in range(test_data_length):
-            print("Save TM for data " + str(i))
-            file_path = "../TM_result/Abilene/GRU-EKM_OD_pair/"
-            if not os.path.exists(file_path):
-                os.makedirs(file_path)
-            file_name = file_path + "GRU-EKM_OD_pair_" + str(i + 1) + ".txt"
-            TM = np.zeros(shape=(size, size))
-            row = -1
-            column = 0
-            for j in range(len(result_list)):
-                if j % self.node_num == 0:
-                    row += 1
-                    column = 0
-                TM[row][column] = result_list[j][i]
-                column += 1
-
-            f = open(file_name, 'w')
-            for w in range(size):
-                for k in range(size):
-                    if not TM[w][k] == 0.0:
-                        temp = str(w + 1) + ' ' + str(k + 1) + ' ' + str(TM[w][k]) + "\n"
-                        f.write(temp)
-            f.close()
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../TM_result/Abilene/" + model + ".tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model=model, topology="Abilene") as writer:
+            writer.extend(TMs, times)
+
+
+    # predicted traffic of the test windows x_test: the model output averaged with the k-means
+    # centroid of the previous traffic, scaled back by normalizer
+    def predict_EKM(self, traffic_data, train_len, x_test, normalizer):
+        # k-means cluster of the training traffic, one cluster per time step of a day
+        self.cluster_number = int(24 * (60 / self.time_step))
+        kmeans_cls = KMeans(self.cluster_number)
+        kmeans_cls.fit(traffic_data[:train_len].reshape(-1, 1))
+        centroids = kmeans_cls.cluster_centers_
+
+        # the whole test span as one batch
+        with torch.no_grad():
+            predictions = self.model.forward(x_test.unsqueeze(2)).numpy()[:, 0]
+        # find centroid by the previous traffic
+        previous = traffic_data[train_len + self.k - 1:-1].reshape(-1, 1)
+        predictions = (np.abs(predictions) + centroids[kmeans_cls.predict(previous)][:, 0]) / 2.0
+        return list(normalizer.inverse_transform(predictions))
+
+    # train (unless its model is saved) and test one OD on the CPU, returns the predicted
+    # traffic of the test span, run by train_parallel in a worker process
+    def train_OD(self, OD):
+        model_name = "../Abilene/model_GRU-EKM_OD/GRU-EKM_" + OD + ".pkl"
+        traffic_data, normalizer = self.read_data(self.file_name, OD)
+        calendar_data = load_OD_cache(self.file_name).get_calendar()
+        traffic_data_series = self.generate_series(traffic_data, calendar_data, self.k)
+        train_len = get_train_len(len(traffic_data_series), self.BATCH_SIZE)
+        train_series, test_series = traffic_data_series.split(train_len)
+        x_test, y_test = test_series[:]
+        if normalizer.is_zero():
+            return [0] * len(x_test)
+
+        # finished by an earlier run
+        predictions = load_predictions(get_prediction_name(model_name))
+        if predictions is not None:
+            return predictions
+
+        self.model = EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                              self.rnn_hidden_size, self.rnn_num_layers, self.k)
+        # trained by an earlier run, an interrupted OD continues from its last checkpoint
+        if is_done(model_name):
+            self.model.load_state_dict(torch.load(model_name, map_location="cpu"))
+            normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+        else:
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, self.BATCH_SIZE)
+            train_series, validation_series = train_series.split(train_len - val_len)
+            validation = [validation_series[:]]
+            train_data_loader = self.generate_batch_loader(train_series)
+            optimizer = torch.optim.Adagrad(self.model.parameters(), lr=self.LR)
+            loss_func = nn.MSELoss()
+            report = train_early_stopping(self.model, train_data_loader, validation, self.epoch, optimizer, loss_func,
+                                          forward=lambda x: self.model(x.unsqueeze(2)), device="cpu",
+                                          checkpoint=get_checkpoint_name(model_name))
+            log_report(OD, report, os.path.join(os.path.dirname(model_name), "early_stopping.csv"))
+            save_model(self.model.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+            mark_done(model_name, report)
+
+        predictions = self.predict_EKM(traffic_data, train_len, x_test, normalizer)
+        # written at once, a restarted run does not predict this OD again
+        save_predictions(predictions, get_prediction_name(model_name))
+        return predictions
+
+    # train_OD for every OD on a pool of processes, THREADS torch threads each, see common/parallel_od.py
+    def train_parallel(self, workers=None):
+        OD_list = self.get_OD_list(self.file_name)
+        result_list = map_ODs(self.train_OD, OD_list, workers, THREADS)
+        self.save_TM(result_list)
+
+    # the ODs to train, GROUP_SIZE at a time with their normalized series, ODs without
+    # traffic and ODs with a saved model are skipped as in train()
+    # yields (indices in OD_list, ODs, data, normalizers)
+    def get_OD_groups(self, OD_list, model_path):
+        group = ([], [], [], [])
+        for i in range(len(OD_list)):
+            OD = OD_list[i]
+            if os.path.exists(model_path + "GRU-EKM_" + OD + ".pkl"):
+                continue
+            traffic_data, normalizer = self.read_data(self.file_name, OD)
+            if normalizer.is_zero():
+                continue
+            for items, item in zip(group, (i, OD, traffic_data, normalizer)):
+                items.append(item)
+            if len(group[0]) == GROUP_SIZE:
+                yield group
+                group = ([], [], [], [])
+        if group[0]:
+            yield group
+
+    # train GROUP_SIZE ODs at once as one batched model, see common/grouped_rnn.py
+    # the checkpoints are those of train(), OD i draws its batches from a generator seeded with i
+    def train_grouped(self):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_GRU-EKM_OD/"
+        if not os.path.exists(model_path):
+            os.makedirs(model_path)
+
+        # get week day and hour data, shared by every OD
+        calendar_data = load_OD_cache(self.file_name).get_calendar()
+
+        for indices, ODs, traffic_data, normalizers in self.get_OD_groups(OD_list, model_path):
+            print("Training for ", ODs[0], "...", ODs[-1])
+            traffic_data_series = WindowDataset(np.stack(traffic_data, axis=1), self.k, extra=calendar_data)
+            train_len = get_train_len(len(traffic_data_series), BATCH_SIZE)
+
+            models = [EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                               self.rnn_hidden_size, self.rnn_num_layers, self.k) for OD in ODs]
+            star_time = time.time()
+            model = train_grouped(models, "GRU", traffic_data_series.subset(0, train_len), self.epoch,
+                                  self.LR, self.BATCH_SIZE, seeds=indices, device=DEVICE)
+            end_time = time.time()
+            print("training time", (end_time - star_time))
+
+            # save one model per OD
+            for g in range(len(ODs)):
+                model_name = model_path + "GRU-EKM_" + ODs[g] + ".pkl"
+                save_model(model.get_state_dict(g), model_name)
+                normalizers[g].save(get_normalizer_name(model_name))
+                mark_done(model_name, {"epochs": self.epoch, "time": end_time - star_time})
+
+    # the windows of OD as in train_OD: the training windows without the validation tail,
+    # the validation tail and the test span, with the normalized traffic and the normalizer of OD
+    # returns (traffic_data, normalizer, train_len, train_series, validation_series, test_series)
+    def split_OD(self, OD):
+        traffic_data, normalizer = self.read_data(self.file_name, OD)
+        calendar_data = load_OD_cache(self.file_name).get_calendar()
+        traffic_data_series = self.generate_series(traffic_data, calendar_data, self.k)
+        train_len = get_train_len(len(traffic_data_series), self.BATCH_SIZE)
+        val_len = get_validation_len(train_len, self.BATCH_SIZE)
+        train_series, test_series = traffic_data_series.split(train_len)
+        train_series, validation_series = train_series.split(train_len - val_len)
+        return traffic_data, normalizer, train_len, train_series, validation_series, test_series
+
+    # warm start: the model of every OD starts from one EmbedRNN pretrained on the pooled training
+    # windows of all ODs and is fine-tuned for FINE_TUNE_EPOCH epochs, see common/warm_start.py
+    # compare: also train every OD from a random initialization for self.epoch epochs and
+    # write the wall time and the test loss of both to warm_start.csv
+    def train_warm_start(self, compare=False):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_GRU-EKM-warm_OD/"
+        forward = lambda x: self.model(x.unsqueeze(2))
+        loss_func = nn.MSELoss()
 
+        # pretrain on the pooled windows of every OD
+        ODs = []
+        pool = WindowPool(len(OD_list))
+        for OD in OD_list:
+            traffic_data, normalizer, train_len, train_series, validation_series, test_series = self.split_OD(OD)
+            if normalizer.is_zero():
+                continue
+            pool.add(train_series, validation_series)
+            ODs.append(OD)
+        pretrained = EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                              self.rnn_hidden_size, self.rnn_num_layers, self.k)
+        self.model = pretrained
+        pretrain_report = pretrain(pretrained, pool, self.epoch, self.LR, self.BATCH_SIZE, forward, device=DEVICE)
+        log_report("pretrain", pretrain_report, model_path + "early_stopping.csv")
+        save_model(pretrained.state_dict(), model_path + "GRU-EKM_pretrained.pkl")
+
+        result_list = []
+        cold = {}
+        warm = {}
+        for OD in OD_list:
+            traffic_data, normalizer, train_len, train_series, validation_series, test_series = self.split_OD(OD)
+            if OD not in ODs:
+                result_list.append([0] * len(test_series))
+                continue
+            print("Training for ", OD)
+            if compare:
+                self.model = EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                                      self.rnn_hidden_size, self.rnn_num_layers, self.k)
+                report = fit(self.model, train_series, validation_series, self.epoch, self.LR, self.BATCH_SIZE,
+                             forward, device=DEVICE)
+                cold[OD] = (report, evaluate(self.model, forward, [test_series[:]], loss_func, DEVICE))
+
+            self.model = EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                                  self.rnn_hidden_size, self.rnn_num_layers, self.k)
+            self.model.load_state_dict(pretrained.state_dict())
+            report = fit(self.model, train_series, validation_series, FINE_TUNE_EPOCH, self.LR, self.BATCH_SIZE,
+                         forward, device=DEVICE)
+            log_report(OD, report, model_path + "early_stopping.csv")
+            warm[OD] = (report, evaluate(self.model, forward, [test_series[:]], loss_func, DEVICE))
+            model_name = model_path + "GRU-EKM_" + OD + ".pkl"
+            save_model(self.model.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+
+            # the test span on the cpu as in train_OD
+            self.model.cpu()
+            result_list.append(self.predict_EKM(traffic_data, train_len, test_series[:][0], normalizer))
+
+        self.save_TM(result_list, "GRU-EKM-warm_OD_pair")
+        if compare:
+            compare_warm_start(cold, warm, pretrain_report, model_path + "warm_start.csv")
+
+    # OD grouping: the ODs are clustered by their normalized daily profile, see common/od_grouping.py,
+    # and one EmbedRNN per group is trained on the pooled windows of its members, so group_num models
+    # replace one model per OD, group_nums: the numbers of groups to compare, every one writes
+    # its own TM result and a row of grouping.csv with its training time and test loss
+    def train_OD_groups(self, group_nums=(4, 16, 64)):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_GRU-EKM-group_OD/"
+        forward = lambda x: self.model(x.unsqueeze(2))
+        loss_func = nn.MSELoss()
+
+        ODs = []
+        profiles = []
+        for OD in OD_list:
+            traffic_data, normalizer = self.read_data(self.file_name, OD)
+            if normalizer.is_zero():
+                continue
+            train_len = get_train_len(len(traffic_data) - self.k, self.BATCH_SIZE)
+            profiles.append(get_daily_profile(traffic_data[:train_len + self.k]))
+            ODs.append(OD)
+
+        rows = []
+        for group_num in group_nums:
+            groups = group_ODs(profiles, group_num)
+            group_path = model_path + str(group_num) + "/"
+            save_groups(ODs, groups, group_path + "groups.csv")
+            results = {}
+            losses = []
+            train_time = 0
+            for g, members in enumerate(get_group_members(ODs, groups)):
+                print("Training for group", g, "of", len(members), "ODs")
+                pool = WindowPool(len(members))
+                for OD in members:
+                    traffic_data, normalizer, train_len, train_series, validation_series, test_series = \
+                        self.split_OD(OD)
+                    pool.add(train_series, validation_series)
+                self.model = EmbedRNN(self.traffic_dim, self.hour_embed_dim, self.week_day_embed_dim,
+                                      self.rnn_hidden_size, self.rnn_num_layers, self.k)
+                report = pretrain(self.model, pool, self.epoch, self.LR, self.BATCH_SIZE, forward, device=DEVICE)
+                log_report("group_" + str(g), report, group_path + "early_stopping.csv")
+                train_time += report["time"]
+                save_model(self.model.state_dict(), group_path + "GRU-EKM_group_" + str(g) + ".pkl")
+
+                # every member is predicted by the model of its group with its own normalizer
+                for OD in members:
+                    traffic_data, normalizer, train_len, train_series, validation_series, test_series = \
+                        self.split_OD(OD)
+                    self.model.to(DEVICE)
+                    losses.append(evaluate(self.model, forward, [test_series[:]], loss_func, DEVICE))
+                    normalizer.save(get_normalizer_name(group_path + "GRU-EKM_" + OD + ".pkl"))
+                    # the test span on the cpu as in train_OD
+                    self.model.cpu()
+                    results[OD] = self.predict_EKM(traffic_data, train_len, test_series[:][0], normalizer)
+
+            test_len = len(results[ODs[0]])
+            self.save_TM([results.get(OD, [0] * test_len) for OD in OD_list],
+                         "GRU-EKM-group-" + str(group_num) + "_OD_pair")
+            rows.append([group_num, int(np.max(groups)) + 1, train_time, float(np.mean(losses))])
+
+        log_grouping(rows, model_path + "grouping.csv")
 
     def train(self):
         OD_list = self.get_OD_list(self.file_name)
@@ -211,10 +432,8 @@ class PridictTM():
         for i in range(self.node_num * self.node_num):
             result_list.append([])
 
-        # get week day and hour data
-        df = pd.read_csv(file_name)
-        week_day_data = np.array(df["week_day"])
-        hour_data = np.array(df["hour"])
+        # get week day and hour data, derived from the time column and cached
+        calendar_data = load_OD_cache(self.file_name).get_calendar()
 
 
         count = 0
@@ -224,63 +443,54 @@ class PridictTM():
             # print(OD_list)
 
             # get traffic data
-            traffic_data, max_traffic, min_traffic = self.read_data(self.file_name, OD)
+            traffic_data, normalizer = self.read_data(self.file_name, OD)
 
             # generate data series
-            traffic_data_series, y_data_series = self.generate_series(traffic_data, week_day_data, hour_data, self.k)
-            # print(traffic_data_series[0], y_data_series[0])
+            traffic_data_series = self.generate_series(traffic_data, calendar_data, self.k)
+            # print(traffic_data_series[0])
 
             # get train_data and test_data
             train_len = int(int(len(traffic_data_series) * 0.8) / BATCH_SIZE) * BATCH_SIZE
 
-            x_train = traffic_data_series[:train_len]
-            y_train = y_data_series[:train_len]
-            x_test = traffic_data_series[train_len:]
-            y_test = y_data_series[train_len:]
+            train_series, test_series = traffic_data_series.split(train_len)
+            x_test, y_test = test_series[:]
 
-            train_data_loader = self.generate_batch_loader(x_train, y_train)
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, self.BATCH_SIZE)
+            train_series, validation_series = train_series.split(train_len - val_len)
+            validation = [validation_series[:]]
+            train_data_loader = self.generate_batch_loader(train_series)
 
             # reset rnn
             self.model = EmbedRNN(traffic_dim, hour_embed_dim, week_day_embed_dim,
                                   rnn_hidden_size, rnn_num_layers, k)
-            self.model.cuda()
+            self.model.to(DEVICE)
 
             optimizer = torch.optim.Adagrad(self.model.parameters(), lr=self.LR)
             loss_func = nn.MSELoss()
 
-            '''
             ################################## train #################################
-            # 全 0 的列，没有流量，不预测
-            if max_traffic == 0 and min_traffic == 0:
-                continue
-            if os.path.exists(model_name):
-                continue
-            star_time = time.clock()
-
-            for e in range(self.epoch):
-                print("Epoch:", e)
-
-                for step, (batch_x, batch_y) in enumerate(train_data_loader):
-                    batch_x = batch_x.unsqueeze(2).cuda()
-                    batch_y = batch_y.unsqueeze(1).cuda()
-                    # print("batch_x.shape", batch_x.shape)
-                    # print("batch_y.shape", batch_y.shape)
-
-                    prediction = self.model.forward(batch_x)
-                    loss = loss_func(prediction, batch_y)
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-                    # print("Epoch =", e, ", step =", step, ", loss:", loss)
-            end_time = time.clock()
-            print("training time", (end_time - star_time))
+            # all zero ODs are not trained, an OD marked done by an earlier run neither, an interrupted
+            # OD continues from its last checkpoint
+            if not normalizer.is_zero() and not is_done(model_name):
+                report = train_early_stopping(self.model, train_data_loader, validation, self.epoch, optimizer, loss_func,
+                                              forward=lambda x: self.model(x.unsqueeze(2)), device=DEVICE,
+                                              checkpoint=get_checkpoint_name(model_name))
+                log_report(OD, report, model_path + "early_stopping.csv")
+                # save model
+                save_model(self.model.state_dict(), model_name)
+                normalizer.save(get_normalizer_name(model_name))
+                mark_done(model_name, report)
             ################################## train #################################
-            # save model
-            torch.save(self.model.state_dict(), model_name)
-            '''
 
             ################################## test #################################
-            if max_traffic == 0 and min_traffic == 0:
+            # predictions of an earlier run
+            saved_predictions = load_predictions(get_prediction_name(model_name))
+            if saved_predictions is not None:
+                result_list[count].extend(saved_predictions)
+                count += 1
+                continue
+            if normalizer.is_zero():
                 for i in range(len(x_test)):
                     result_list[count].append(0)
             else:
@@ -288,7 +498,7 @@ class PridictTM():
                 # 每个OD对，Canopy有点慢了。直接按照 timestep设置吧
                 self.cluster_number = int(24 * (60 / self.time_step))
                 # 全 0 列，cluster number = 24 * 60 / time_step 有问题
-                if max_traffic > 0:
+                if normalizer.data_max > 0:
                     cluster_data = traffic_data[:train_len].reshape(-1, 1)
                     # print(cluster_data)
                     kmeans_cls = KMeans(self.cluster_number)
@@ -297,12 +507,13 @@ class PridictTM():
                     # print(centroids)
                     
                 # load model
-                self.model.load_state_dict(torch.load(model_name))
+                self.model.load_state_dict(torch.load(model_name, map_location=DEVICE))
+                normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
                 out_file = "./compare_EKM/GRU-EKM_" + OD + ".csv"
-                star_time = time.clock()
+                star_time = time.time()
                 for i in range(len(x_test)):
-                    batch_x = x_test[i].cuda().unsqueeze(0).unsqueeze(2)
-                    batch_y = y_test[i].cuda().unsqueeze(0).unsqueeze(1)
+                    batch_x = x_test[i].to(DEVICE).unsqueeze(0).unsqueeze(2)
+                    batch_y = y_test[i].to(DEVICE).unsqueeze(0).unsqueeze(1)
 
                     prediction = self.model.forward(batch_x)
                     loss = loss_func(prediction, batch_y)
@@ -328,8 +539,8 @@ class PridictTM():
 
                     prediction_value /= 2.0
 
-                    prediction_traffic = prediction_value * (max_traffic - min_traffic) + min_traffic
-                    origin_traffic = batch_y.cpu().data.numpy()[0][0] * (max_traffic - min_traffic) + min_traffic
+                    prediction_traffic = normalizer.inverse_transform(prediction_value)
+                    origin_traffic = normalizer.inverse_transform(batch_y.cpu().data.numpy()[0][0])
 
                     # data = []
                     # data.append(origin_traffic)
@@ -339,8 +550,10 @@ class PridictTM():
 
                     result_list[count].append(prediction_traffic)
 
-                end_time = time.clock()
+                end_time = time.time()
                 print("average prediction time:", (end_time - star_time) / len(x_test) * self.node_num * self.node_num)
+                # written at once, a restarted run does not predict this OD again
+                save_predictions(result_list[count], get_prediction_name(model_name))
             ################################## test #################################
 
             count += 1
@@ -351,7 +564,7 @@ class PridictTM():
 
 if __name__ == "__main__":
     # PridictTM (self, file_name, k, input_size, hidden_size, num_layers)
-    file_name = "../OD_pair/Abilene-OD_pair_embed_2004-08-01.csv"
+    file_name = "../OD_pair/Abilene-OD_pair_2004-08-01.csv"
 
     k = 10
     traffic_dim = 1
@@ -377,5 +590,9 @@ if __name__ == "__main__":
     predict_tm_model = PridictTM(file_name, k, traffic_dim, hour_embed_dim, week_day_embed_dim,
                                  rnn_hidden_size, rnn_num_layers, epoch, LR, BATCH_SIZE, time_step, node_num)
     predict_tm_model.train()
+    # predict_tm_model.train_grouped()
+    # predict_tm_model.train_parallel()
+    # predict_tm_model.train_warm_start(compare=True)
+    # predict_tm_model.train_OD_groups()
 
 
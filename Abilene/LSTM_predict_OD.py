@@ -10,10 +10,40 @@ import pandas as pd
 import math
 import time
 import os
+from common.od_cache import load_OD_cache
+from common.window import WindowDataset, get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.grouped_rnn import train_grouped
+from common.parallel_od import map_ODs, THREADS
+from common.checkpoint import save_model, is_done, mark_done, get_checkpoint_name, get_prediction_name, \
+    save_predictions, load_predictions
+from common.early_stopping import train_early_stopping, get_validation_len, log_report, evaluate
+from common.warm_start import WindowPool, fit, pretrain, compare_warm_start, FINE_TUNE_EPOCH
+from common.od_grouping import get_daily_profile, group_ODs, get_group_members, save_groups, log_grouping
+from common.stateful import train_stateful, predict_stateful
+from common.sweep import get_configs, get_sweep_ODs, successive_halving, hyperband, save_ranking, \
+    get_run_path, remove_checkpoints, MIN_EPOCH
+from common.device import get_device
 
 
 BATCH_SIZE = 50
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+
+# number of ODs trained at once by train_grouped
+GROUP_SIZE = 64
+
+# stateful training: parallel streams of the series and the truncated BPTT length,
+# 288 steps of 5 minutes are one day
+STATEFUL_BATCH_SIZE = 4
+BPTT = 288
+
+# hyperparameter sweep: the values of the constructor arguments tried by sweep()
+SWEEP_SPACE = {"k": [10, 20], "hidden_size": [30, 100, 200], "num_layers": [1, 2], "LR": [0.01, 0.065, 0.1]}
+
 class RNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers):
         super(RNN, self).__init__()
@@ -49,63 +79,38 @@ class PridictTM():
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.rnn = RNN(input_size, hidden_size, num_layers)
-        # self.rnn.cuda()
+        # self.rnn.to(DEVICE)
         print(self.rnn)
 
     def get_OD_list(self, file_name):
-        df = pd.read_csv(file_name)
-        OD_list = df.columns.values.tolist()
-        del OD_list[0]
+        OD_list = load_OD_cache(file_name).get_OD_list()
 
         return OD_list
 
     def read_data(self, file_name, OD):
-        df = pd.read_csv(file_name)
-        data = np.array(df[OD])
-
-        # min-max normalization
-
-        max_value = np.max(data)
-        min_value = np.min(data)
-        if not (max_value == 0 and min_value == 0):
-            data = (data - min_value) / (max_value - min_value)
-        '''
+        data = np.array(load_OD_cache(file_name).get_OD(OD))
 
-        # z-score
-        
-        u = np.average(data)
-        sigma = np.std(data)
-        for i in range(len(data)):
-            data[i] = (data[i] - u) / sigma
-        '''
-        return data, max_value, min_value
+        # min-max normalization fitted on the training span, Normalizer("z-score") for z-score
+        train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+        normalizer = Normalizer("min-max").fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, normalizer
 
 
     # generate normalized time series data
     # list of ([x1, x2, ..., xk], [xk+1])
     # using first k data to predict the k+1 data
     def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        length = len(data)
-        for i in range(length - k):
-            x = data[i:i+k]
-            y = data[i+k]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
+        series = WindowDataset(data, k)
+        return series.x_data, series.y_data
 
     # generate batch data
     def generate_batch_loader(self, x_data, y_data):
         torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
+        loader = BatchLoader(
             dataset=torch_dataset,      # torch TensorDataset format
             batch_size=BATCH_SIZE,      # mini batch size
             shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
         )
         return loader
 
@@ -116,30 +121,316 @@ class PridictTM():
             csvwriter.writerow(data)
 
     # save TM result
-    def save_TM(self, result_list):
-        test_data_length = len(result_list[0])
+    def save_TM(self, result_list, model="LSTM_OD_pair"):
         size = int(math.sqrt(len(result_list)))
-        for i in range(test_data_length):
-            print("Save TM for data " + str(i))
-            file_name = "../TM_result/Abilene/LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-            TM = np.zeros(shape=(size, size))
-            row = -1
-            column = 0
-            for j in range(len(result_list)):
-                if j % 12 == 0:
-                    row += 1
-                    column = 0
-                TM[row][column] = result_list[j][i]
-                column += 1
-
-            f = open(file_name, 'w')
-            for w in range(size):
-                for k in range(size):
-                    if not TM[w][k] == 0.0:
-                        temp = str(w + 1) + ' ' + str(k + 1) + ' ' + str(TM[w][k]) + "\n"
-                        f.write(temp)
-            f.close()
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../TM_result/Abilene/" + model + ".tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model=model, topology="Abilene") as writer:
+            writer.extend(TMs, times)
+
+
+    # stateful truncated-BPTT training over the contiguous training span instead of k-length
+    # windows, see common/stateful.py, the test span is predicted in one pass that carries on
+    # the state of the training span, so the look back is not limited to k steps
+    def train_stateful(self):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_LSTM-stateful_OD/"
+        result_list = []
+
+        for OD in OD_list:
+            print("Training for ", OD)
+            model_name = model_path + "LSTM_" + OD + ".pkl"
+            data, normalizer = self.read_data(self.file_name, OD)
+            train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+                result_list.append([0] * (len(data) - self.k - train_len))
+                continue
+
+            self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
+            star_time = time.time()
+            train_stateful(self.rnn, data[:train_len + self.k], self.epoch, self.LR, STATEFUL_BATCH_SIZE, BPTT,
+                           device=DEVICE)
+            end_time = time.time()
+            print(end_time - star_time)
+            save_model(self.rnn.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+
+            # the prediction of step t + 1 is at t, the test targets start at step train_len + k
+            predictions = predict_stateful(self.rnn, data, DEVICE)[train_len + self.k - 1:-1, 0]
+            result_list.append(list(normalizer.inverse_transform(predictions, absolute=True)))
+
+        self.save_TM(result_list, "LSTM-stateful_OD_pair")
+
+    # train (unless its model is saved) and test one OD on the CPU, returns the predicted
+    # traffic of the test span, run by train_parallel in a worker process
+    def train_OD(self, OD):
+        model_name = "../Abilene/model_LSTM_OD/LSTM_" + OD + ".pkl"
+        data, normalizer = self.read_data(self.file_name, OD)
+        x_data, y_data = self.generate_series(data, self.k)
+        train_len = get_train_len(len(x_data), BATCH_SIZE)
+        if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+            return [0] * (len(x_data) - train_len)
+
+        # finished by an earlier run
+        predictions = load_predictions(get_prediction_name(model_name))
+        if predictions is not None:
+            return predictions
+
+        self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
+        # trained by an earlier run, an interrupted OD continues from its last checkpoint
+        if is_done(model_name):
+            self.rnn.load_state_dict(torch.load(model_name, map_location="cpu"))
+            normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+        else:
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            validation = [(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])]
+            data_loader = self.generate_batch_loader(x_data[:train_len - val_len], y_data[:train_len - val_len])
+            optimizer = torch.optim.Adagrad(self.rnn.parameters(), lr=self.LR)
+            loss_func = nn.MSELoss()
+            report = train_early_stopping(self.rnn, data_loader, validation, self.epoch, optimizer, loss_func,
+                                          forward=lambda x: self.rnn(x.reshape(-1, self.k, self.input_size)),
+                                          device="cpu", checkpoint=get_checkpoint_name(model_name))
+            log_report(OD, report, os.path.join(os.path.dirname(model_name), "early_stopping.csv"))
+            save_model(self.rnn.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+            mark_done(model_name, report)
+
+        # the whole test span as one batch
+        with torch.no_grad():
+            predictions = self.rnn.forward(x_data[train_len:].reshape(-1, self.k, self.input_size))
+        # negative outputs are flipped, then the whole test span is scaled back
+        predictions = list(normalizer.inverse_transform(predictions.reshape(-1).numpy(), absolute=True))
+        # written at once, a restarted run does not predict this OD again
+        save_predictions(predictions, get_prediction_name(model_name))
+        return predictions
+
+    # train_OD for every OD on a pool of processes, THREADS torch threads each, see common/parallel_od.py
+    def train_parallel(self, workers=None):
+        OD_list = self.get_OD_list(self.file_name)
+        result_list = map_ODs(self.train_OD, OD_list, workers, THREADS)
+        self.save_TM(result_list)
+
+    # the ODs to train, GROUP_SIZE at a time with their normalized series
+    # yields (indices in OD_list, ODs, data, normalizers)
+    def get_OD_groups(self, OD_list):
+        group = ([], [], [], [])
+        for i in range(len(OD_list)):
+            OD = OD_list[i]
+            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+                continue
+            data, normalizer = self.read_data(self.file_name, OD)
+            for items, item in zip(group, (i, OD, data, normalizer)):
+                items.append(item)
+            if len(group[0]) == GROUP_SIZE:
+                yield group
+                group = ([], [], [], [])
+        if group[0]:
+            yield group
+
+    # train GROUP_SIZE ODs at once as one batched model, see common/grouped_rnn.py
+    # the checkpoints are those of train(), OD i draws its batches from a generator seeded with i
+    def train_grouped(self):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_LSTM_OD/"
+        if not os.path.exists(model_path):
+            os.makedirs(model_path)
+
+        for indices, ODs, data, normalizers in self.get_OD_groups(OD_list):
+            print("Training for ", ODs[0], "...", ODs[-1])
+            series = WindowDataset(np.stack(data, axis=1), self.k)
+            train_len = get_train_len(len(series), BATCH_SIZE)
+
+            models = [RNN(self.input_size, self.hidden_size, self.num_layers) for OD in ODs]
+            star_time = time.time()
+            model = train_grouped(models, "LSTM", series.subset(0, train_len), self.epoch, self.LR,
+                                  BATCH_SIZE, seeds=indices, device=DEVICE)
+            end_time = time.time()
+            print(end_time - star_time)
+
+            # save one model per OD
+            for g in range(len(ODs)):
+                model_name = model_path + "LSTM_" + ODs[g] + ".pkl"
+                save_model(model.get_state_dict(g), model_name)
+                normalizers[g].save(get_normalizer_name(model_name))
+                mark_done(model_name, {"epochs": self.epoch, "time": end_time - star_time})
+
+    # the windows of OD as in train_OD: the training windows without the validation tail,
+    # the validation tail and the test span, with the normalizer of OD
+    def get_OD_sets(self, OD):
+        data, normalizer = self.read_data(self.file_name, OD)
+        x_data, y_data = self.generate_series(data, self.k)
+        train_len = get_train_len(len(x_data), BATCH_SIZE)
+        val_len = get_validation_len(train_len, BATCH_SIZE)
+        train_set = Data.TensorDataset(x_data[:train_len - val_len], y_data[:train_len - val_len])
+        validation_set = Data.TensorDataset(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])
+        test_set = Data.TensorDataset(x_data[train_len:], y_data[train_len:])
+        return train_set, validation_set, test_set, normalizer
+
+    # warm start: the model of every OD starts from one RNN pretrained on the pooled training
+    # windows of all ODs and is fine-tuned for FINE_TUNE_EPOCH epochs, see common/warm_start.py
+    # compare: also train every OD from a random initialization for self.epoch epochs and
+    # write the wall time and the test loss of both to warm_start.csv
+    def train_warm_start(self, compare=False):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_LSTM-warm_OD/"
+        forward = lambda x: self.rnn(x.reshape(-1, self.k, self.input_size))
+        loss_func = nn.MSELoss()
+
+        # pretrain on the pooled windows of every OD
+        ODs = []
+        pool = WindowPool(len(OD_list))
+        for OD in OD_list:
+            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+                continue
+            train_set, validation_set, test_set, normalizer = self.get_OD_sets(OD)
+            pool.add(train_set, validation_set)
+            ODs.append(OD)
+        pretrained = RNN(self.input_size, self.hidden_size, self.num_layers)
+        self.rnn = pretrained
+        pretrain_report = pretrain(pretrained, pool, self.epoch, self.LR, BATCH_SIZE, forward, device=DEVICE)
+        log_report("pretrain", pretrain_report, model_path + "early_stopping.csv")
+        save_model(pretrained.state_dict(), model_path + "LSTM_pretrained.pkl")
+
+        result_list = []
+        cold = {}
+        warm = {}
+        for OD in OD_list:
+            train_set, validation_set, test_set, normalizer = self.get_OD_sets(OD)
+            if OD not in ODs:
+                result_list.append([0] * len(test_set))
+                continue
+            print("Training for ", OD)
+            if compare:
+                self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
+                report = fit(self.rnn, train_set, validation_set, self.epoch, self.LR, BATCH_SIZE, forward,
+                             device=DEVICE)
+                cold[OD] = (report, evaluate(self.rnn, forward, [test_set[:]], loss_func, DEVICE))
 
+            self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
+            self.rnn.load_state_dict(pretrained.state_dict())
+            report = fit(self.rnn, train_set, validation_set, FINE_TUNE_EPOCH, self.LR, BATCH_SIZE, forward,
+                         device=DEVICE)
+            log_report(OD, report, model_path + "early_stopping.csv")
+            warm[OD] = (report, evaluate(self.rnn, forward, [test_set[:]], loss_func, DEVICE))
+            model_name = model_path + "LSTM_" + OD + ".pkl"
+            save_model(self.rnn.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+
+            # the whole test span as one batch
+            with torch.no_grad():
+                predictions = forward(test_set[:][0].to(DEVICE)).cpu()
+            # negative outputs are flipped, then the whole test span is scaled back
+            result_list.append(list(normalizer.inverse_transform(predictions.reshape(-1).numpy(), absolute=True)))
+
+        self.save_TM(result_list, "LSTM-warm_OD_pair")
+        if compare:
+            compare_warm_start(cold, warm, pretrain_report, model_path + "warm_start.csv")
+
+    # OD grouping: the ODs are clustered by their normalized daily profile, see common/od_grouping.py,
+    # and one RNN per group is trained on the pooled windows of its members, so group_num models
+    # replace one model per OD, group_nums: the numbers of groups to compare, every one writes
+    # its own TM result and a row of grouping.csv with its training time and test loss
+    def train_OD_groups(self, group_nums=(4, 16, 64)):
+        OD_list = self.get_OD_list(self.file_name)
+        model_path = "../Abilene/model_LSTM-group_OD/"
+        forward = lambda x: self.rnn(x.reshape(-1, self.k, self.input_size))
+        loss_func = nn.MSELoss()
+
+        ODs = []
+        profiles = []
+        for OD in OD_list:
+            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+                continue
+            data, normalizer = self.read_data(self.file_name, OD)
+            train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+            profiles.append(get_daily_profile(data[:train_len + self.k]))
+            ODs.append(OD)
+
+        rows = []
+        for group_num in group_nums:
+            groups = group_ODs(profiles, group_num)
+            group_path = model_path + str(group_num) + "/"
+            save_groups(ODs, groups, group_path + "groups.csv")
+            results = {}
+            losses = []
+            train_time = 0
+            for g, members in enumerate(get_group_members(ODs, groups)):
+                print("Training for group", g, "of", len(members), "ODs")
+                pool = WindowPool(len(members))
+                for OD in members:
+                    train_set, validation_set, test_set, normalizer = self.get_OD_sets(OD)
+                    pool.add(train_set, validation_set)
+                self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
+                report = pretrain(self.rnn, pool, self.epoch, self.LR, BATCH_SIZE, forward, device=DEVICE)
+                log_report("group_" + str(g), report, group_path + "early_stopping.csv")
+                train_time += report["time"]
+                save_model(self.rnn.state_dict(), group_path + "LSTM_group_" + str(g) + ".pkl")
+
+                # every member is predicted by the model of its group with its own normalizer
+                for OD in members:
+                    train_set, validation_set, test_set, normalizer = self.get_OD_sets(OD)
+                    losses.append(evaluate(self.rnn, forward, [test_set[:]], loss_func, DEVICE))
+                    normalizer.save(get_normalizer_name(group_path + "LSTM_" + OD + ".pkl"))
+                    with torch.no_grad():
+                        predictions = forward(test_set[:][0].to(DEVICE)).cpu()
+                    results[OD] = list(normalizer.inverse_transform(predictions.reshape(-1).numpy(), absolute=True))
+
+            test_len = len(results[ODs[0]])
+            self.save_TM([results.get(OD, [0] * test_len) for OD in OD_list],
+                         "LSTM-group-" + str(group_num) + "_OD_pair")
+            rows.append([group_num, int(np.max(groups)) + 1, train_time, float(np.mean(losses))])
+
+        log_grouping(rows, model_path + "grouping.csv")
+
+    # validation and test loss of the constructor arguments config trained for epoch epochs on ODs,
+    # one trial of sweep(), the checkpoints of the trial name let its next rung continue the training
+    def sweep_trial(self, ODs, model_path, config, epoch, name):
+        args = {"k": self.k, "input_size": self.input_size, "hidden_size": self.hidden_size,
+                "num_layers": self.num_layers, "LR": self.LR}
+        args.update(config)
+        model = PridictTM(self.file_name, epoch=epoch, **args)
+        forward = lambda x: model.rnn(x.reshape(-1, model.k, model.input_size))
+        losses = []
+        test_losses = []
+        epochs = 0
+        train_time = 0
+        for OD in ODs:
+            train_set, validation_set, test_set, normalizer = model.get_OD_sets(OD)
+            model.rnn = RNN(model.input_size, model.hidden_size, model.num_layers)
+            report = fit(model.rnn, train_set, validation_set, epoch, model.LR, BATCH_SIZE, forward, device="cpu",
+                         checkpoint=model_path + name + "/LSTM_" + OD + ".ckpt", checkpoint_every=1)
+            losses.append(report["validation_loss"])
+            test_losses.append(evaluate(model.rnn, forward, [test_set[:]], nn.MSELoss(), "cpu"))
+            epochs = max(epochs, report["epochs"])
+            train_time += report["time"]
+        return {"loss": float(np.mean(losses)), "test_loss": float(np.mean(test_losses)), "epochs": epochs,
+                "time": train_time}
+
+    # hyperparameter sweep over the constructor arguments in space, see common/sweep.py, every
+    # configuration is trained on the same few ODs and successive halving (use_hyperband: Hyperband)
+    # drops the weak ones after a few epochs, the trials run on workers processes and the ranking by
+    # validation loss, with the test loss and training time of every trial, is written to sweep.csv
+    def sweep(self, space=None, use_hyperband=False, workers=None):
+        model_path = "../Abilene/model_LSTM-sweep_OD/"
+        if space is None:
+            space = SWEEP_SPACE
+        ODs = get_sweep_ODs(self.get_OD_list(self.file_name))
+        # the trials resume between the rungs of this sweep only, their checkpoints go to a new run directory
+        run_path = get_run_path(model_path)
+        trial = lambda config, epoch, name: self.sweep_trial(ODs, run_path, config, epoch, name)
+        if use_hyperband:
+            results = hyperband(trial, space, MIN_EPOCH, self.epoch, workers=workers, threads=THREADS,
+                                path=run_path)
+        else:
+            results = successive_halving(trial, get_configs(space), MIN_EPOCH, self.epoch, workers=workers,
+                                         threads=THREADS, path=run_path)
+        remove_checkpoints(run_path)
+        save_ranking(results, model_path + "sweep.csv")
 
     def train(self):
         OD_list = self.get_OD_list(self.file_name)
@@ -154,10 +445,13 @@ class PridictTM():
             print("Training for ", OD)
             model_name = model_path + "LSTM_" + OD + ".pkl"
             # print(OD_list)
-            data, max_value, min_value = self.read_data(self.file_name, OD)
+            data, normalizer = self.read_data(self.file_name, OD)
             x_data, y_data = self.generate_series(data, self.k)
             train_len = int(int(len(x_data) * 0.8) / 50) * 50
-            data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            validation = [(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])]
+            data_loader = self.generate_batch_loader(x_data[:train_len - val_len], y_data[:train_len - val_len])
 
             # min-max
             # for i in range(len(data)):
@@ -170,55 +464,45 @@ class PridictTM():
 
             # reset rnn
             self.rnn = RNN(self.input_size, self.hidden_size, self.num_layers)
-            self.rnn.cuda()
+            self.rnn.to(DEVICE)
             optimizer = torch.optim.Adagrad(self.rnn.parameters(), lr=self.LR)
             loss_func = nn.MSELoss()
 
 
             ################################## train #################################
-            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
-                continue
-            # if os.path.exists(model_name):
-            #     continue
-            star_time = time.clock()
-            for e in range(self.epoch):
-                # print("Epoch:", e)
-
-                for step, (batch_x, batch_y) in enumerate(data_loader):
-                    # print(batch_x.shape)
-                    # print(batch_y.shape)
-                    batch_x = batch_x.reshape(BATCH_SIZE, self.k, self.input_size)  # (batch_size, time_step, input_size)
-                    print(batch_x.shape)
-                    batch_y = batch_y.reshape(BATCH_SIZE, self.input_size)
-                    batch_x = batch_x.cuda()
-                    batch_y = batch_y.cuda()
-                    prediction = self.rnn.forward(batch_x)
-                    print(prediction.shape)
-                    loss = loss_func(prediction, batch_y)
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-                    # print("Epoch =", e, ", step =", step, ", loss:", loss)
-            end_time = time.clock()
-            print(end_time - star_time)
+            # O = D pairs are not trained, an OD marked done by an earlier run neither, an interrupted
+            # OD continues from its last checkpoint
+            if OD.split('_')[1].split('-')[0] != OD.split('_')[1].split('-')[1] and not is_done(model_name):
+                report = train_early_stopping(self.rnn, data_loader, validation, self.epoch, optimizer, loss_func,
+                                              forward=lambda x: self.rnn(x.reshape(-1, self.k, self.input_size)),
+                                              device=DEVICE, checkpoint=get_checkpoint_name(model_name))
+                log_report(OD, report, model_path + "early_stopping.csv")
+                # save model
+                save_model(self.rnn.state_dict(), model_name)
+                normalizer.save(get_normalizer_name(model_name))
+                mark_done(model_name, report)
             ################################## train #################################
-            # save model
-            torch.save(self.rnn.state_dict(), model_name)
-            '''
-
 
             ################################## test #################################
+            # predictions of an earlier run
+            saved_predictions = load_predictions(get_prediction_name(model_name))
+            if saved_predictions is not None:
+                result_list[count].extend(saved_predictions)
+                count += 1
+                continue
             
             if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
                 for i in range(train_len, len(x_data)):
                     result_list[count].append(0)
             else:
             # load model
-                self.rnn.load_state_dict(torch.load(model_name))
-                star_time = time.clock()
+                self.rnn.load_state_dict(torch.load(model_name, map_location=DEVICE))
+                normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+                star_time = time.time()
+                predictions = []
                 for i in range(train_len, len(x_data)):
-                    test_x = x_data[i].reshape(1, self.k, self.input_size).cuda()
-                    test_y = y_data[i].cuda()
+                    test_x = x_data[i].reshape(1, self.k, self.input_size).to(DEVICE)
+                    test_y = y_data[i].to(DEVICE)
                     prediction = self.rnn.forward(test_x).reshape(1)
                     # loss = loss_func(prediction, test_y)
 
@@ -228,17 +512,18 @@ class PridictTM():
                     # self.write_row_to_csv(data, "loss_LSTM_OD.csv")
     
                     prediction_value = prediction.cpu().data.numpy()[0]
-                    if prediction_value < 0:
-                        prediction_value = -prediction_value
-                    result_list[count].append(prediction_value * (max_value - min_value) + min_value)
+                    predictions.append(prediction_value)
+                # negative outputs are flipped, then the whole test span is scaled back
+                result_list[count].extend(normalizer.inverse_transform(predictions, absolute=True))
+                # written at once, a restarted run does not predict this OD again
+                save_predictions(result_list[count], get_prediction_name(model_name))
 
-                end_time = time.clock()
+                end_time = time.time()
                 print((end_time - star_time) / (len(x_data) - train_len) * 144)
             ################################## test #################################
 
             count += 1
-            '''
-        # self.save_TM(result_list)
+        self.save_TM(result_list)
 
 
 
@@ -258,5 +543,11 @@ if __name__ == "__main__":
 
     predict_tm_model = PridictTM(file_name, k, input_size, hidden_size, num_layers, epoch, LR)
     predict_tm_model.train()
+    # predict_tm_model.train_grouped()
+    # predict_tm_model.train_parallel()
+    # predict_tm_model.train_warm_start(compare=True)
+    # predict_tm_model.train_OD_groups()
+    # predict_tm_model.sweep()
+    # predict_tm_model.train_stateful()
 
 
@@ -11,10 +11,15 @@ import torch.utils.data as Data
 import math
 from Abilene.TCN.tm_predict.model import TCN
 import time
+from common.window import get_train_len
+from common.od_stream import ODStream, StreamLoader
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.device import get_device
+from common.tcn_stream import StreamingTCN
 
 class PridictTM():
     def __init__(self, file_name, k, input_size, input_channel, output_size, channel_sizes, kernel_size,
-                 dropout, epochs, lr, USE_CUDA):
+                 dropout, epochs, lr, device=None, trim=False, stream=False):
         # super(PridictTM, self).__init__()
         self.file_name = file_name
         self.k = k
@@ -26,67 +31,21 @@ class PridictTM():
         self.channel_size = channel_sizes
         self.kernel_size = kernel_size
         self.dropout = dropout
-        self.USE_CUDA = USE_CUDA
-
-        self.model = TCN(input_size, output_size, channel_sizes, kernel_size=kernel_size, dropout=dropout, k=self.k)
-        if self.USE_CUDA:
-            self.model = self.model.cuda()
-
-    def read_data(self, file_name):
-        df = pd.read_csv(file_name)
-        del df["time"]
-        data_list = df.values
-        # print(data_list)
-        # print(data_list.shape)
-        # print(type(data_list))
-
-        max_list = np.max(data_list, axis=0)
-        min_list = np.min(data_list, axis=0)
-        # print(len(max_list))
-        # print(len(min_list))
-
-        # OD pair, when O = D, max = min = 0, so data_list will have some nan value
-        # change these values to 0
-        data_list = (data_list - min_list) / (max_list - min_list)
-        data_list[np.isnan(data_list)] = 0
-
-        return data_list, min_list, max_list
-
-
-    # generate normalized time series data
-    # list of ([x1, x2, ..., xk], [xk+1])
-    # using first k data to predict the k+1 data
-    def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        print("data.shape: ", data.shape)
-        length = data.shape[0]
-        # print(length)
-        for i in range(length - k):
-            x = data[i:i+k, :]
-            y = data[i+k, :]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
-
-    # generate batch data
-    def generate_batch_loader(self, x_data, y_data):
-        torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
-            dataset=torch_dataset,      # torch TensorDataset format
-            batch_size=BATCH_SIZE,      # mini batch size
-            shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
-        )
-        return loader
+        # drop the TCN levels after the receptive field covers the window of k TMs
+        self.trim = trim
+        # stream the whole test span through the TCN even when its receptive field is > k, see train()
+        self.stream = stream
+        # cpu or cuda, see common/device.py
+        self.device = get_device(device)
+
+        self.model = TCN(input_size, output_size, channel_sizes, kernel_size=kernel_size, dropout=dropout, k=self.k,
+                         trim=trim)
+        self.model = self.model.to(self.device)
 
     # inverse normalization
-    def inverse_normalization(self, prediction, y, max_list, min_list):
-        inverse_prediction = prediction * (max_list - min_list) + min_list
-        inverse_y = y * (max_list - min_list) + min_list
+    def inverse_normalization(self, prediction, y, normalizer):
+        inverse_prediction = normalizer.inverse_transform(prediction)
+        inverse_y = normalizer.inverse_transform(y)
 
         return inverse_prediction, inverse_y
 
@@ -102,18 +61,22 @@ class PridictTM():
         f.close()
 
     def train(self):
-        data, min_list, max_list = self.read_data(self.file_name)
-        x_data, y_data = self.generate_series(data, self.k)
-        print("x_data.shape:", x_data.shape)
-        print("y_data.shape:", y_data.shape)
-        train_len = int(int(len(x_data) * 0.8) / 50) * 50
+        # out-of-core: the windows of at most MEMORY_LIMIT bytes of TMs are materialized at a time
+        stream = ODStream(self.file_name, self.k, memory_limit=MEMORY_LIMIT)
+        print("time steps:", len(stream), ", chunk size:", stream.chunk_size)
+        train_len = get_train_len(len(stream) - self.k, BATCH_SIZE)
         print("Training length: ", train_len)
+        train_stream, test_stream = stream.split(train_len)
 
-        data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
+        # min-max normalization of every OD, fitted on the training span
+        normalizer = train_stream.fit(Normalizer("min-max", axis=0))
+        data_loader = StreamLoader(train_stream, BATCH_SIZE, normalizer=normalizer)
 
         optimizer = torch.optim.Adam(self.model.parameters(), lr=self.LR)
         loss_func = nn.MSELoss()
         model_name = "TCN_kernel=" + str(self.kernel_size) + "_dropout=" + str(self.dropout) + "_lr=" + str(self.LR) + "_k=" + str(self.k) + ".pkl"
+        if self.trim:
+            model_name = model_name[:-len(".pkl")] + "_trim.pkl"
 
         '''
         star_time = time.clock()
@@ -122,24 +85,15 @@ class PridictTM():
             # print("Epoch: ", e)
             result = []
             for step, (batch_x, batch_y) in enumerate(data_loader):
-                if USE_CUDA:
-                    batch_x = batch_x.cuda()
-                    batch_y = batch_y.cuda()
-                    # print("batch_x.shape:", batch_x.shape)
-                    # print("batch_y.shape:", batch_y.shape)
-
-                    # TCN input shape: (batch_size, in_channels, seq_length)
-                    batch_x = batch_x.reshape(BATCH_SIZE, -1, self.k)
-                    prediction = self.model.forward(batch_x).cuda()
-                else:
-                    batch_x = batch_x
-                    batch_y = batch_y
-                    # print("batch_x.shape:", batch_x.shape)
-                    # print("batch_y.shape:", batch_y.shape)
-
-                    # TCN input shape: (batch_size, in_channels, seq_length)
-                    batch_x = batch_x.reshape(BATCH_SIZE, -1, self.k)
-                    prediction = self.model.forward(batch_x)
+                batch_x = batch_x.to(self.device)
+                batch_y = batch_y.to(self.device)
+                # print("batch_x.shape:", batch_x.shape)
+                # print("batch_y.shape:", batch_y.shape)
+
+                # TCN input shape: (batch_size, in_channels, seq_length), the ODs are the channels
+                # and time is the sequence, (batch_size, k, N) -> (batch_size, N, k)
+                batch_x = batch_x.transpose(1, 2)
+                prediction = self.model.forward(batch_x)
                 # print("prediction.shape:", prediction.shape)
                 # print(prediction)
                 # print(prediction[-1].data.numpy())
@@ -155,6 +109,7 @@ class PridictTM():
         print(end_time - star_time)
         # save model 
         # torch.save(self.model.state_dict(), model_name)
+        # normalizer.save(get_normalizer_name(model_name))
 
         ################################## train ###############################
         '''
@@ -163,37 +118,68 @@ class PridictTM():
         ################################## test ################################
         print("----------------------------test-----------------------\n")
         # load model
-        self.model.load_state_dict(torch.load(model_name))
+        self.model.load_state_dict(torch.load(model_name, map_location=self.device))
+        normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
         result = []
         count = 0
 
-        star_time = time.clock()
-        for i in range(train_len, len(x_data)):
-            test_x = x_data[i].reshape(1, -1, self.k).cuda()
-            test_y = y_data[i].reshape(1, self.input_size).cuda()
+        # streaming inference: every TM of the test span goes once through the ring buffers of
+        # the TCN levels, see common/tcn_stream.py, this is the forward of a window of k TMs
+        # only when the receptive field of the TCN fits in the window, with self.stream the whole test
+        # span is streamed anyway, its TMs then see up to receptive_field - 1 TMs before their window
+        # unlike in training, and its loss is reported next to the loss of the window forward
+        self.model.eval()
+        stream = StreamingTCN(self.model.tcn)
+        # window by window with weight_norm baked in, causal padding and no Chomp1d copies
+        test_model = self.model.fold()
+        window_equivalent = stream.receptive_field <= self.k
+        streaming = window_equivalent or self.stream
+        if not window_equivalent:
+            print("receptive field", stream.receptive_field, "> k =", self.k, ", testing window by window")
+        window_loss = 0.0
+        stream_loss = 0.0
+
+        star_time = time.time()
+        for test_x, test_y in test_stream.samples(normalizer):
+            count += 1
+            # (k, N) -> (1, N, k), as in training
+            test_x = test_x.t().reshape(1, -1, self.k).to(self.device)
+            test_y = test_y.reshape(1, self.input_size).to(self.device)
             # print("test_y.shape:", test_y.shape)
-            prediction = self.model.forward(test_x).cuda()
+            if not window_equivalent:
+                prediction = test_model.forward(test_x)
+                window_loss += loss_func(prediction, test_y).item()
+            if streaming:
+                # the first window fills the buffers, then one new TM per step
+                if count == 1:
+                    stream.extend(test_x[:, :, :-1])
+                prediction = self.model.forward_step(stream, test_x[:, :, -1])
+                stream_loss += loss_func(prediction, test_y).item()
             # print("prediction.shape:", prediction.shape)
             # break
             loss = loss_func(prediction, test_y)
-            # print("Loss for test data " + str(i - train_len + 1) + " is:", loss)
+            # print("Loss for test data " + str(count) + " is:", loss)
 
             # save result
             # data = []
-            # data.append(str(i - train_len + 1))
+            # data.append(str(count))
             # data.append(loss.cpu().data.numpy())
             # self.write_row_to_csv(data, "loss_TCN.csv")
 
             # inverse normalization
-            inverse_prediction, inverse_y = self.inverse_normalization(prediction.cpu().data.numpy()[0], test_y.cpu().data.numpy()[0], max_list, min_list)
+            inverse_prediction, inverse_y = self.inverse_normalization(prediction.cpu().data.numpy()[0], test_y.cpu().data.numpy()[0], normalizer)
             # inverse_prediction = inverse_prediction.reshape(int(math.sqrt(self.input_size)), int(math.sqrt(self.input_size)))
             # inverse_y = inverse_y.reshape(int(math.sqrt(self.input_size)), int(math.sqrt(self.input_size)))
 
-            path = "../../../TM_result/Abilene/TCN/TCN_" + str(i - train_len + 1) + ".txt"
+            path = "../../../TM_result/Abilene/TCN/TCN_" + str(count) + ".txt"
             # self.save_TM(inverse_prediction, path)
         ################################## test ################################
-        end_time = time.clock()
-        print((end_time - star_time) / (len(x_data) - train_len))
+        end_time = time.time()
+        print((end_time - star_time) / count)
+        if self.stream and not window_equivalent:
+            print("test loss, window:", window_loss / count, ", stream:", stream_loss / count)
+            self.write_row_to_csv([model_name, stream.receptive_field, self.k, window_loss / count,
+                                   stream_loss / count], "TCN_stream_loss.csv")
 
 
 
@@ -205,7 +191,10 @@ class PridictTM():
 
 if __name__ == "__main__":
     BATCH_SIZE = 50
-    USE_CUDA = True
+    # bytes of traffic data in memory at a time, the rest stays in the memory-mapped csv cache
+    MEMORY_LIMIT = 1024 * 1024 * 1024
+    # "cpu" or "cuda", None for $TM_DEVICE or cuda if available
+    device = None
     dropout = 0.05
     clip = -1
     epochs = 20
@@ -219,12 +208,19 @@ if __name__ == "__main__":
     output_size = 144
     channel_sizes = [nhid] * levels
     k = 10
+    # True: only the levels up to the one whose receptive field covers the k TMs
+    trim = False
+    # True: stream the test span one TM per step, a window of k TMs is streamed exactly only when
+    # the receptive field is <= k, which even one level of kernel_size 7 is not (13), so with these
+    # sizes the stream also sees the TMs before the window and its test loss is reported next to
+    # the loss of the window forward in TCN_stream_loss.csv
+    stream = False
 
     # PridictTM (self, file_name, k, input_size, hidden_size, num_layers)
     file_name = "../../../OD_pair/Abilene-OD_pair_2004-08-01.csv"
 
     predict_tm_model = PridictTM(file_name, k, input_size, input_channel, output_size, channel_sizes, kernel_size,
-                                 dropout, epochs, lr, USE_CUDA)
+                                 dropout, epochs, lr, device, trim, stream)
     predict_tm_model.train()
 
 
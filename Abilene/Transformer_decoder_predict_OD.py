@@ -10,9 +10,18 @@ import pandas as pd
 import math
 import time
 import os
+from common.od_cache import load_OD_cache
+from common.window import WindowDataset, get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.device import get_device
 
 BATCH_SIZE = 128
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+
 class RNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers):
         super(RNN, self).__init__()
@@ -75,63 +84,38 @@ class PridictTM():
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.rnn = Transformer(input_size, 1, 0)
-        # self.rnn.cuda()
+        # self.rnn.to(DEVICE)
         print(self.rnn)
 
     def get_OD_list(self, file_name):
-        df = pd.read_csv(file_name)
-        OD_list = df.columns.values.tolist()
-        del OD_list[0]
+        OD_list = load_OD_cache(file_name).get_OD_list()
 
         return OD_list
 
     def read_data(self, file_name, OD):
-        df = pd.read_csv(file_name)
-        data = np.array(df[OD])
-
-        # min-max normalization
-
-        max_value = np.max(data)
-        min_value = np.min(data)
-        if not (max_value == 0 and min_value == 0):
-            data = (data - min_value) / (max_value - min_value)
-        '''
+        data = np.array(load_OD_cache(file_name).get_OD(OD))
 
-        # z-score
-        
-        u = np.average(data)
-        sigma = np.std(data)
-        for i in range(len(data)):
-            data[i] = (data[i] - u) / sigma
-        '''
-        return data, max_value, min_value
+        # min-max normalization fitted on the training span, Normalizer("z-score") for z-score
+        train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+        normalizer = Normalizer("min-max").fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, normalizer
 
 
     # generate normalized time series data
     # list of ([x1, x2, ..., xk], [xk+1])
     # using first k data to predict the k+1 data
     def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        length = len(data)
-        for i in range(length - k):
-            x = data[i:i+k]
-            y = data[i+k]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
+        series = WindowDataset(data, k)
+        return series.x_data, series.y_data
 
     # generate batch data
     def generate_batch_loader(self, x_data, y_data):
         torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
+        loader = BatchLoader(
             dataset=torch_dataset,      # torch TensorDataset format
             batch_size=BATCH_SIZE,      # mini batch size
             shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
         )
         return loader
 
@@ -143,28 +127,15 @@ class PridictTM():
 
     # save TM result
     def save_TM(self, result_list):
-        test_data_length = len(result_list[0])
         size = int(math.sqrt(len(result_list)))
-        for i in range(test_data_length):
-            print("Save TM for data " + str(i))
-            file_name = "../TM_result/Abilene/LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-            TM = np.zeros(shape=(size, size))
-            row = -1
-            column = 0
-            for j in range(len(result_list)):
-                if j % 12 == 0:
-                    row += 1
-                    column = 0
-                TM[row][column] = result_list[j][i]
-                column += 1
-
-            f = open(file_name, 'w')
-            for w in range(size):
-                for k in range(size):
-                    if not TM[w][k] == 0.0:
-                        temp = str(w + 1) + ' ' + str(k + 1) + ' ' + str(TM[w][k]) + "\n"
-                        f.write(temp)
-            f.close()
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../TM_result/Abilene/Transformer_decoder_OD_pair.tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model="Transformer_decoder_OD_pair", topology="Abilene") as writer:
+            writer.extend(TMs, times)
 
 
     def train(self):
@@ -180,13 +151,13 @@ class PridictTM():
             print("Training for ", OD)
             model_name = model_path + "LSTM_" + OD + ".pkl"
             # print(OD_list)
-            data, max_value, min_value = self.read_data(self.file_name, OD)
+            data, normalizer = self.read_data(self.file_name, OD)
             x_data, y_data = self.generate_series(data, self.k)
             train_len = int(int(len(x_data) * 0.8) / 50) * 50
             data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
 
             self.rnn = Transformer(self.input_size, 1, 0)
-            self.rnn.cuda()
+            self.rnn.to(DEVICE)
             optimizer = torch.optim.Adagrad(self.rnn.parameters(), lr=self.LR)
             loss_func = nn.MSELoss()
 
@@ -204,8 +175,8 @@ class PridictTM():
                     # print(batch_y.shape)
                     batch_x = batch_x.reshape(BATCH_SIZE, self.k, self.input_size)  # (batch_size, time_step, input_size)
                     batch_y = batch_y.reshape(BATCH_SIZE, self.input_size)
-                    batch_x = batch_x.cuda()
-                    batch_y = batch_y.cuda()
+                    batch_x = batch_x.to(DEVICE)
+                    batch_y = batch_y.to(DEVICE)
                     prediction = self.rnn.forward(batch_x)
                     loss = loss_func(prediction, batch_y)
                     optimizer.zero_grad()
@@ -217,6 +188,7 @@ class PridictTM():
             ################################## train #################################
             # save model
             torch.save(self.rnn.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
             '''
 
 
@@ -227,11 +199,13 @@ class PridictTM():
                     result_list[count].append(0)
             else:
             # load model
-                self.rnn.load_state_dict(torch.load(model_name))
+                self.rnn.load_state_dict(torch.load(model_name, map_location=DEVICE))
+                normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
                 star_time = time.clock()
+                predictions = []
                 for i in range(train_len, len(x_data)):
-                    test_x = x_data[i].reshape(1, self.k, self.input_size).cuda()
-                    test_y = y_data[i].cuda()
+                    test_x = x_data[i].reshape(1, self.k, self.input_size).to(DEVICE)
+                    test_y = y_data[i].to(DEVICE)
                     prediction = self.rnn.forward(test_x).reshape(1)
                     # loss = loss_func(prediction, test_y)
 
@@ -241,9 +215,9 @@ class PridictTM():
                     # self.write_row_to_csv(data, "loss_LSTM_OD.csv")
     
                     prediction_value = prediction.cpu().data.numpy()[0]
-                    if prediction_value < 0:
-                        prediction_value = -prediction_value
-                    result_list[count].append(prediction_value * (max_value - min_value) + min_value)
+                    predictions.append(prediction_value)
+                # negative outputs are flipped, then the whole test span is scaled back
+                result_list[count].extend(normalizer.inverse_transform(predictions, absolute=True))
 
                 end_time = time.clock()
                 print((end_time - star_time) / (len(x_data) - train_len) * 144)
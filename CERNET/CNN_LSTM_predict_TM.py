@@ -9,6 +9,13 @@ import pandas as pd
 import csv
 import matplotlib as plt
 import time
+from common.window import get_train_len
+from common.od_stream import ODStream, StreamLoader
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.device import get_device
+from common.early_stopping import train_early_stopping, get_validation_len, log_report
+from common.frame_cache import FrameCache, embed_unique
+from common.freeze import freeze_model, benchmark_models, get_script_name
 
 # Hyper Parameters
 EPOCH = 20
@@ -19,7 +26,13 @@ INPUT_SIZE = 14
 HIDDEN_SIZE = 100
 NUM_LAYERS = 1
 K = 10
-USE_CUDA = True
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+# bytes of traffic data in memory at a time, the rest stays in the memory-mapped csv cache
+MEMORY_LIMIT = 1024 * 1024 * 1024
+# train on contiguous batches of consecutive windows and embed their shared frames once,
+# see StreamLoader and embed_unique, by default the batches are shuffled single windows
+CONTIGUOUS = False
 
 
 class AlexNet_LSTM(nn.Module):
@@ -103,13 +116,25 @@ class AlexNet_LSTM(nn.Module):
         ############################## LSTM ###################################
 
 
-    def forward(self, x, batch_size):
+    # per-frame embedding, x shape (frames, 1, input_size, input_size) -> (frames, input_size)
+    def embed(self, x):
         x = self.features2(x)
         # print("AlexNet CNN output shape:", x.shape)
         x = x.view(x.size(0), -1)
         middle_output = self.middle_out(x)
+        return middle_output
+
+    def forward(self, x, batch_size, unique=False):
+        # with unique every distinct frame of the batch goes through the CNN once, see common/frame_cache.py
+        if unique:
+            middle_output = embed_unique(self.embed, x)
+        else:
+            middle_output = self.embed(x)
         middle_output = middle_output.reshape(batch_size, K, INPUT_SIZE)
+        return self.predict(middle_output)
 
+    # the prediction from the frame embeddings, middle_output shape (batch_size, K, input_size)
+    def predict(self, middle_output):
         # LSTM
         r_out, (h_n, h_c) = self.rnn(middle_output, None)  # None represents zero initial hidden state
         out = self.out(r_out[:, -1, :])  # return the last value
@@ -180,8 +205,8 @@ class CNN_LSTM(nn.Module):
         self.out = nn.Linear(HIDDEN_SIZE, INPUT_SIZE * INPUT_SIZE)
         ############################## LSTM ###################################
 
-    def forward(self, x, batch_size):
-        # print("-------------------------------NN forward-------------------------------")
+    # per-frame embedding, x shape (frames, 1, input_size, input_size) -> (frames, input_size)
+    def embed(self, x):
         # CNN
         x = self.conv1(x)
         # print("conv1, x.shape:", x.shape)
@@ -193,7 +218,21 @@ class CNN_LSTM(nn.Module):
 
         x = x.view(x.size(0), -1)  # (batch_size, 16, 8, 8) -> (batch_size, 32 * 6 * 6)
         middle_output = self.middle_out(x)  # (batch_size * K, input_size)
+        return middle_output
+
+    def forward(self, x, batch_size, unique=False):
+        # print("-------------------------------NN forward-------------------------------")
+        # with unique every distinct frame of the batch goes through the CNN once, the windows of
+        # a contiguous batch share K - 1 frames, see common/frame_cache.py
+        if unique:
+            middle_output = embed_unique(self.embed, x)  # (batch_size * K, input_size)
+        else:
+            middle_output = self.embed(x)  # (batch_size * K, input_size)
         middle_output = middle_output.reshape(batch_size, K, INPUT_SIZE)  # reshape to (batch_size, time_step, input_size)
+        return self.predict(middle_output)
+
+    # the prediction from the frame embeddings, middle_output shape (batch_size, K, input_size)
+    def predict(self, middle_output):
         # print("middle_output.shape:", middle_output.shape)
         # LSTM
         r_out, (h_n, h_c) = self.rnn(middle_output, None)  # None represents zero initial hidden state
@@ -202,7 +241,6 @@ class CNN_LSTM(nn.Module):
         # print("r_out.shape:", r_out.shape)
         out = self.sigmoid(out)
         # print("out.shape:", out.shape)
-        # print("-------------------------------NN forward-------------------------------")
         return out
 
 
@@ -211,70 +249,13 @@ class PredictTM():
         self.nn_model = CNN_LSTM()
         self.complex_nn_model = AlexNet_LSTM()
 
-        # GPU
-        if USE_CUDA:
-            self.nn_model.cuda()
-            self.complex_nn_model.cuda()
-
-    def read_data(self):
-        df = pd.read_csv(FILE_NAME)
-        del df["time"]
-        data_list = df.values
-        # print(data_list)
-        # print(data_list.shape)
-        # print(type(data_list))
-
-        max_list = np.max(data_list, axis=0)
-        min_list = np.min(data_list, axis=0)
-        # print(len(max_list))
-        # print(len(min_list))
-
-        # OD pair, when O = D, max = min = 0, so data_list will have some nan value
-        # change these values to 0
-        data_list = (data_list - min_list) / (max_list - min_list)
-        data_list[np.isnan(data_list)] = 0
-
-        # change to TM list
-        data = []
-        for i in range(data_list.shape[0]):
-            data.append(data_list[i].reshape(INPUT_SIZE, INPUT_SIZE))
-        data = np.array(data)
-
-        return data, min_list, max_list
-
-    # generate normalized time series data
-    # list of ([TM1, TM2, TM3, .. TMk], [TMk+1])
-    # using first k data to predict the k+1 data
-    def generate_series(self, data):
-        length = data.shape[0]
-        x_data = []
-        y_data = []
-        for i in range(length - K):
-            x = data[i:i+K]
-            y = data[i+K]
-            x_data.append(x)
-            y_data.append(y)
-
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
-
-    # generate batch data
-    def generate_batch_loader(self, x_data, y_data):
-        torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
-            dataset=torch_dataset,      # torch TensorDataset format
-            batch_size=BATCH_SIZE,      # mini batch size
-            shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
-        )
-        return loader
+        self.nn_model.to(DEVICE)
+        self.complex_nn_model.to(DEVICE)
 
     # inverse normalization
-    def inverse_normalization(self, prediction, y, max_list, min_list):
-        inverse_prediction = prediction * (max_list - min_list) + min_list
-        inverse_y = y * (max_list - min_list) + min_list
+    def inverse_normalization(self, prediction, y, normalizer):
+        inverse_prediction = normalizer.inverse_transform(prediction)
+        inverse_y = normalizer.inverse_transform(y)
         return inverse_prediction, inverse_y
 
     # save TM result
@@ -291,13 +272,27 @@ class PredictTM():
 
 
     def train(self):
-        data, min_list, max_list = self.read_data()
-        x_data, y_data = self.generate_series(data)
-        print("x_data.shape:", x_data.shape)
-        print("y_data.shape:", y_data.shape)
-        train_len = int(int(len(x_data) * 0.8) / 50) * 50
+        # out-of-core: the windows of at most MEMORY_LIMIT bytes of TMs are materialized at a time
+        stream = ODStream(FILE_NAME, K, memory_limit=MEMORY_LIMIT)
+        print("time steps:", len(stream), ", chunk size:", stream.chunk_size)
+        train_len = get_train_len(len(stream) - K, BATCH_SIZE)
         print("training len:", train_len)
-        data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
+        train_stream, test_stream = stream.split(train_len)
+
+        # min-max normalization of every OD, fitted on the training span
+        normalizer = train_stream.fit(Normalizer("min-max", axis=0))
+        # the last val_len training windows are held out for early stopping
+        val_len = get_validation_len(train_len, BATCH_SIZE)
+        train_stream, validation_stream = train_stream.split(train_len - val_len)
+        validation = StreamLoader(stream=validation_stream, batch_size=BATCH_SIZE, shuffle=False, normalizer=normalizer)
+        data_loader = StreamLoader(
+            stream=train_stream,
+            batch_size=BATCH_SIZE,      # mini batch size
+            shuffle=True,               # random order data
+            contiguous=CONTIGUOUS,      # consecutive windows, their shared frames are embedded once
+            normalizer=normalizer,
+            prefetch=2,                 # gather next batches in a background thread
+        )
 
         # print(self.nn_model)
         optimizer = torch.optim.Adagrad(params=self.nn_model.parameters(), lr=LR)
@@ -305,34 +300,15 @@ class PredictTM():
         loss_func = nn.MSELoss()
 
 
-        star_time = time.clock()
         #################################### train ####################################
-        for e in range(EPOCH):
-            # print("Epoch:", e)
-            for step, (batch_x, batch_y) in enumerate(data_loader):
-                # print("batch_x.shape:", batch_x.shape)
-                # print("batch_y.shape", batch_y.shape)
-
-                # GPU
-                if USE_CUDA:
-                    batch_x = batch_x.cuda()
-                    batch_y = batch_y.cuda()
-                    prediction = self.nn_model.forward(batch_x.reshape(BATCH_SIZE*K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=BATCH_SIZE).cuda()
-                    # prediction = self.complex_nn_model.forward(batch_x.reshape(BATCH_SIZE*K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=BATCH_SIZE).cuda()
-                else:
-                    # prediction = self.nn_model.forward(batch_x.reshape(BATCH_SIZE*K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=BATCH_SIZE)
-                    prediction = self.complex_nn_model.forward(batch_x.reshape(BATCH_SIZE*K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=BATCH_SIZE)
-
-                # break
-                # print(prediction.shape)
-                batch_y = batch_y.reshape(BATCH_SIZE, INPUT_SIZE * INPUT_SIZE)
-                loss = loss_func(prediction, batch_y)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                # print("Epoch =", e, ", step =", step, ", loss:", loss)
-        end_time = time.clock()
-        print(end_time - star_time)
+        report = train_early_stopping(
+            self.nn_model, data_loader, validation, EPOCH, optimizer, loss_func,
+            forward=lambda x: self.nn_model.forward(x.reshape(-1, 1, INPUT_SIZE, INPUT_SIZE), batch_size=x.shape[0],
+                                                   unique=CONTIGUOUS),
+            # forward=lambda x: self.complex_nn_model.forward(x.reshape(-1, 1, INPUT_SIZE, INPUT_SIZE), batch_size=x.shape[0],
+            #                                            unique=CONTIGUOUS),
+            device=DEVICE)
+        log_report("CNN_LSTM", report, "CNN_LSTM_early_stopping.csv")
         #################################### train ####################################
 
 
@@ -340,6 +316,7 @@ class PredictTM():
         # model_name = "CNN_LSTM_LR=" + str(LR) + "_hidden=" + str(HIDDEN_SIZE) + ".pkl"
         # model_name = "complex_CNN_LSTM_LR=" + str(LR) + "_hidden=" + str(HIDDEN_SIZE) + ".pkl"
         # torch.save(self.nn_model.state_dict(), model_name)
+        # normalizer.save(get_normalizer_name(model_name))
         # torch.save(self.complex_nn_model.state_dict(), model_name)
 
 
@@ -348,24 +325,31 @@ class PredictTM():
 
         '''
         # load model
-        self.nn_model.load_state_dict(torch.load(model_name))
-        # self.complex_nn_model.load_state_dict(torch.load(model_name))
+        self.nn_model.load_state_dict(torch.load(model_name, map_location=DEVICE))
+        normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+        # self.complex_nn_model.load_state_dict(torch.load(model_name, map_location=DEVICE))
+        # the embeddings of the frames of the last window, only the new frame of every window goes
+        # through the CNN, the embedding of a frame does not depend on its window in eval mode
+        self.nn_model.eval()
+        test_model = self.nn_model
+        # self.complex_nn_model.eval()
+        # test_model = self.complex_nn_model
+        # on the CPU the conv stack runs frozen: BatchNorm folded, no dropout, channels_last
+        if DEVICE.type == "cpu":
+            test_model = freeze_model(self.nn_model, ["conv1"])
+            # test_model = freeze_model(self.complex_nn_model, ["features2"])
+        frame_cache = FrameCache(test_model.embed, K)
+        count = 0
         star_time = time.clock()
-        for i in range(train_len, len(x_data)):
-            test_x = x_data[i]
-            test_y = y_data[i]
+        for test_x, test_y in test_stream.samples(normalizer):
+            count += 1
             # print("test_x.shape:", test_x.shape)
             # print("test_y.shape", test_y.shape)
 
-            # GPU
-            if USE_CUDA:
-                test_x = test_x.cuda()
-                test_y = test_y.cuda()
-                prediction = self.nn_model.forward(test_x.reshape(K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=1).cuda()
-                # prediction = self.complex_nn_model.forward(test_x.reshape(K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=1).cuda()
-            else:
-                # prediction = self.nn_model.forward(test_x.reshape(K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=1)
-                prediction = self.complex_nn_model.forward(test_x.reshape(K, 1, INPUT_SIZE, INPUT_SIZE), batch_size=1)
+            test_x = test_x.to(DEVICE)
+            test_y = test_y.to(DEVICE)
+            middle_output = frame_cache.get(test_x.reshape(K, 1, INPUT_SIZE, INPUT_SIZE))
+            prediction = test_model.predict(middle_output.reshape(1, K, INPUT_SIZE))
 
             # print("prediction.shape:", prediction.shape)
 
@@ -373,42 +357,49 @@ class PredictTM():
             test_y = test_y.reshape(1, INPUT_SIZE * INPUT_SIZE)
 
             loss = loss_func(prediction, test_y)
-            # print("Loss for test data " + str(i - train_len + 1) + " is:", loss)
+            # print("Loss for test data " + str(count) + " is:", loss)
             
             # save result
             # data = []
-            # data.append(str(i - train_len + 1))
-            # if USE_CUDA:
-            #     data.append(loss.cpu().data.numpy())
-            # else:
-            #     data.append(loss.data.numpy())
+            # data.append(str(count))
+            # data.append(loss.cpu().data.numpy())
             # self.write_row_to_csv(data, "loss_CNN_LSTM.csv")
 
 
             # inverse normalization
-            if USE_CUDA:
-                # print(prediction.cpu().data.numpy().shape)
-                prediction = prediction.cpu().data.numpy()[0]
-                test_y = test_y.cpu().data.numpy()[0]
-                inverse_prediction, inverse_y = self.inverse_normalization(prediction, test_y, max_list, min_list)
-                inverse_prediction = inverse_prediction.reshape(INPUT_SIZE, INPUT_SIZE)
-                # path = "../TM_result/CERNET/CNN_LSTM/CNN_LSTM_" + str(i - train_len + 1) + ".txt"
-                # self.save_TM(inverse_prediction, path)
-
-            else:
-                # print(prediction.data.numpy().shape)
-                prediction = prediction.data.numpy()[0]
-                test_y = test_y.data.numpy()[0]
-                inverse_prediction, inverse_y = self.inverse_normalization(prediction, test_y, max_list, min_list)
-                inverse_prediction = inverse_prediction.reshape(INPUT_SIZE, INPUT_SIZE)
-                # path = "../TM_result/CERNET/CNN_LSTM/CNN_LSTM_" + str(i - train_len + 1) + ".txt"
-                # self.save_TM(inverse_prediction, path)
+            # print(prediction.cpu().data.numpy().shape)
+            prediction = prediction.cpu().data.numpy()[0]
+            test_y = test_y.cpu().data.numpy()[0]
+            inverse_prediction, inverse_y = self.inverse_normalization(prediction, test_y, normalizer)
+            inverse_prediction = inverse_prediction.reshape(INPUT_SIZE, INPUT_SIZE)
+            # path = "../TM_result/CERNET/CNN_LSTM/CNN_LSTM_" + str(count) + ".txt"
+            # self.save_TM(inverse_prediction, path)
         end_time = time.clock()
-        print((end_time - star_time) / (len(x_data) - train_len))
+        print((end_time - star_time) / count)
         #################################### test ####################################
         '''
 
 
+    # per-TM latency of the CPU inference path: the eager model in eval mode against its frozen
+    # copies (common/freeze.py) on the K frames of one window, as in the test loop without the
+    # frame cache, written to <model>_inference.csv
+    # alexnet: AlexNet_LSTM instead of CNN_LSTM
+    def benchmark_inference(self, alexnet=False):
+        if alexnet:
+            model, names, name = self.complex_nn_model, ["features2"], "AlexNet_LSTM"
+        else:
+            model, names, name = self.nn_model, ["conv1"], "CNN_LSTM"
+        model.to("cpu").eval()
+        x = torch.rand(K, 1, INPUT_SIZE, INPUT_SIZE)
+        models = [
+            ("eager", model),
+            ("folded", freeze_model(model, names, channels_last=False)),
+            ("folded channels_last", freeze_model(model, names)),
+            (get_script_name(), freeze_model(model, names, script=True, example=x)),
+        ]
+        print(name, str(INPUT_SIZE) + "x" + str(INPUT_SIZE))
+        benchmark_models(models, lambda model: model.forward(x, batch_size=1), file_name=name + "_inference.csv")
+
     def write_row_to_csv(self, data, file_name):
         with open(file_name, 'a+', newline="") as datacsv:
             csvwriter = csv.writer(datacsv, dialect=("excel"))
@@ -417,6 +408,7 @@ class PredictTM():
 if __name__ == "__main__":
     predict_tm_model = PredictTM()
     predict_tm_model.train()
+    # predict_tm_model.benchmark_inference()
 
 
     # np_list = []
@@ -10,6 +10,15 @@ import csv
 import os
 import math
 import time
+from common.od_cache import load_OD_cache
+from common.window import WindowDataset, get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.early_stopping import train_early_stopping, get_validation_len, log_report
+from common.checkpoint import save_model, is_done, mark_done, get_checkpoint_name, get_prediction_name, \
+    save_predictions, load_predictions
+from common.parallel_od import map_ODs, THREADS
 BATCH_SIZE = 50
 
 
@@ -111,7 +120,7 @@ class DBN(nn.Module):
             tensor_x = tmp.type(torch.FloatTensor) # transform to torch tensors
             tensor_y = train_labels.type(torch.FloatTensor)
             _dataset = torch.utils.data.TensorDataset(tensor_x,tensor_y) # create your datset
-            _dataloader = torch.utils.data.DataLoader(_dataset,batch_size=batch_size,drop_last = True) # create your dataloader
+            _dataloader = BatchLoader(_dataset, batch_size=batch_size, shuffle=False, drop_last=True) # create your dataloader
 
             self.rbm_layers[i].train(_dataloader , num_epochs,batch_size)
             # print(train_data.shape)
@@ -139,7 +148,7 @@ class DBN(nn.Module):
         tensor_x = tmp.type(torch.FloatTensor) # transform to torch tensors
         tensor_y = train_labels.type(torch.FloatTensor)
         _dataset = torch.utils.data.TensorDataset(tensor_x,tensor_y) # create your datset
-        _dataloader = torch.utils.data.DataLoader(_dataset , batch_size=batch_size,drop_last=True)
+        _dataloader = BatchLoader(_dataset, batch_size=batch_size, shuffle=False, drop_last=True)
         self.rbm_layers[ith_layer].train(_dataloader, num_epochs,batch_size)
         return
 
@@ -154,58 +163,33 @@ class PridictTM():
         # self.rnn.cuda()
 
     def get_OD_list(self, file_name):
-        df = pd.read_csv(file_name)
-        OD_list = df.columns.values.tolist()
-        del OD_list[0]
+        OD_list = load_OD_cache(file_name).get_OD_list()
 
         return OD_list
 
     def read_data(self, file_name, OD):
-        df = pd.read_csv(file_name)
-        data = np.array(df[OD])
+        data = np.array(load_OD_cache(file_name).get_OD(OD))
 
-        # min-max normalization
-
-        max_value = np.max(data)
-        min_value = np.min(data)
-        if not (max_value == 0 and min_value == 0):
-            data = (data - min_value) / (max_value - min_value)
-        '''
-
-        # z-score
-
-        u = np.average(data)
-        sigma = np.std(data)
-        for i in range(len(data)):
-            data[i] = (data[i] - u) / sigma
-        '''
-        return data, max_value, min_value
+        # min-max normalization fitted on the training span, Normalizer("z-score") for z-score
+        train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+        normalizer = Normalizer("min-max").fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, normalizer
 
     # generate normalized time series data
     # list of ([x1, x2, ..., xk], [xk+1])
     # using first k data to predict the k+1 data
     def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        length = len(data)
-        for i in range(length - k):
-            x = data[i:i + k]
-            y = data[i + k]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
+        series = WindowDataset(data, k)
+        return series.x_data, series.y_data
 
     # generate batch data
     def generate_batch_loader(self, x_data, y_data):
         torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
+        loader = BatchLoader(
             dataset=torch_dataset,  # torch TensorDataset format
             batch_size=BATCH_SIZE,  # mini batch size
             shuffle=True,  # random order data
-            num_workers=2,  # multiple threading to read data
         )
         return loader
 
@@ -216,28 +200,64 @@ class PridictTM():
 
     # save TM result
     def save_TM(self, result_list):
-        test_data_length = len(result_list[0])
         size = int(math.sqrt(len(result_list)))
-        for i in range(test_data_length):
-            print("Save TM for data " + str(i))
-            file_name = "../../TM_result/CERNET/\DBN/\DBN_" + str(i + 1) + ".txt"
-            TM = np.zeros(shape=(size, size))
-            row = -1
-            column = 0
-            for j in range(len(result_list)):
-                if j % 14 == 0:
-                    row += 1
-                    column = 0
-                TM[row][column] = result_list[j][i]
-                column += 1
-
-            f = open(file_name, 'w')
-            for w in range(size):
-                for k in range(size):
-                    if not TM[w][k] == 0.0:
-                        temp = str(w + 1) + ' ' + str(k + 1) + ' ' + str(TM[w][k]) + "\n"
-                        f.write(temp)
-            f.close()
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../../TM_result/CERNET/DBN.tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model="DBN", topology="CERNET") as writer:
+            writer.extend(TMs, times)
+
+    # train (unless it is marked done) and test one OD, returns the predicted traffic of the
+    # test span, run by train_parallel in a worker process
+    def train_OD(self, OD):
+        model_name = "../../CERNET/model_DBN_OD/DBN_" + OD + ".pkl"
+        data, normalizer = self.read_data(self.file_name, OD)
+        x_data, y_data = self.generate_series(data, self.k)
+        train_len = get_train_len(len(x_data), BATCH_SIZE)
+        if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+            return [0] * (len(x_data) - train_len)
+
+        # finished by an earlier run
+        predictions = load_predictions(get_prediction_name(model_name))
+        if predictions is not None:
+            return predictions
+
+        self.dbn = DBN()
+        # trained by an earlier run, an interrupted OD continues from its last checkpoint
+        if is_done(model_name):
+            self.dbn.load_state_dict(torch.load(model_name, map_location="cpu"))
+            normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+        else:
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            validation = [(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])]
+            data_loader = self.generate_batch_loader(x_data[:train_len - val_len], y_data[:train_len - val_len])
+            optimizer = torch.optim.Adagrad(self.dbn.parameters(), lr=self.LR)
+            loss_func = nn.MSELoss()
+            report = train_early_stopping(self.dbn, data_loader, validation, self.epoch, optimizer, loss_func,
+                                          device="cpu", checkpoint=get_checkpoint_name(model_name))
+            log_report(OD, report, os.path.join(os.path.dirname(model_name), "early_stopping.csv"))
+            save_model(self.dbn.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+            mark_done(model_name, report)
+
+        # the whole test span as one batch
+        with torch.no_grad():
+            predictions = self.dbn.forward(x_data[train_len:].reshape(-1, self.k))
+        # negative outputs are flipped, then the whole test span is scaled back
+        predictions = list(normalizer.inverse_transform(predictions.reshape(-1).numpy(), absolute=True))
+        # written at once, a restarted run does not predict this OD again
+        save_predictions(predictions, get_prediction_name(model_name))
+        return predictions
+
+    # train_OD for every OD on a pool of processes, THREADS torch threads each, see common/parallel_od.py
+    def train_parallel(self, workers=None):
+        OD_list = self.get_OD_list(self.file_name)
+        result_list = map_ODs(self.train_OD, OD_list, workers, THREADS)
+        self.save_TM(result_list)
 
     def train(self):
         OD_list = self.get_OD_list(self.file_name)
@@ -253,10 +273,13 @@ class PridictTM():
             model_name = model_path + "DBN_" + OD + ".pkl"
 
             # print(OD_list)
-            data, max_value, min_value = self.read_data(self.file_name, OD)
+            data, normalizer = self.read_data(self.file_name, OD)
             x_data, y_data = self.generate_series(data, self.k)
             train_len = int(int(len(x_data) * 0.8) / 50) * 50
-            data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            validation = [(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])]
+            data_loader = self.generate_batch_loader(x_data[:train_len - val_len], y_data[:train_len - val_len])
 
             # reset dbn
             self.dbn = DBN()
@@ -264,44 +287,36 @@ class PridictTM():
             optimizer = torch.optim.Adagrad(self.dbn.parameters(), lr=self.LR)
             loss_func = nn.MSELoss()
 
-            '''
             ################################## train #################################
-            # if os.path.exists(model_name):
-            #     continue
-            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
-                continue
-            star_time = time.clock()
-            for e in range(self.epoch):
-                # print("Epoch:", e)
-                for step, (batch_x, batch_y) in enumerate(data_loader):
-                    # batch_x = batch_x.reshape(BATCH_SIZE, self.k, self.input_size)  # (batch_size, time_step, input_size)
-                    # batch_y = batch_y.reshape(BATCH_SIZE, self.input_size)
-                    # batch_x = batch_x.cuda()
-                    # batch_y = batch_y.cuda()
-                    prediction = self.dbn.forward(batch_x).reshape(BATCH_SIZE)
-                    loss = loss_func(prediction, batch_y)
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
-                    # print("Epoch =", e, ", step =", step, ", loss:", loss)
-
+            # O = D pairs are not trained, an OD marked done by an earlier run neither, an interrupted
+            # OD continues from its last checkpoint
+            if OD.split('_')[1].split('-')[0] != OD.split('_')[1].split('-')[1] and not is_done(model_name):
+                # the DBN runs on the cpu
+                report = train_early_stopping(self.dbn, data_loader, validation, self.epoch, optimizer, loss_func,
+                                              device="cpu", checkpoint=get_checkpoint_name(model_name))
+                log_report(OD, report, model_path + "early_stopping.csv")
+                # save model
+                save_model(self.dbn.state_dict(), model_name)
+                normalizer.save(get_normalizer_name(model_name))
+                mark_done(model_name, report)
             ################################## train #################################
-            # save model
-            torch.save(self.dbn.state_dict(), model_name)
-            end_time = time.clock()
-            print((end_time - star_time) * 196)
-            '''
-
 
             ################################## test #################################
+            # predictions of an earlier run
+            saved_predictions = load_predictions(get_prediction_name(model_name))
+            if saved_predictions is not None:
+                result_list[count].extend(saved_predictions)
+                count += 1
+                continue
             if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
                 for i in range(train_len, len(x_data)):
                     result_list[count].append(0)
             else:
                 # load model
                 self.dbn.load_state_dict(torch.load(model_name))
-                star_time = time.clock()
+                normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+                star_time = time.time()
+                predictions = []
                 for i in range(train_len, len(x_data)):
                     test_x = x_data[i].reshape(1, -1)
                     test_y = y_data[i]
@@ -312,10 +327,12 @@ class PridictTM():
                     # self.write_row_to_csv(data, "DBN_OD1-2_loss.csv")
     
                     prediction_value = prediction.data.numpy()[0]
-                    if prediction_value < 0:
-                        prediction_value = -prediction_value
-                    result_list[count].append(prediction_value * (max_value - min_value) + min_value)
-                end_time = time.clock()
+                    predictions.append(prediction_value)
+                # negative outputs are flipped, then the whole test span is scaled back
+                result_list[count].extend(normalizer.inverse_transform(predictions, absolute=True))
+                # written at once, a restarted run does not predict this OD again
+                save_predictions(result_list[count], get_prediction_name(model_name))
+                end_time = time.time()
                 print((end_time - star_time) / (len(x_data) - train_len) * 196)
             ################################## test #################################
             count += 1
@@ -334,4 +351,5 @@ if __name__ == "__main__":
     LR = 0.065
 
     predict_tm_model = PridictTM(file_name, k, epoch, LR)
-    predict_tm_model.train()
\ No newline at end of file
+    predict_tm_model.train()
+    # predict_tm_model.train_parallel()
\ No newline at end of file
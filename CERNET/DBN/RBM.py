@@ -7,6 +7,7 @@ import torch.nn.functional as F
 import math
 from tqdm import tqdm
 import sys
+from common.batch_loader import BatchLoader
 
 BATCH_SIZE = 64
 
@@ -179,10 +180,10 @@ class RBM(nn.Module):
     def train(self, train_dataloader, num_epochs=50, batch_size=16):
 
         self.batch_size = batch_size
-        if (isinstance(train_dataloader, torch.utils.data.DataLoader)):
+        if (isinstance(train_dataloader, (torch.utils.data.DataLoader, BatchLoader))):
             train_loader = train_dataloader
         else:
-            train_loader = torch.utils.data.DataLoader(train_dataloader, batch_size=batch_size)
+            train_loader = BatchLoader(train_dataloader, batch_size=batch_size, shuffle=False)
 
         for epoch in range(1, num_epochs + 1):
             epoch_err = 0.0
@@ -10,8 +10,17 @@ import matplotlib.pyplot as plt
 import torch.utils.data as Data
 import math
 import time
+from common.window import get_train_len
+from common.od_stream import ODStream, StreamLoader, get_OD_files
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.device import get_device
 BATCH_SIZE = 50
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+# time steps read from the csv files at a time, a multiple of BATCH_SIZE
+CHUNK_SIZE = 2000
+
 class RNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers):
         super(RNN, self).__init__()
@@ -47,64 +56,13 @@ class PridictTM():
         self.LR = LR
         self.input_size = input_size
         self.rnn = RNN(input_size, hidden_size, num_layers)
-        self.rnn.cuda()
+        self.rnn.to(DEVICE)
         print(self.rnn)
 
-    def read_data(self, file_name):
-        df = pd.read_csv(file_name)
-        del df["time"]
-        data_list = df.values
-        # print(data_list)
-        # print(data_list.shape)
-        # print(type(data_list))
-
-        max_list = np.max(data_list, axis=0)
-        min_list = np.min(data_list, axis=0)
-        # print(len(max_list))
-        # print(len(min_list))
-
-        # OD pair, when O = D, max = min = 0, so data_list will have some nan value
-        # change these values to 0
-        data_list = (data_list - min_list) / (max_list - min_list)
-        data_list[np.isnan(data_list)] = 0
-
-        return data_list, min_list, max_list
-
-
-    # generate normalized time series data
-    # list of ([x1, x2, ..., xk], [xk+1])
-    # using first k data to predict the k+1 data
-    def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        print("data.shape: ", data.shape)
-        length = data.shape[0]
-        # print(length)
-        for i in range(length - k):
-            x = data[i:i+k, :]
-            y = data[i+k, :]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
-
-    # generate batch data
-    def generate_batch_loader(self, x_data, y_data):
-        torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
-            dataset=torch_dataset,      # torch TensorDataset format
-            batch_size=BATCH_SIZE,      # mini batch size
-            shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
-        )
-        return loader
-
     # inverse normalization
-    def inverse_normalization(self, prediction, y, max_list, min_list):
-        inverse_prediction = prediction * (max_list - min_list) + min_list
-        inverse_y = y * (max_list - min_list) + min_list
+    def inverse_normalization(self, prediction, y, normalizer):
+        inverse_prediction = normalizer.inverse_transform(prediction)
+        inverse_y = normalizer.inverse_transform(y)
 
         return inverse_prediction, inverse_y
 
@@ -120,15 +78,16 @@ class PridictTM():
         f.close()
 
     def train(self):
-        data, min_list, max_list = self.read_data(self.file_name)
-        x_data, y_data = self.generate_series(data, self.k)
-        print("x_data.shape:", x_data.shape)
-        print("y_data.shape:", y_data.shape)
-        train_len = int(int(len(x_data) * 0.8) / 50) * 50
+        # file_name is one csv or all the days of a run, read CHUNK_SIZE time steps at a time
+        stream = ODStream(self.file_name, self.k, CHUNK_SIZE)
+        print("time steps:", len(stream), ", files:", len(stream.files))
+        train_len = get_train_len(len(stream) - self.k, BATCH_SIZE)
         print("Training length: ", train_len)
+        train_stream, test_stream = stream.split(train_len)
 
-
-        data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
+        # min-max normalization of every OD, fitted on the training span
+        normalizer = train_stream.fit(Normalizer("min-max", axis=0))
+        data_loader = StreamLoader(train_stream, BATCH_SIZE, normalizer=normalizer)
 
         optimizer = torch.optim.Adagrad(self.rnn.parameters(), lr=self.LR)
         loss_func = nn.MSELoss()
@@ -141,11 +100,11 @@ class PridictTM():
             # print("Epoch: ", e)
             result = []
             for step, (batch_x, batch_y) in enumerate(data_loader):
-                batch_x = batch_x.cuda()
-                batch_y = batch_y.cuda()
+                batch_x = batch_x.to(DEVICE)
+                batch_y = batch_y.to(DEVICE)
                 # print("batch_x.shape:", batch_x.shape)
                 # print("batch_y.shape:", batch_y.shape)
-                prediction = self.rnn.forward(batch_x).cuda()
+                prediction = self.rnn.forward(batch_x)
                 # print("prediction.shape:", prediction.shape)
                 # print(prediction)
                 # print(prediction[-1].data.numpy())
@@ -160,6 +119,7 @@ class PridictTM():
         print(end_time - star_time)
         # save model 
         # torch.save(self.rnn.state_dict(), model_name)
+        # normalizer.save(get_normalizer_name(model_name))
         
         ################################## train ###############################
         '''
@@ -168,36 +128,38 @@ class PridictTM():
         ################################## test ################################
         print("----------------------------test-----------------------\n")
         # load model
-        self.rnn.load_state_dict(torch.load(model_name))
+        self.rnn.load_state_dict(torch.load(model_name, map_location=DEVICE))
+        normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
         result = []
         count = 0
 
         star_time = time.clock()
-        for i in range(train_len, len(x_data)):
-            test_x = x_data[i].reshape(1, self.k, self.input_size).cuda()
-            test_y = y_data[i].reshape(1, self.input_size).cuda()
+        for test_x, test_y in test_stream.samples(normalizer):
+            count += 1
+            test_x = test_x.reshape(1, self.k, self.input_size).to(DEVICE)
+            test_y = test_y.reshape(1, self.input_size).to(DEVICE)
             # print("test_y.shape:", test_y.shape)
-            prediction = self.rnn.forward(test_x).cuda()
+            prediction = self.rnn.forward(test_x)
             # print("prediction.shape:", prediction.shape)
 
             loss = loss_func(prediction, test_y)
-            # print("Loss for test data " + str(i - train_len + 1) + " is:", loss)
+            # print("Loss for test data " + str(count) + " is:", loss)
             # break
             # save result
             # data = []
-            # data.append(str(i - train_len + 1))
+            # data.append(str(count))
             # data.append(loss.cpu().data.numpy())
             # self.write_row_to_csv(data, "loss_GRU.csv")
 
             # inverse normalization
-            inverse_prediction, inverse_y = self.inverse_normalization(prediction.cpu().data.numpy()[0], test_y.cpu().data.numpy()[0], max_list, min_list)
+            inverse_prediction, inverse_y = self.inverse_normalization(prediction.cpu().data.numpy()[0], test_y.cpu().data.numpy()[0], normalizer)
             inverse_prediction = inverse_prediction.reshape(int(math.sqrt(self.input_size)), int(math.sqrt(self.input_size)))
             # inverse_y = inverse_y.reshape(int(math.sqrt(self.input_size)), int(math.sqrt(self.input_size)))
 
-            # path = "E:/Tsinghua/master/Project/code/traffic matrix prediction/TM_result/GEANT/GRU/GRU_" + str(i - train_len + 1) + ".txt"
+            # path = "E:/Tsinghua/master/Project/code/traffic matrix prediction/TM_result/GEANT/GRU/GRU_" + str(count) + ".txt"
             # self.save_TM(inverse_prediction, path)
         end_time = time.clock()
-        print((end_time - star_time) / (len(x_data) - train_len))
+        print((end_time - star_time) / count)
         ################################## test ################################
 
 
@@ -212,6 +174,8 @@ class PridictTM():
 if __name__ == "__main__":
     # PridictTM (self, file_name, k, input_size, hidden_size, num_layers)
     file_name = "../OD_pair/CERNET-OD_pair_2013-03-01.csv"
+    # all the days of a date range as one series
+    # file_name = get_OD_files("../OD_pair/CERNET-OD_pair_*.csv", "2013-03-01", "2013-03-31")
     k = 10
     input_size = 196
     hidden_size = 300
@@ -11,10 +11,23 @@ import torch.utils.data as Data
 import math
 import time
 import os
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from common.window import get_train_len
+from common.od_stream import ODStream, StreamLoader
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.device import get_device
 
 BATCH_SIZE = 50
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+# bytes of traffic data in memory at a time, the rest stays in the memory-mapped csv cache
+MEMORY_LIMIT = 1024 * 1024 * 1024
+# k-means of a span of several chunks: passes over the chunks at most, and the largest move of a
+# normalized centre in a pass below which the centres have converged
+KMEANS_PASSES = 20
+KMEANS_TOL = 1e-4
+
 class EmbedRNN(nn.Module):
     '''
     combine LSTM with hour and day embedding
@@ -96,77 +109,13 @@ class PridictTM():
 
         self.model = EmbedRNN(traffic_dim, hour_embed_dim, week_day_embed_dim,
                               rnn_hidden_size, rnn_num_layers, k)
-        self.model.cuda()
+        self.model.to(DEVICE)
         print(self.model)
 
-    def read_data(self, file_name):
-        df = pd.read_csv(file_name)
-        week_day_data = df["week_day"]
-        hour_data = df["hour"]
-
-        del df["time"]
-
-        data_list = df.values
-        # print(data_list)
-        # print(data_list.shape)
-        # print(data_list[0].shape)
-        # print(data_list[:, 0].shape)
-        # print(type(data_list))
-
-        max_list = np.max(data_list, axis=0)
-        min_list = np.min(data_list, axis=0)
-        max_list = max_list[:-2]
-        min_list = min_list[:-2]
-
-        for i in range(max_list.shape[0]):
-            if not max_list[i] - min_list[i] == 0:
-                data_list[:, i] = (data_list[:, i] - min_list[i]) / (max_list[i] - min_list[i])
-
-        return data_list, min_list, max_list, week_day_data, hour_data
-
-
-    # generate normalized time series data
-    # list of ([x1, x2, ..., xk], [xk+1])
-    # using first k data to predict the k+1 data
-    def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        length = data.shape[0]
-        y_length = data.shape[1]
-        # print(length)
-        for i in range(length - k):
-            x = data[i: i + k, :]
-            y = data[i + k, :]
-
-            # y 数据不需要带有 week 和 hour
-            y = y[:y_length - 2]
-
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
-
-    # generate batch data
-    def generate_batch_loader(self, x_data, y_data):
-        torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
-            dataset=torch_dataset,      # torch TensorDataset format
-            batch_size=BATCH_SIZE,      # mini batch size
-            shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
-        )
-        return loader
-
     # inverse normalization
-    def inverse_normalization(self, prediction, max_traffic_list, min_traffic_list):
-        for i in range(prediction.shape[0]):
-            if prediction[i] < 0:
-                prediction[i] = -prediction[i]
-            prediction[i] = prediction[i] * (max_traffic_list[i] - min_traffic_list[i]) + max_traffic_list[i]
-
-        return prediction
+    # negative outputs are flipped before scaling back
+    def inverse_normalization(self, prediction, normalizer):
+        return normalizer.inverse_transform(prediction, absolute=True)
 
         # inverse_y = y * (max_list - min_list) + min_list
         # return inverse_prediction, inverse_y
@@ -182,26 +131,35 @@ class PridictTM():
                     f.write(temp)
         f.close()
 
-    def train(self):
-        # read traffic data
-        # traffic_data: [6048, 198], 198 = 196 + 2，TM 压成一行 196 + week + hour
-        traffic_data, min_traffic_list, max_traffic_list, week_day_data, hour_data = self.read_data(self.file_name)
+    # k-means cluster of the normalized TMs of stream, KMeans when the stream is one chunk,
+    # otherwise MiniBatchKMeans pass after pass over the chunks until the centres converge
+    def fit_kmeans(self, stream, normalizer):
+        if len(stream) <= stream.chunk_size:
+            cluster_data, calendar_data = next(stream.chunks(context=False))
+            return KMeans(self.cluster_number).fit(normalizer.transform(cluster_data))
+
+        kmeans_cls = MiniBatchKMeans(self.cluster_number)
+        for i in range(KMEANS_PASSES):
+            centroids = kmeans_cls.cluster_centers_.copy() if i > 0 else None
+            for cluster_data, calendar_data in stream.chunks(context=False):
+                kmeans_cls.partial_fit(normalizer.transform(cluster_data))
+            if centroids is not None and np.abs(kmeans_cls.cluster_centers_ - centroids).max() < KMEANS_TOL:
+                break
+        return kmeans_cls
 
-        # generate data series
-        traffic_data_series, y_data_series = self.generate_series(traffic_data, self.k)
-        # print(traffic_data_series.shape)
-        # print(y_data_series.shape)
+    def train(self):
+        # read traffic data out-of-core, at most MEMORY_LIMIT bytes of windows at a time
+        # every time step: [198], 198 = 196 + 2，TM 压成一行 196 + week + hour
+        stream = ODStream(self.file_name, self.k, calendar=True, memory_limit=MEMORY_LIMIT)
 
         # get train_data and test_data
-        train_len = int(int(len(traffic_data_series) * 0.8) / BATCH_SIZE) * BATCH_SIZE
-
-        x_train = traffic_data_series[:train_len]
-        y_train = y_data_series[:train_len]
-        x_test = traffic_data_series[train_len:]
-        y_test = y_data_series[train_len:]
-
+        train_len = get_train_len(len(stream) - self.k, BATCH_SIZE)
+        train_stream, test_stream = stream.split(train_len)
 
-        train_data_loader = self.generate_batch_loader(x_train, y_train)
+        # min-max normalization of every OD, fitted on the training span
+        # week_day and hour are not scaled
+        normalizer = train_stream.fit(Normalizer("min-max", axis=0))
+        train_data_loader = StreamLoader(train_stream, BATCH_SIZE, normalizer=normalizer)
 
         optimizer = torch.optim.Adagrad(self.model.parameters(), lr=self.LR)
         loss_func = nn.MSELoss()
@@ -215,11 +173,11 @@ class PridictTM():
         for e in range(self.epoch):
             print("Epoch: ", e)
             for step, (batch_x, batch_y) in enumerate(train_data_loader):
-                batch_x = batch_x.cuda()
-                batch_y = batch_y.cuda()
+                batch_x = batch_x.to(DEVICE)
+                batch_y = batch_y.to(DEVICE)
                 # print("batch_x.shape:", batch_x.shape)
                 # print("batch_y.shape:", batch_y.shape)
-                prediction = self.model.forward(batch_x).cuda()
+                prediction = self.model.forward(batch_x)
                 # print("prediction.shape:", prediction.shape)
                 # print(prediction)
                 # print(prediction[-1].data.numpy())
@@ -234,21 +192,21 @@ class PridictTM():
         
         # save model 
         torch.save(self.model.state_dict(), model_name)
+        normalizer.save(get_normalizer_name(model_name))
         ################################## train ###############################
         '''
 
         ################################## test ################################
         path = "../TM_result/CERNET/LSTM-EKM_TM/"
         # load model
-        self.model.load_state_dict(torch.load(model_name))
+        self.model.load_state_dict(torch.load(model_name, map_location=DEVICE))
+        normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
         # print(x_test[0][self.k - 1][:-2].data.numpy().shape,
         #       x_test[0][self.k - 1][:-2].data.numpy().shape)
 
-        # k-means cluster
-        cluster_data = traffic_data[:train_len, :self.node_num * self.node_num]
+        # k-means cluster of the first train_len TMs
         self.cluster_number = int(24 * (60 / self.time_step))
-        kmeans_cls = KMeans(self.cluster_number)
-        kmeans_cls.fit(cluster_data)
+        kmeans_cls = self.fit_kmeans(train_stream.subset(0, train_len), normalizer)
         centroids = kmeans_cls.cluster_centers_
         # print(cluster_data.shape)
         # print(len(centroids))
@@ -259,42 +217,39 @@ class PridictTM():
         # print(centroids[kmeans_cls.
         #       predict(x_test[0][self.k - 1][:-2].data.numpy().reshape(1, -1))][0])
 
+        count = 0
         star_time = time.clock()
-        for i in range(len(x_test)):
-            test_x = x_test[i].cuda().unsqueeze(0)
-            test_y = y_test[i].cuda().unsqueeze(0)
+        for x, y in test_stream.samples(normalizer):
+            count += 1
+            test_x = x.to(DEVICE).unsqueeze(0)
+            test_y = y.to(DEVICE).unsqueeze(0)
             # print(test_x.shape, test_y.shape)
             # print("test_y.shape:", test_y.shape)
-            prediction = self.model.forward(test_x).cuda()
+            prediction = self.model.forward(test_x)
             # print("prediction.shape:", prediction.shape)
 
             # get prediction loss
             # loss = loss_func(prediction, test_y)
-            # print("Loss for test data " + str(i - train_len + 1) + " is:", loss)
+            # print("Loss for test data " + str(count) + " is:", loss)
             # break
             # save result
             # data = []
-            # data.append(str(i - train_len + 1))
+            # data.append(str(count))
             # data.append(loss.cpu().data.numpy())
             # self.write_row_to_csv(data, "loss_LSTM.csv")
 
             # inverse normalization
             # print(prediction.cpu().data.numpy()[0])
             # print(prediction.cpu().data.numpy()[0].shape)
-            # print(max_traffic_list.shape)
-            # print(min_traffic_list.shape)
-            inverse_prediction = self.inverse_normalization(prediction.cpu().data.numpy()[0],
-                                                            max_traffic_list, min_traffic_list)
+            inverse_prediction = self.inverse_normalization(prediction.cpu().data.numpy()[0], normalizer)
 
             # find centroid by the previous traffic
             prediction_value = (inverse_prediction +
                                 centroids[kmeans_cls.predict
-                                (x_test[i][self.k - 1][:-2].data.numpy().reshape(1, -1))][0]) / 2.0
+                                (x[self.k - 1][:-2].data.numpy().reshape(1, -1))][0]) / 2.0
 
             # 矩阵聚类有可能出现负数，避免这一情况影响 TE
-            for j in range(prediction_value.shape[0]):
-                if prediction_value[j] < 0:
-                    prediction_value[j] = -prediction_value[j]
+            prediction_value = np.abs(prediction_value)
 
 
             prediction_value = inverse_prediction
@@ -302,12 +257,12 @@ class PridictTM():
 
             if not os.path.exists(path):
                 os.makedirs(path)
-            our_file = path + "LSTM-EKM_TM_" + str(i + 1) + ".txt"
+            our_file = path + "LSTM-EKM_TM_" + str(count) + ".txt"
             self.save_TM(prediction_value, our_file)
 
         ################################## test ################################
         end_time = time.clock()
-        print("test time:", (end_time - star_time) / len(x_test))
+        print("test time:", (end_time - star_time) / count)
 
 
     def write_row_to_csv(self, data, file_name):
@@ -318,7 +273,7 @@ class PridictTM():
 
 if __name__ == "__main__":
     # PridictTM (self, file_name, k, input_size, hidden_size, num_layers)
-    file_name = "../OD_pair/CERNET-OD_pair_embed_2013-03-01.csv"
+    file_name = "../OD_pair/CERNET-OD_pair_2013-03-01.csv"
     k = 10
     traffic_dim = 196
     week_day_embed_dim = 100
@@ -7,7 +7,10 @@ import math
 import networkx as nx
 import matplotlib.pyplot as plt
 import pandas as pd
+from common.tm_archive import load_TM, load_TM_run
+from common.te_export import format_ospf, write_file, export_runs
 
+NODE_NUM = 14
 CAPA = 9920000
 PATH_CERNET = "../TM_result/CERNET/"
 
@@ -40,6 +43,8 @@ GRU_EKM_KEC_10_TM = PATH_CERNET + "GRU_EKM_KEC_10/"
 GRU_EKM_KEC_20_TM = PATH_CERNET + "GRU_EKM_KEC_20/"
 GRU_EKM_KEC_40_TM = PATH_CERNET + "GRU_EKM_KEC_40/"
 GRU_EKM_KEC_78_TM = PATH_CERNET + "GRU_EKM_KEC_78/"
+LSTM_global_TM = PATH_CERNET + "LSTM-global_OD_pair/"
+GRU_global_TM = PATH_CERNET + "GRU-global_OD_pair/"
 
 Origin_OSPF_TM = PATH_OSPF_CERNET + "Origin/"
 LSTM_OSPF_TM = PATH_OSPF_CERNET + "LSTM/"
@@ -66,6 +71,8 @@ GRU_EKM_KEC_10_OSPF_TM = PATH_OSPF_CERNET + "GRU_EKM_KEC_10/"
 GRU_EKM_KEC_20_OSPF_TM = PATH_OSPF_CERNET + "GRU_EKM_KEC_20/"
 GRU_EKM_KEC_40_OSPF_TM = PATH_OSPF_CERNET + "GRU_EKM_KEC_40/"
 GRU_EKM_KEC_78_OSPF_TM = PATH_OSPF_CERNET + "GRU_EKM_KEC_78/"
+LSTM_global_OSPF_TM = PATH_OSPF_CERNET + "LSTM-global_OD_pair/"
+GRU_global_OSPF_TM = PATH_OSPF_CERNET + "GRU-global_OD_pair/"
 
 Origin_HYBRID_TM = PATH_HYBRID_CERNET + "Origin/"
 LSTM_HYBRID_TM = PATH_HYBRID_CERNET + "LSTM/"
@@ -92,6 +99,8 @@ GRU_EKM_KEC_10_HYBRID_TM = PATH_HYBRID_CERNET + "GRU_EKM_KEC_10/"
 GRU_EKM_KEC_20_HYBRID_TM = PATH_HYBRID_CERNET + "GRU_EKM_KEC_20/"
 GRU_EKM_KEC_40_HYBRID_TM = PATH_HYBRID_CERNET + "GRU_EKM_KEC_40/"
 GRU_EKM_KEC_78_HYBRID_TM = PATH_HYBRID_CERNET + "GRU_EKM_KEC_78/"
+LSTM_global_HYBRID_TM = PATH_HYBRID_CERNET + "LSTM-global_OD_pair/"
+GRU_global_HYBRID_TM = PATH_HYBRID_CERNET + "GRU-global_OD_pair/"
 
 
 def generate_topo(topo_file, out_file):
@@ -115,43 +124,16 @@ def generate_topo(topo_file, out_file):
                 weight = int(line[3])
                 f.write("LINK: " + str(src) + ' ' + str(dst) + ' ' + "CC 1\n")
 
-def generate_tm(TM_file, out_file, node):
-    TM = np.zeros(shape=(node, node))
-    with open(TM_file, 'r') as readTxt:
-        while True:
-            line = readTxt.readline()
-            if not line:
-                break
-            # line : OD-src OD-dst link-src link-dst link-value
-            line = line.split()
-            OD_src = int(line[0]) - 1
-            OD_dst = int(line[1]) - 1
-            traffic = float(line[2])
-            TM[OD_src][OD_dst] = traffic
-
-    f = open(out_file, 'w')
-    for i in range(node):
-        data = ' '
-        for j in range(node - 1):
-            data += str(TM[i][j])
-            data += ' '
-        data += str(TM[i][node - 1])
-        if not i == node - 1:
-            data += '\n'
-        f.write(data)
+# TM: a TM text file or a (node, node) array, e.g. one TM of a TM archive
+def generate_tm(TM, out_file, node):
+    TM = load_TM(TM, node)
+    write_file(out_file, format_ospf(TM))
 
 
 
+# in_path is a text TM directory or its TM archive, unchanged TMs are not rewritten
 def generate_TMs(in_path, out_path, nodes):
-    if not os.path.exists(out_path):
-        os.makedirs(out_path)
-
-    files = os.listdir(in_path)
-    for file in files:
-        print(file)
-        in_file_name = in_path + file
-        out_file_name = out_path + file
-        generate_tm(in_file_name, out_file_name, nodes)
+    export_runs([(in_path, out_path)], nodes, fmt="ospf")
 
 
 def get_MAE_RMSE(list1, list2, length):
@@ -359,21 +341,8 @@ def write_row_to_csv(data, file_name):
         csvwriter.writerow(data)
 
 
-def get_TM_volume(TM_file):
-    result = 0
-    with open(TM_file, 'r') as reader:
-        while True:
-            line = reader.readline().strip()
-            if not line:
-                break
-
-            if not line == ' ':
-                line = line.split(' ')
-                src = int(line[0]) - 1
-                dst = int(line[1]) - 1
-                value = float(line[2])
-                result += value
-    return result / 1000
+def get_TM_volume(TM):
+    return float(np.sum(load_TM(TM, NODE_NUM))) / 1000
 
 
 # 分析什么情况下，MLU超出阈值
@@ -396,14 +365,13 @@ def analysis_overflow(file_name, threshold, nums):
     origin_TM = []
     LSTM_OD_TM = []
     GRU_OD_TM = []
+    origin_TMs = load_TM_run(Origin_TM, NODE_NUM, "CERNET")
+    LSTM_OD_TMs = load_TM_run(PATH_CERNET + "LSTM_OD_pair/", NODE_NUM, "CERNET")
+    GRU_OD_TMs = load_TM_run(PATH_CERNET + "GRU_OD_pair/", NODE_NUM, "CERNET")
     for i in range(nums):
-        origin_TM_path = Origin_TM + "Origin_" + str(i + 1) + ".txt"
-        LSTM_OD_TM_path = PATH_CERNET + "LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-        GRU_OD_TM_path = PATH_CERNET + "GRU_OD_pair/GRU_OD_pair_" + str(i + 1) + ".txt"
-
-        origin_TM.append(get_TM_volume(origin_TM_path))
-        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TM_path))
-        GRU_OD_TM.append(get_TM_volume(GRU_OD_TM_path))
+        origin_TM.append(get_TM_volume(origin_TMs[i]))
+        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TMs[i]))
+        GRU_OD_TM.append(get_TM_volume(GRU_OD_TMs[i]))
 
     x_axix = []
     for i in range(nums):
@@ -526,8 +494,9 @@ if __name__ == "__main__":
     # in_path_list = [LSTM_OD_pair_TM]
     # # out_path_list = [LSTM_OD_pair_OSPF_TM]
     # out_path_list = [LSTM_OD_pair_HYBRID_TM]
-    # for i in range(len(in_path_list)):
-    #     generate_TMs(in_path_list[i], out_path_list[i], 14)
+    # in_path_list = [LSTM_global_TM, GRU_global_TM]
+    # out_path_list = [LSTM_global_OSPF_TM, GRU_global_OSPF_TM]
+    # export_runs(list(zip(in_path_list, out_path_list)), 14, fmt="ospf")
 
 
     # get bias and MAE of MLU' and MLU
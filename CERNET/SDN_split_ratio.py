@@ -7,7 +7,9 @@ import math
 import networkx as nx
 import pandas as pd
 import matplotlib.pyplot as plt
+from common.tm_archive import load_TM, load_TM_run
 
+NODE_NUM = 14
 CAPA = 45000
 PATH_CERNET = "../TM_result/CERNET/"
 STRATEGY_ORIGIN = PATH_CERNET + "split_ratio/Origin/"
@@ -67,24 +69,17 @@ def construct_graph(topo_file):
                 # print(src, dst, capa, weight)
     return G
 
-def get_routing_strategy(TM_file, flow_file):
+# TM: a TM text file or a (NODE_NUM, NODE_NUM) array, e.g. one TM of a TM archive
+def get_routing_strategy(TM, flow_file):
     # get origin TM demand
+    TM = load_TM(TM, NODE_NUM)
     tm_dict = {}  # O-D: traffic
-    with open(TM_file, 'r') as readTxt:
-        while True:
-            line = readTxt.readline()
-            if not line:
-                break
-            # line : OD-src OD-dst link-src link-dst link-value
-            line = line.split()
-            OD_src = int(line[0]) - 1
-            OD_dst = int(line[1]) - 1
-            if OD_src == OD_dst:
-                continue
-            traffic = float(line[2])
-            temp = str(OD_src) + '-' + str(OD_dst)
+    for OD_src, OD_dst in zip(*np.nonzero(TM)):
+        if OD_src == OD_dst:
+            continue
+        temp = str(OD_src) + '-' + str(OD_dst)
 
-            tm_dict[temp] = traffic
+        tm_dict[temp] = float(TM[OD_src][OD_dst])
 
     # calculate strategy based on TM and split flow_file
     link_dict = {}  # OD : {link: ratio}
@@ -201,43 +196,37 @@ def get_routing_strategy(TM_file, flow_file):
 
 
 # route based on strategy
-def routing(G, TM_file, strategy, out_file):
-    # read TM
-    # OD-src OD-dst traffic
-    with open(TM_file, 'r') as readTxt:
-        while True:
-            line = readTxt.readline()
-            if not line:
-                break
-            # line : OD-src OD-dst link-src link-dst link-value
-            line = line.split()
-            OD_src = int(line[0]) - 1
-            OD_dst = int(line[1]) - 1
-            traffic = float(line[2])
-
-            key = str(OD_src) + '-' + str(OD_dst)
-            if key in strategy:
-                for link in strategy[key]:
-                    # print(link)
-                    link_src = int(link.split('-')[0])
-                    link_dst = int(link.split('-')[1])
-                    volume = traffic * float(strategy[key][link])
-                    G[link_src][link_dst]["traffic"] += volume
-
-                '''
-                # route based on strategy
-                full_path_list = nx.all_simple_paths(G, source=OD_src, target=OD_dst)
-                for path in full_path_list:
-                    if str(path) in strategy[key]:
-                        for i in range(len(path) - 1):
-                            G[path[i]][path[i + 1]]["traffic"] += traffic * strategy[key][str(path)]
-                '''
-            else:
-                # continue
-                # route based on shortest path
-                shortest_path = nx.shortest_path(G, source=OD_src, target=OD_dst)
-                for i in range(len(shortest_path) - 1):
-                    G[shortest_path[i]][shortest_path[i + 1]]["traffic"] += traffic
+def routing(G, TM, strategy, out_file):
+    # read TM, a TM text file or a (NODE_NUM, NODE_NUM) array
+    TM = load_TM(TM, NODE_NUM)
+    for OD_src, OD_dst in zip(*np.nonzero(TM)):
+        OD_src = int(OD_src)
+        OD_dst = int(OD_dst)
+        traffic = float(TM[OD_src][OD_dst])
+
+        key = str(OD_src) + '-' + str(OD_dst)
+        if key in strategy:
+            for link in strategy[key]:
+                # print(link)
+                link_src = int(link.split('-')[0])
+                link_dst = int(link.split('-')[1])
+                volume = traffic * float(strategy[key][link])
+                G[link_src][link_dst]["traffic"] += volume
+
+            '''
+            # route based on strategy
+            full_path_list = nx.all_simple_paths(G, source=OD_src, target=OD_dst)
+            for path in full_path_list:
+                if str(path) in strategy[key]:
+                    for i in range(len(path) - 1):
+                        G[path[i]][path[i + 1]]["traffic"] += traffic * strategy[key][str(path)]
+            '''
+        else:
+            # continue
+            # route based on shortest path
+            shortest_path = nx.shortest_path(G, source=OD_src, target=OD_dst)
+            for i in range(len(shortest_path) - 1):
+                G[shortest_path[i]][shortest_path[i + 1]]["traffic"] += traffic
 
 
     sorted_edge = sorted(G.edges(data=True), key=lambda x: x[2]["traffic"], reverse=True)
@@ -464,21 +453,8 @@ def draw_MAE_RMSE(file_name):
     plt.show()
 
 
-def get_TM_volume(TM_file):
-    result = 0
-    with open(TM_file, 'r') as reader:
-        while True:
-            line = reader.readline().strip()
-            if not line:
-                break
-
-            if not line == ' ':
-                line = line.split(' ')
-                src = int(line[0]) - 1
-                dst = int(line[1]) - 1
-                value = float(line[2])
-                result += value
-    return result / 1000
+def get_TM_volume(TM):
+    return float(np.sum(load_TM(TM, NODE_NUM))) / 1000
 
 # 分析什么情况下，MLU超出阈值
 def analysis_overflow(file_name, threshold, nums):
@@ -500,14 +476,13 @@ def analysis_overflow(file_name, threshold, nums):
     origin_TM = []
     LSTM_OD_TM = []
     GRU_OD_TM = []
+    origin_TMs = load_TM_run(Origin_TM, NODE_NUM, "CERNET")
+    LSTM_OD_TMs = load_TM_run(PATH_CERNET + "LSTM_OD_pair/", NODE_NUM, "CERNET")
+    GRU_OD_TMs = load_TM_run(PATH_CERNET + "GRU_OD_pair/", NODE_NUM, "CERNET")
     for i in range(nums):
-        origin_TM_path = Origin_TM + "Origin_" + str(i + 1) + ".txt"
-        LSTM_OD_TM_path = PATH_CERNET + "LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-        GRU_OD_TM_path = PATH_CERNET + "GRU_OD_pair/GRU_OD_pair_" + str(i + 1) + ".txt"
-
-        origin_TM.append(get_TM_volume(origin_TM_path))
-        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TM_path))
-        GRU_OD_TM.append(get_TM_volume(GRU_OD_TM_path))
+        origin_TM.append(get_TM_volume(origin_TMs[i]))
+        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TMs[i]))
+        GRU_OD_TM.append(get_TM_volume(GRU_OD_TMs[i]))
 
     '''
     x_axix = []
@@ -654,18 +629,22 @@ if __name__ == "__main__":
     for i in range(len(strategy_path)):
         result_list.append([])
 
+    # one TM archive per run, converted from the text TMs on first use
+    strategy_TMs = []
+    for path in strategy_path:
+        strategy_TMs.append(load_TM_run(PATH_CERNET + path.split("/")[-2] + "/", NODE_NUM, "CERNET"))
+    target_TMs = load_TM_run(Origin_TM, NODE_NUM, "CERNET")
+
     for i in range(nums):
         print("Solving strategy for TM", i + 1)
         count = 0
         for path in strategy_path:
             G = construct_graph("CERNET.txt")
             strategy_file = path + path.split("/")[-2] + '_' + str(i + 1) + ".txt"
-            strategy_tm_file = PATH_CERNET + path.split("/")[-2] + "/" + path.split("/")[-2] + "_" \
-                               + str(i + 1) + ".txt"  # should be predicted TM file
-            target_tm_file = Origin_TM + "Origin_" + str(i + 1) + ".txt"  # should be origin TM file
-            # print(strategy_tm_file, strategy_file, target_tm_file)
-            strategy = get_routing_strategy(strategy_tm_file, strategy_file)
-            MLU = routing(G, target_tm_file, strategy, out_file)
+            strategy_tm = strategy_TMs[count][i]  # should be predicted TM
+            target_tm = target_TMs[i]  # should be origin TM
+            strategy = get_routing_strategy(strategy_tm, strategy_file)
+            MLU = routing(G, target_tm, strategy, out_file)
             result_list[count].append(MLU)
             count += 1
 
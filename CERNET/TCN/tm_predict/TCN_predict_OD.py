@@ -1,3 +1,4 @@
+import os
 import csv
 import torch
 import torchvision
@@ -12,6 +13,21 @@ from statsmodels.tsa.seasonal import seasonal_decompose
 import math
 import argparse
 from TCN.tm_predict.model import TCN
+from common.od_cache import load_OD_cache
+from common.window import WindowDataset, get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.early_stopping import train_early_stopping, get_validation_len, evaluate, log_report
+from common.warm_start import fit
+from common.parallel_od import map_ODs, THREADS
+from common.checkpoint import save_model, is_done, mark_done, get_checkpoint_name, get_prediction_name, \
+    save_predictions, load_predictions
+from common.sweep import get_configs, get_config_name, get_sweep_ODs, successive_halving, hyperband, save_ranking, \
+    get_run_path, remove_checkpoints, MIN_EPOCH
+from common.tcn_stream import get_level_receptive_fields
+from common.tcn_sizing import get_latency
+from common.device import get_device
 
 parser = argparse.ArgumentParser(description='Sequence Modeling - (Permuted) Sequential MNIST')
 parser.add_argument('--batch_size', type=int, default=1, metavar='N',
@@ -45,73 +61,62 @@ args = parser.parse_args()
 
 BATCH_SIZE = 50
 
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+
+# hyperparameter sweep: the values tried by sweep(), levels and nhid make up the channel_sizes
+SWEEP_SPACE = {"k": [10, 20], "levels": [4, 8], "nhid": [25, 50], "kernel_size": [3, 7], "LR": [0.002, 0.065]}
+
 class PridictTM():
-    def __init__(self, file_name, k, input_size, output_size, channel_sizes, kernel_size, dropout, LR, epoch):
+    def __init__(self, file_name, k, input_size, output_size, channel_sizes, kernel_size, dropout, LR, epoch,
+                 trim=False):
         # super(PridictTM, self).__init__()
         self.file_name = file_name
         self.k = k
         self.epoch = epoch
         self.LR = LR
         self.input_size = input_size
-        self.model = TCN(input_size, output_size, channel_sizes, kernel_size=kernel_size, dropout=dropout, k=self.k)
-        # self.rnn.cuda()
+        self.output_size = output_size
+        self.channel_sizes = channel_sizes
+        self.kernel_size = kernel_size
+        self.dropout = dropout
+        # drop the TCN levels after the receptive field covers the window of k steps
+        self.trim = trim
+        self.model = TCN(input_size, output_size, channel_sizes, kernel_size=kernel_size, dropout=dropout, k=self.k,
+                         trim=trim)
+        # self.rnn.to(DEVICE)
         # print(self.model)
-        self.model.cuda()
+        self.model.to(DEVICE)
 
     def get_OD_list(self, file_name):
-        df = pd.read_csv(file_name)
-        OD_list = df.columns.values.tolist()
-        del OD_list[0]
+        OD_list = load_OD_cache(file_name).get_OD_list()
 
         return OD_list
 
     def read_data(self, file_name, OD):
-        df = pd.read_csv(file_name)
-        data = np.array(df[OD])
-
-        # min-max normalization
-
-        max_value = np.max(data)
-        min_value = np.min(data)
-        if not (max_value == 0 and min_value == 0):
-            data = (data - min_value) / (max_value - min_value)
-        '''
+        data = np.array(load_OD_cache(file_name).get_OD(OD))
 
-        # z-score
-        
-        u = np.average(data)
-        sigma = np.std(data)
-        for i in range(len(data)):
-            data[i] = (data[i] - u) / sigma
-        '''
-        return data, max_value, min_value
+        # min-max normalization fitted on the training span, Normalizer("z-score") for z-score
+        train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+        normalizer = Normalizer("min-max").fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, normalizer
 
 
     # generate normalized time series data
     # list of ([x1, x2, ..., xk], [xk+1])
     # using first k data to predict the k+1 data
     def generate_series(self, data, k):
-        x_data = []
-        y_data = []
-        length = len(data)
-        for i in range(length - k):
-            x = data[i:i+k]
-            y = data[i+k]
-            x_data.append(x)
-            y_data.append(y)
-        x_data = torch.from_numpy(np.array(x_data)).float()
-        y_data = torch.from_numpy(np.array(y_data)).float()
-
-        return x_data, y_data
+        series = WindowDataset(data, k)
+        return series.x_data, series.y_data
 
     # generate batch data
     def generate_batch_loader(self, x_data, y_data):
         torch_dataset = Data.TensorDataset(x_data, y_data)
-        loader = Data.DataLoader(
+        loader = BatchLoader(
             dataset=torch_dataset,      # torch TensorDataset format
             batch_size=BATCH_SIZE,      # mini batch size
             shuffle=True,               # random order data
-            num_workers=2,              # multiple threading to read data
         )
         return loader
 
@@ -123,29 +128,151 @@ class PridictTM():
 
     # save TM result
     def save_TM(self, result_list):
-        test_data_length = len(result_list[0])
         size = int(math.sqrt(len(result_list)))
-        for i in range(test_data_length):
-            print("Save TM for data " + str(i))
-            file_name = "../../../TM_result/GEANT/\LSTM_OD_pair/\LSTM_OD_pair_" + str(i + 1) + ".txt"
-            TM = np.zeros(shape=(size, size))
-            row = -1
-            column = 0
-            for j in range(len(result_list)):
-                if j % 23 == 0:
-                    row += 1
-                    column = 0
-                TM[row][column] = result_list[j][i]
-                column += 1
-
-            f = open(file_name, 'w')
-            for w in range(size):
-                for k in range(size):
-                    if not TM[w][k] == 0.0:
-                        temp = str(w + 1) + ' ' + str(k + 1) + ' ' + str(TM[w][k]) + "\n"
-                        f.write(temp)
-            f.close()
-
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../../../TM_result/CERNET/TCN_OD_pair.tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model="TCN_OD_pair", topology="CERNET") as writer:
+            writer.extend(TMs, times)
+
+
+    # train (unless it is marked done) and test one OD on the CPU, returns the predicted traffic
+    # of the test span, run by train_parallel in a worker process
+    def train_OD(self, OD):
+        model_name = "../../../CERNET/model_TCN_OD/TCN_" + OD + ".pkl"
+        data, normalizer = self.read_data(self.file_name, OD)
+        x_data, y_data = self.generate_series(data, self.k)
+        train_len = get_train_len(len(x_data), BATCH_SIZE)
+        if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+            return [0] * (len(x_data) - train_len)
+
+        # finished by an earlier run
+        predictions = load_predictions(get_prediction_name(model_name))
+        if predictions is not None:
+            return predictions
+
+        self.model = TCN(self.input_size, self.output_size, self.channel_sizes, kernel_size=self.kernel_size,
+                         dropout=self.dropout, k=self.k, trim=self.trim)
+        # trained by an earlier run, an interrupted OD continues from its last checkpoint
+        if is_done(model_name):
+            self.model.load_state_dict(torch.load(model_name, map_location="cpu"))
+            normalizer = load_normalizer(get_normalizer_name(model_name), normalizer)
+        else:
+            # the last val_len training windows are held out for early stopping
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            validation = [(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])]
+            data_loader = self.generate_batch_loader(x_data[:train_len - val_len], y_data[:train_len - val_len])
+            optimizer = torch.optim.Adagrad(self.model.parameters(), lr=self.LR)
+            loss_func = nn.MSELoss()
+            # TCN input shape: (batch_size, in_channels, seq_length)
+            report = train_early_stopping(self.model, data_loader, validation, self.epoch, optimizer, loss_func,
+                                          forward=lambda x: self.model(x.reshape(x.shape[0], -1, self.k)),
+                                          device="cpu", checkpoint=get_checkpoint_name(model_name))
+            log_report(OD, report, os.path.join(os.path.dirname(model_name), "early_stopping.csv"))
+            save_model(self.model.state_dict(), model_name)
+            normalizer.save(get_normalizer_name(model_name))
+            mark_done(model_name, report)
+
+        # the whole test span as one batch, weight_norm baked in, see common/tcn_fold.py
+        with torch.no_grad():
+            predictions = self.model.fold().forward(x_data[train_len:].reshape(-1, self.input_size, self.k))
+        # negative outputs are flipped, then the whole test span is scaled back
+        predictions = list(normalizer.inverse_transform(predictions.reshape(-1).numpy(), absolute=True))
+        # written at once, a restarted run does not predict this OD again
+        save_predictions(predictions, get_prediction_name(model_name))
+        return predictions
+
+    # train_OD for every OD on a pool of processes, THREADS torch threads each, see common/parallel_od.py
+    def train_parallel(self, workers=None):
+        OD_list = self.get_OD_list(self.file_name)
+        result_list = map_ODs(self.train_OD, OD_list, workers, THREADS)
+        self.save_TM(result_list)
+
+    # validation and test loss of the arguments config trained for epoch epochs on ODs, one trial
+    # of sweep(), the checkpoints of the trial name let its next rung continue the training
+    def sweep_trial(self, ODs, model_path, config, epoch, name):
+        args = {"k": self.k, "levels": len(self.channel_sizes), "nhid": self.channel_sizes[-1],
+                "kernel_size": self.kernel_size, "LR": self.LR, "trim": self.trim}
+        args.update(config)
+        model = PridictTM(self.file_name, args["k"], self.input_size, self.output_size,
+                          [args["nhid"]] * args["levels"], args["kernel_size"], self.dropout, args["LR"], epoch,
+                          args["trim"])
+        # TCN input shape: (batch_size, in_channels, seq_length)
+        forward = lambda x: model.model(x.reshape(x.shape[0], -1, model.k))
+        losses = []
+        test_losses = []
+        epochs = 0
+        train_time = 0
+        for OD in ODs:
+            data, normalizer = model.read_data(self.file_name, OD)
+            x_data, y_data = model.generate_series(data, model.k)
+            train_len = get_train_len(len(x_data), BATCH_SIZE)
+            val_len = get_validation_len(train_len, BATCH_SIZE)
+            train_set = Data.TensorDataset(x_data[:train_len - val_len], y_data[:train_len - val_len])
+            validation_set = Data.TensorDataset(x_data[train_len - val_len:train_len], y_data[train_len - val_len:train_len])
+            model.model = TCN(model.input_size, model.output_size, model.channel_sizes, kernel_size=model.kernel_size,
+                              dropout=model.dropout, k=model.k, trim=model.trim)
+            report = fit(model.model, train_set, validation_set, epoch, model.LR, BATCH_SIZE, forward, device="cpu",
+                         checkpoint=model_path + name + "/TCN_" + OD + ".ckpt", checkpoint_every=1)
+            losses.append(report["validation_loss"])
+            test_losses.append(evaluate(model.model, forward, [(x_data[train_len:], y_data[train_len:])],
+                                        nn.MSELoss(), "cpu"))
+            epochs = max(epochs, report["epochs"])
+            train_time += report["time"]
+        return {"loss": float(np.mean(losses)), "test_loss": float(np.mean(test_losses)), "epochs": epochs,
+                "time": train_time}
+
+    # hyperparameter sweep over k, the levels, nhid and kernel_size of the TCN and LR, see
+    # common/sweep.py, as sweep() of the RNN scripts, the ranking is written to sweep.csv
+    def sweep(self, space=None, use_hyperband=False, workers=None):
+        model_path = "../../../CERNET/model_TCN-sweep_OD/"
+        if space is None:
+            space = SWEEP_SPACE
+        ODs = get_sweep_ODs(self.get_OD_list(self.file_name))
+        # the trials resume between the rungs of this sweep only, their checkpoints go to a new run directory
+        run_path = get_run_path(model_path)
+        trial = lambda config, epoch, name: self.sweep_trial(ODs, run_path, config, epoch, name)
+        if use_hyperband:
+            results = hyperband(trial, space, MIN_EPOCH, self.epoch, workers=workers, threads=THREADS,
+                                path=run_path)
+        else:
+            results = successive_halving(trial, get_configs(space), MIN_EPOCH, self.epoch, workers=workers,
+                                         threads=THREADS, path=run_path)
+        remove_checkpoints(run_path)
+        save_ranking(results, model_path + "sweep.csv")
+
+    # the TCN trimmed to the levels up to the one whose receptive field covers the window of k
+    # steps against the whole TCN: validation and test loss on the ODs of sweep(), trained as a
+    # trial of it, and the latency of the folded model for one window, written to trim.csv
+    def benchmark_trim(self):
+        model_path = "../../../CERNET/model_TCN-trim_OD/"
+        ODs = get_sweep_ODs(self.get_OD_list(self.file_name))
+        test_x = torch.rand(1, self.input_size, self.k)
+        # the trials are trained from scratch in a new run directory, see common/sweep.py
+        run_path = get_run_path(model_path)
+        rows = []
+        for trim in [False, True]:
+            config = {"trim": trim}
+            result = self.sweep_trial(ODs, run_path, config, self.epoch, get_config_name(config))
+            model = TCN(self.input_size, self.output_size, self.channel_sizes, kernel_size=self.kernel_size,
+                        dropout=self.dropout, k=self.k, trim=trim)
+            fields = get_level_receptive_fields(model.tcn)
+            latency = get_latency(model.fold(), test_x)
+            rows.append([trim, len(fields), fields[-1], result["loss"], result["test_loss"], result["time"], latency])
+            print("trim:", trim, ", levels:", len(fields), ", receptive field:", fields[-1], ", validation loss:",
+                  result["loss"], ", test loss:", result["test_loss"], ", latency:", latency)
+        remove_checkpoints(run_path)
+
+        if not os.path.exists(model_path):
+            os.makedirs(model_path, exist_ok=True)
+        with open(model_path + "trim.csv", 'w', newline="") as datacsv:
+            csvwriter = csv.writer(datacsv, dialect=("excel"))
+            csvwriter.writerow(["trim", "levels", "receptive_field", "validation_loss", "test_loss", "time", "latency"])
+            csvwriter.writerows(rows)
+        return rows
 
     def train(self):
         # OD_list = self.get_OD_list(self.file_name)
@@ -158,7 +285,7 @@ class PridictTM():
         for OD in OD_list:
             print("Training for ", OD)
             # print(OD_list)
-            data, max_value, min_value = self.read_data(self.file_name, OD)
+            data, normalizer = self.read_data(self.file_name, OD)
             x_data, y_data = self.generate_series(data, self.k)
             train_len = int(int(len(x_data) * 0.8) / 50) * 50
             data_loader = self.generate_batch_loader(x_data[:train_len], y_data[:train_len])
@@ -185,12 +312,11 @@ class PridictTM():
                     # TCN input shape: (batch_size, in_channels, seq_length)
                     batch_x = batch_x.reshape(BATCH_SIZE, -1, self.k)
                     batch_y = batch_y.reshape(BATCH_SIZE, -1)
-                    batch_x = batch_x.cuda()
-                    batch_y = batch_y.cuda()
+                    batch_x = batch_x.to(DEVICE)
+                    batch_y = batch_y.to(DEVICE)
                     # print("batch_x.shape:", batch_x.shape)
                     # print("batch_y.shape:", batch_y.shape)
                     prediction = self.model.forward(batch_x)
-                    prediction = prediction.cuda()
                     # print("prediction.shape:", prediction.shape)
                     loss = loss_func(prediction, batch_y)
                     optimizer.zero_grad()
@@ -204,11 +330,14 @@ class PridictTM():
 
             ################################## test #################################
             # load model
-            # self.rnn.load_state_dict(torch.load(model_name))
+            # self.rnn.load_state_dict(torch.load(model_name, map_location=DEVICE))
+            # weight_norm baked in, causal padding and no Chomp1d copies, see common/tcn_fold.py
+            test_model = self.model.fold()
+            predictions = []
             for i in range(train_len, len(x_data)):
-                test_x = x_data[i].reshape(1, -1, self.k).cuda()
-                test_y = y_data[i].cuda()
-                prediction = self.model.forward(test_x).reshape(1).cuda()
+                test_x = x_data[i].reshape(1, -1, self.k).to(DEVICE)
+                test_y = y_data[i].to(DEVICE)
+                prediction = test_model.forward(test_x).reshape(1)
                 loss = loss_func(prediction, test_y)
                 print("loss for data", i, ":", loss)
                 data = []
@@ -216,9 +345,9 @@ class PridictTM():
                 self.write_row_to_csv(data, "TCN_OD1-2_loss.csv")
 
                 prediction_value = prediction.cpu().data.numpy()[0]
-                if prediction_value < 0:
-                    prediction_value = -prediction_value
-                result_list[count].append(prediction_value * (max_value - min_value) + min_value)
+                predictions.append(prediction_value)
+            # negative outputs are flipped, then the whole test span is scaled back
+            result_list[count].extend(normalizer.inverse_transform(predictions, absolute=True))
             ################################## test #################################
 
             count += 1
@@ -236,7 +365,6 @@ if __name__ == "__main__":
 
     # best paramaters: hidden_size = 100, LR = 0.065
     BATCH_SIZE = 50
-    USE_CUDA = True
     dropout = 0.05
     clip = -1
     epochs = 50
@@ -253,6 +381,9 @@ if __name__ == "__main__":
 
     predict_tm_model = PridictTM(file_name, k, input_size, output_size, channel_sizes, kernel_size, dropout, lr, epochs)
     predict_tm_model.train()
+    # predict_tm_model.train_parallel()
+    # predict_tm_model.sweep()
+    # predict_tm_model.benchmark_trim()
 
     # for i in range(658):
     #     row = -1
@@ -1,22 +1,28 @@
+import copy
 import torch
 import torch.nn.functional as F
 from torch import nn
 from CERNET.TCN.tcn import TemporalConvNet
+from common.tcn_fold import fold_tcn
+from common.tcn_sizing import fit_window
 
 
 class TCN(nn.Module):
-    def __init__(self, input_size, output_size, num_channels, kernel_size, dropout, k):
+    def __init__(self, input_size, output_size, num_channels, kernel_size, dropout, k, trim=False):
         super(TCN, self).__init__()
         # self.dense = nn.Linear(input_size * k, int(input_size / 2) * k)
         self.tcn = TemporalConvNet(input_size, num_channels, kernel_size=kernel_size, dropout=dropout)
-        self.linear = nn.Linear(num_channels[-1], output_size)
+        # warns on the levels after the receptive field covers the window of k steps, trim drops
+        # them, see common/tcn_sizing.py
+        levels = fit_window(self.tcn, k, trim)
+        self.linear = nn.Linear(num_channels[levels - 1], output_size)
         self.sigmoid = nn.Sigmoid()
 
     def sparse(self, inputs):
         batch_size = inputs.shape[0]
         seq_length = inputs.shape[2]
-        new_inputs = torch.Tensor([]).cuda()
-        # new_inputs = torch.Tensor([])
+        # empty, on the device of inputs
+        new_inputs = inputs.new_zeros(0, seq_length)
         # print("new_inputs.shape", new_inputs.shape)
 
         for i in range(batch_size):
@@ -37,4 +43,22 @@ class TCN(nn.Module):
         y1 = self.tcn(inputs)  # input should have dimension (N, C, L)
         out = self.linear(y1[:, :, -1])
         out = self.sigmoid(out)
+        return out
+
+    def fold(self):
+        """A copy for inference with the TemporalConvNet folded, same outputs as self in eval
+        mode, see common/tcn_fold.py"""
+        # no deepcopy of self, the weight_norm weights are not graph leaves
+        model = TCN.__new__(TCN)
+        nn.Module.__init__(model)
+        model.tcn = fold_tcn(self.tcn)
+        model.linear = copy.deepcopy(self.linear)
+        model.sigmoid = nn.Sigmoid()
+        return model.to(self.linear.weight.device).eval()
+
+    def forward_step(self, stream, inputs):
+        """The output of forward from the newest input column (N, C_in) only, stream is a
+        StreamingTCN of self.tcn holding the steps before, see common/tcn_stream.py"""
+        out = self.linear(stream.step(inputs))
+        out = self.sigmoid(out)
         return out
\ No newline at end of file
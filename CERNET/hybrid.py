@@ -7,7 +7,9 @@ import math
 import networkx as nx
 import pandas as pd
 import matplotlib.pyplot as plt
+from common.tm_archive import load_TM, load_TM_run
 
+NODE_NUM = 14
 CAPA = 26000
 PATH_CERNET = "../TM_result/CERNET/"
 Origin_TM = PATH_CERNET + "Origin/"
@@ -206,21 +208,8 @@ def write_row_to_csv(data, file_name):
 
 
 
-def get_TM_volume(TM_file):
-    result = 0
-    with open(TM_file, 'r') as reader:
-        while True:
-            line = reader.readline().strip()
-            if not line:
-                break
-
-            if not line == ' ':
-                line = line.split(' ')
-                src = int(line[0]) - 1
-                dst = int(line[1]) - 1
-                value = float(line[2])
-                result += value
-    return result / 1000
+def get_TM_volume(TM):
+    return float(np.sum(load_TM(TM, NODE_NUM))) / 1000
 
 # 分析什么情况下，MLU超出阈值
 def analysis_overflow(file_name, threshold, nums):
@@ -242,14 +231,13 @@ def analysis_overflow(file_name, threshold, nums):
     origin_TM = []
     LSTM_OD_TM = []
     GRU_OD_TM = []
+    origin_TMs = load_TM_run(Origin_TM, NODE_NUM, "CERNET")
+    LSTM_OD_TMs = load_TM_run(PATH_CERNET + "LSTM_OD_pair/", NODE_NUM, "CERNET")
+    GRU_OD_TMs = load_TM_run(PATH_CERNET + "GRU_OD_pair/", NODE_NUM, "CERNET")
     for i in range(nums):
-        origin_TM_path = Origin_TM + "Origin_" + str(i + 1) + ".txt"
-        LSTM_OD_TM_path = PATH_CERNET + "LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-        GRU_OD_TM_path = PATH_CERNET + "GRU_OD_pair/GRU_OD_pair_" + str(i + 1) + ".txt"
-
-        origin_TM.append(get_TM_volume(origin_TM_path))
-        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TM_path))
-        GRU_OD_TM.append(get_TM_volume(GRU_OD_TM_path))
+        origin_TM.append(get_TM_volume(origin_TMs[i]))
+        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TMs[i]))
+        GRU_OD_TM.append(get_TM_volume(GRU_OD_TMs[i]))
 
 
     x_axix = []
@@ -7,7 +7,10 @@ import math
 import networkx as nx
 import matplotlib.pyplot as plt
 import pandas as pd
+from common.tm_archive import load_TM, load_TM_run
+from common.te_export import format_ospf, write_file, export_runs
 
+NODE_NUM = 23
 CAPA = 9920000
 PATH_GEANT = "../TM_result/GEANT/"
 
@@ -41,6 +44,8 @@ GRU_EKM_KEC_25_TM = PATH_GEANT + "GRU_EKM_KEC_25/"
 GRU_EKM_KEC_53_TM = PATH_GEANT + "GRU_EKM_KEC_53/"
 GRU_EKM_KEC_106_TM = PATH_GEANT + "GRU_EKM_KEC_106/"
 GRU_EKM_KEC_159_TM = PATH_GEANT + "GRU_EKM_KEC_159/"
+LSTM_global_TM = PATH_GEANT + "LSTM-global_OD_pair/"
+GRU_global_TM = PATH_GEANT + "GRU-global_OD_pair/"
 
 
 Origin_OSPF_TM = PATH_OSPF_GEANT + "Origin/"
@@ -68,6 +73,8 @@ GRU_EKM_KEC_25_OSPF_TM = PATH_OSPF_GEANT + "GRU_EKM_KEC_25/"
 GRU_EKM_KEC_53_OSPF_TM = PATH_OSPF_GEANT + "GRU_EKM_KEC_53/"
 GRU_EKM_KEC_106_OSPF_TM = PATH_OSPF_GEANT + "GRU_EKM_KEC_106/"
 GRU_EKM_KEC_159_OSPF_TM = PATH_OSPF_GEANT + "GRU_EKM_KEC_159/"
+LSTM_global_OSPF_TM = PATH_OSPF_GEANT + "LSTM-global_OD_pair/"
+GRU_global_OSPF_TM = PATH_OSPF_GEANT + "GRU-global_OD_pair/"
 
 
 Origin_HYBRID_TM = PATH_HYBRID_GEANT + "Origin/"
@@ -96,6 +103,8 @@ GRU_EKM_KEC_25_HYBRID_TM = PATH_HYBRID_GEANT + "GRU_EKM_KEC_25/"
 GRU_EKM_KEC_53_HYBRID_TM = PATH_HYBRID_GEANT + "GRU_EKM_KEC_53/"
 GRU_EKM_KEC_106_HYBRID_TM = PATH_HYBRID_GEANT + "GRU_EKM_KEC_106/"
 GRU_EKM_KEC_159_HYBRID_TM = PATH_HYBRID_GEANT + "GRU_EKM_KEC_159/"
+LSTM_global_HYBRID_TM = PATH_HYBRID_GEANT + "LSTM-global_OD_pair/"
+GRU_global_HYBRID_TM = PATH_HYBRID_GEANT + "GRU-global_OD_pair/"
 
 
 def generate_topo(topo_file, out_file):
@@ -119,43 +128,16 @@ def generate_topo(topo_file, out_file):
                 weight = int(line[3])
                 f.write("LINK: " + str(src) + ' ' + str(dst) + ' ' + "CC 1\n")
 
-def generate_tm(TM_file, out_file, node):
-    TM = np.zeros(shape=(node, node))
-    with open(TM_file, 'r') as readTxt:
-        while True:
-            line = readTxt.readline()
-            if not line:
-                break
-            # line : OD-src OD-dst link-src link-dst link-value
-            line = line.split()
-            OD_src = int(line[0]) - 1
-            OD_dst = int(line[1]) - 1
-            traffic = float(line[2])
-            TM[OD_src][OD_dst] = traffic
-
-    f = open(out_file, 'w')
-    for i in range(node):
-        data = ' '
-        for j in range(node - 1):
-            data += str(TM[i][j])
-            data += ' '
-        data += str(TM[i][node - 1])
-        if not i == node - 1:
-            data += '\n'
-        f.write(data)
+# TM: a TM text file or a (node, node) array, e.g. one TM of a TM archive
+def generate_tm(TM, out_file, node):
+    TM = load_TM(TM, node)
+    write_file(out_file, format_ospf(TM))
 
 
 
+# in_path is a text TM directory or its TM archive, unchanged TMs are not rewritten
 def generate_TMs(in_path, out_path, nodes):
-    if not os.path.exists(out_path):
-        os.makedirs(out_path)
-
-    files = os.listdir(in_path)
-    for file in files:
-        print(file)
-        in_file_name = in_path + file
-        out_file_name = out_path + file
-        generate_tm(in_file_name, out_file_name, nodes)
+    export_runs([(in_path, out_path)], nodes, fmt="ospf")
 
 
 def get_MAE_RMSE(list1, list2, length):
@@ -360,21 +342,8 @@ def write_row_to_csv(data, file_name):
         csvwriter = csv.writer(datacsv, dialect=("excel"))
         csvwriter.writerow(data)
 
-def get_TM_volume(TM_file):
-    result = 0
-    with open(TM_file, 'r') as reader:
-        while True:
-            line = reader.readline().strip()
-            if not line:
-                break
-
-            if not line == ' ':
-                line = line.split(' ')
-                src = int(line[0]) - 1
-                dst = int(line[1]) - 1
-                value = float(line[2])
-                result += value
-    return result / 1000
+def get_TM_volume(TM):
+    return float(np.sum(load_TM(TM, NODE_NUM))) / 1000
 
 # 分析什么情况下，MLU超出阈值
 def analysis_overflow(file_name, threshold, nums):
@@ -398,14 +367,13 @@ def analysis_overflow(file_name, threshold, nums):
     origin_TM = []
     LSTM_OD_TM = []
     GRU_OD_TM = []
+    origin_TMs = load_TM_run(Origin_TM, NODE_NUM, "GEANT")
+    LSTM_OD_TMs = load_TM_run(PATH_GEANT + "LSTM_OD_pair/", NODE_NUM, "GEANT")
+    GRU_OD_TMs = load_TM_run(PATH_GEANT + "GRU_OD_pair/", NODE_NUM, "GEANT")
     for i in range(nums):
-        origin_TM_path = Origin_TM + "Origin_" + str(i + 1) + ".txt"
-        LSTM_OD_TM_path = PATH_GEANT + "LSTM_OD_pair/LSTM_OD_pair_" + str(i + 1) + ".txt"
-        GRU_OD_TM_path = PATH_GEANT + "GRU_OD_pair/GRU_OD_pair_" + str(i + 1) + ".txt"
-
-        origin_TM.append(get_TM_volume(origin_TM_path))
-        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TM_path))
-        GRU_OD_TM.append(get_TM_volume(GRU_OD_TM_path))
+        origin_TM.append(get_TM_volume(origin_TMs[i]))
+        LSTM_OD_TM.append(get_TM_volume(LSTM_OD_TMs[i]))
+        GRU_OD_TM.append(get_TM_volume(GRU_OD_TMs[i]))
 
 
     x_axix = []
@@ -540,8 +508,9 @@ if __name__ == "__main__":
     # in_path_list = [LSTM_OD_pair_TM]
     # # out_path_list = [LSTM_OD_pair_OSPF_TM]
     # out_path_list = [LSTM_OD_pair_HYBRID_TM]
-    # for i in range(len(in_path_list)):
-    #     generate_TMs(in_path_list[i], out_path_list[i], 23)
+    # in_path_list = [LSTM_global_TM, GRU_global_TM]
+    # out_path_list = [LSTM_global_OSPF_TM, GRU_global_OSPF_TM]
+    # export_runs(list(zip(in_path_list, out_path_list)), 23, fmt="ospf")
 
 
     # get bias and MAE of MLU' and MLU
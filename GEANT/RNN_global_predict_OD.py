@@ -0,0 +1,259 @@
+import csv
+import torch
+import torch.nn as nn
+import numpy as np
+import math
+import os
+import time
+from common.od_cache import load_OD_cache
+from common.window import get_train_len
+from common.batch_loader import BatchLoader
+from common.tm_archive import TMArchiveWriter
+from common.normalizer import Normalizer, get_normalizer_name, load_normalizer
+from common.checkpoint import save_model
+from common.early_stopping import train_early_stopping, get_validation_len, log_report
+from common.global_od import ODWindowDataset, predict
+from common.device import get_device
+
+# the train / test split in time windows, the same test span as the per-OD models
+BATCH_SIZE = 50
+
+# windows of all ODs per mini batch
+OD_BATCH_SIZE = 1024
+
+# time steps predicted per forward at test time, every one is a batch of all the ODs
+TEST_STEPS = 288
+
+# cpu or cuda, $TM_DEVICE overrides the default, see common/device.py
+DEVICE = get_device()
+
+class ODEmbedRNN(nn.Module):
+    '''
+    one RNN shared by every OD pair, conditioned on a learned OD pair embedding
+    the OD embedding is appended to the traffic of every time step and, as in EmbedRNN,
+    to the last hidden state together with the hour and week_day embeddings
+    :param OD_num: the number of OD pairs, the OD column of the input is their index
+    :param OD_embed_dim: the dimension of OD pair embedding
+    :param hour_embed_dim: the dimension of hour data embedding
+    :param week_day_embed_dim: the dimension of week_day data embedding
+    :param rnn_hidden_size: the hidden size of the RNN
+    :param rnn_num_layers: the number of hidden layers of the RNN
+    :param k: window length
+    :param cell: "LSTM" or "GRU"
+    '''
+    def __init__(self, OD_num, OD_embed_dim, hour_embed_dim, week_day_embed_dim,
+                 rnn_hidden_size, rnn_num_layers, k, cell="LSTM"):
+        super(ODEmbedRNN, self).__init__()
+
+        self.time_step = k
+
+        # OD pair, hour and week_day information embedding
+        self.OD_embeds = nn.Embedding(OD_num, OD_embed_dim)
+        self.hour_embeds = nn.Embedding(24, hour_embed_dim)
+        self.week_day_embeds = nn.Embedding(7, week_day_embed_dim)
+
+        # RNN model
+        rnn = nn.LSTM if cell == "LSTM" else nn.GRU
+        self.rnn = rnn(
+            input_size=1 + OD_embed_dim,
+            hidden_size=rnn_hidden_size,
+            num_layers=rnn_num_layers,
+            batch_first=True
+        )
+
+        self.out = nn.Linear(rnn_hidden_size + OD_embed_dim + week_day_embed_dim + hour_embed_dim, 1)
+
+    def forward(self, x):
+        # x shape (batch, k + 3): k traffic values, OD index, week_day and hour
+        x_traffic = x[:, 0:self.time_step].unsqueeze(2)
+        x_OD_embed = self.OD_embeds(x[:, self.time_step].long())
+        x_week_day_embed = self.week_day_embeds(x[:, -2].long())
+        x_hour_embed = self.hour_embeds(x[:, -1].long())
+
+        # the OD embedding is an input of every time step
+        rnn_input = torch.cat((x_traffic, x_OD_embed.unsqueeze(1).expand(-1, self.time_step, -1)), 2)
+        # None represents zero initial hidden state
+        r_out, h_n = self.rnn(rnn_input, None)
+
+        out_input = torch.cat((r_out[:, -1, :], x_OD_embed, x_week_day_embed, x_hour_embed), 1)
+
+        # return the last
+        out = self.out(out_input)
+
+        return out
+
+
+class PridictTM():
+    '''
+    a single global forecaster for every OD pair instead of one model per OD
+    one checkpoint, model_<cell>-global/<cell>-global.pkl, with one normalizer per OD saved
+    next to it, and a full TM is predicted with one batched forward over its OD sequences
+    '''
+    def __init__(self, file_name, k, OD_embed_dim, hour_embed_dim, week_day_embed_dim,
+                 rnn_hidden_size, rnn_num_layers, epoch, LR, cell="LSTM"):
+        self.file_name = file_name
+        self.k = k
+        self.epoch = epoch
+        self.LR = LR
+        self.cell = cell
+        self.OD_list = self.get_OD_list(file_name)
+        self.OD_num = len(self.OD_list)
+        self.node_num = int(math.sqrt(self.OD_num))
+
+        self.model = ODEmbedRNN(self.OD_num, OD_embed_dim, hour_embed_dim, week_day_embed_dim,
+                                rnn_hidden_size, rnn_num_layers, k, cell)
+        self.model.to(DEVICE)
+        self.normalizer = None
+        self.model_path = "../GEANT/model_" + cell + "-global/"
+        self.model_name = self.model_path + cell + "-global.pkl"
+        print(self.model)
+
+    def get_OD_list(self, file_name):
+        OD_list = load_OD_cache(file_name).get_OD_list()
+
+        return OD_list
+
+    # every OD column normalized on the training span, with its calendar and the normalizer
+    # normalizer: a saved normalizer to use instead of fitting one
+    def read_data(self, file_name, normalizer=None):
+        cache = load_OD_cache(file_name)
+        data = cache.get_values()
+
+        # min-max normalization of every OD fitted on the training span, Normalizer("z-score", axis=0) for z-score
+        if normalizer is None:
+            train_len = get_train_len(len(data) - self.k, BATCH_SIZE)
+            normalizer = Normalizer("min-max", axis=0).fit(data[:train_len + self.k])
+        data = normalizer.transform(data)
+        return data, cache.get_calendar(), normalizer
+
+    # column indices of the ODs the model is trained on and predicts,
+    # the O = D pairs and the ODs without traffic are predicted as 0
+    def get_ODs(self, normalizer):
+        ODs = []
+        for i in range(self.OD_num):
+            OD = self.OD_list[i]
+            if OD.split('_')[1].split('-')[0] == OD.split('_')[1].split('-')[1]:
+                continue
+            if normalizer.data_max[i] == 0 and normalizer.data_min[i] == 0:
+                continue
+            ODs.append(i)
+        return ODs
+
+    # generate batch data
+    def generate_batch_loader(self, dataset):
+        loader = BatchLoader(
+            dataset=dataset,            # ODWindowDataset format
+            batch_size=OD_BATCH_SIZE,   # mini batch size
+            shuffle=True,               # random order data
+        )
+        return loader
+
+    def write_row_to_csv(self, data, file_name):
+        with open(file_name, 'a+', newline="") as datacsv:
+            csvwriter = csv.writer(datacsv, dialect=("excel"))
+            csvwriter.writerow(data)
+
+    # save TM result
+    def save_TM(self, result_list, model=None):
+        if model is None:
+            model = self.cell + "-global_OD_pair"
+        size = int(math.sqrt(len(result_list)))
+        # result_list[j][i] is the prediction of OD j for test data i
+        TMs = np.array(result_list).T.reshape(-1, size, size)
+        time_data = load_OD_cache(self.file_name).time
+        times = time_data[len(time_data) - TMs.shape[0]:]
+        file_name = "../TM_result/GEANT/" + model + ".tma"
+        print("Save " + str(TMs.shape[0]) + " TMs to " + file_name)
+        with TMArchiveWriter(file_name, size, model=model, topology="GEANT") as writer:
+            writer.extend(TMs, times)
+
+    # the checkpoint and normalizer of train()
+    def load(self):
+        self.model.load_state_dict(torch.load(self.model_name, map_location=DEVICE))
+        self.normalizer = load_normalizer(get_normalizer_name(self.model_name))
+
+    def train(self):
+        data, calendar, normalizer = self.read_data(self.file_name)
+        series = ODWindowDataset(data, calendar, self.k, self.get_ODs(normalizer))
+        train_len = get_train_len(series.get_window_num(), BATCH_SIZE)
+        print("training len:", train_len, ", ODs:", len(series.ODs))
+
+        # the last val_len training windows of every OD are held out for early stopping
+        val_len = get_validation_len(train_len, BATCH_SIZE)
+        train_series, validation_series = series.subset(0, train_len).split(train_len - val_len)
+        data_loader = self.generate_batch_loader(train_series)
+        validation = BatchLoader(validation_series, OD_BATCH_SIZE, shuffle=False)
+
+        optimizer = torch.optim.Adagrad(self.model.parameters(), lr=self.LR)
+        loss_func = nn.MSELoss()
+
+        ################################## train #################################
+        report = train_early_stopping(self.model, data_loader, validation, self.epoch, optimizer, loss_func,
+                                      device=DEVICE)
+        log_report(self.cell + "-global", report, self.model_path + "early_stopping.csv")
+        ################################## train #################################
+        # save model
+        save_model(self.model.state_dict(), self.model_name)
+        normalizer.save(get_normalizer_name(self.model_name))
+        self.normalizer = normalizer
+
+        self.test()
+
+    # predict the test span TEST_STEPS TMs at a time and save it like the per-OD models
+    def test(self):
+        if self.normalizer is None:
+            self.load()
+        data, calendar, normalizer = self.read_data(self.file_name, self.normalizer)
+        series = ODWindowDataset(data, calendar, self.k)
+        train_len = get_train_len(series.get_window_num(), BATCH_SIZE)
+
+        star_time = time.time()
+        predictions = predict(self.model, series.subset(train_len), TEST_STEPS * self.OD_num, DEVICE)
+        end_time = time.time()
+        print((end_time - star_time) / (series.get_window_num() - train_len))
+
+        # negative outputs are flipped, then every OD is scaled back
+        TMs = self.normalizer.inverse_transform(predictions.reshape(-1, self.OD_num), absolute=True)
+        mask = np.zeros(self.OD_num, dtype=bool)
+        mask[self.get_ODs(self.normalizer)] = True
+        TMs[:, ~mask] = 0
+        self.save_TM(TMs.T.tolist())
+
+    # the TM of the next time step from the TMs of the last k, one batched forward
+    # over the OD_num sequences, week_day and hour are those of the predicted step
+    # TMs: (k, node_num, node_num) traffic, returns the (node_num, node_num) prediction
+    def predict_TM(self, TMs, week_day, hour):
+        if self.normalizer is None:
+            self.load()
+        traffic = self.normalizer.transform(np.asarray(TMs).reshape(self.k, self.OD_num)).T
+        x = np.concatenate((traffic, np.arange(self.OD_num).reshape(-1, 1),
+                            np.full((self.OD_num, 1), week_day), np.full((self.OD_num, 1), hour)), 1)
+        self.model.eval()
+        with torch.no_grad():
+            prediction = self.model(torch.from_numpy(x).float().to(DEVICE)).reshape(-1).cpu().numpy()
+        self.model.train()
+
+        TM = self.normalizer.inverse_transform(prediction, absolute=True)
+        mask = np.zeros(self.OD_num, dtype=bool)
+        mask[self.get_ODs(self.normalizer)] = True
+        TM[~mask] = 0
+        return TM.reshape(self.node_num, self.node_num)
+
+
+if __name__ == "__main__":
+    file_name = "../OD_pair/GEANT-OD_pair_2005-07-26.csv"
+
+    k = 10
+    OD_embed_dim = 16
+    week_day_embed_dim = 100
+    hour_embed_dim = 100
+    rnn_hidden_size = 200
+    rnn_num_layers = 1
+    epoch = 100
+    LR = 0.01
+
+    # cell = "GRU" for the GRU family
+    predict_tm_model = PridictTM(file_name, k, OD_embed_dim, hour_embed_dim, week_day_embed_dim,
+                                 rnn_hidden_size, rnn_num_layers, epoch, LR, cell="LSTM")
+    predict_tm_model.train()
+    # predict_tm_model.test()
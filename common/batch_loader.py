@@ -0,0 +1,103 @@
+import threading
+import queue
+import torch
+import torch.utils.data as Data
+
+
+_END = object()
+
+
+# gather the next batches in a thread while the current one is trained on,
+# index_select releases the GIL so both really run at the same time
+# batches: generator of batches, prefetch: number of batches gathered ahead
+def prefetch_batches(batches, prefetch):
+    batch_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BatchLoader():
+    '''
+    shuffled mini batches gathered in-process from tensors that are already in memory
+    replaces Data.DataLoader(dataset, shuffle=True, num_workers=2), which spawns worker
+    processes every epoch just to index a TensorDataset
+    :param dataset: Data.TensorDataset, or a dataset indexable by a LongTensor (WindowDataset)
+    :param batch_size: mini batch size
+    :param shuffle: random order data
+    :param drop_last: drop the last incomplete batch
+    :param prefetch: number of batches gathered ahead by a background thread, 0 disables it
+    :param generator: torch.Generator of the shuffled order, None for the global one
+    '''
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, prefetch=0, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.generator = generator
+
+        if isinstance(dataset, Data.TensorDataset):
+            self.tensors = dataset.tensors
+        else:
+            self.tensors = None
+
+    def __len__(self):
+        n = len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def gather(self, index):
+        if self.tensors is not None:
+            return tuple(tensor[index] for tensor in self.tensors)
+        return self.dataset[index]
+
+    def batches(self):
+        n = len(self.dataset)
+        if self.shuffle and self.generator is not None:
+            order = torch.randperm(n, generator=self.generator)
+        elif self.shuffle:
+            order = torch.randperm(n)
+        else:
+            order = torch.arange(n)
+
+        for i in range(len(self)):
+            index = order[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.gather(index)
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return prefetch_batches(self.batches(), self.prefetch)
+        return self.batches()
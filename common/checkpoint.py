@@ -0,0 +1,91 @@
+import os
+import json
+import numpy as np
+import torch
+
+
+# epochs between the training checkpoints of train_early_stopping
+CHECKPOINT_EVERY = 5
+
+# files kept next to a model, model_LSTM_OD/LSTM_OD_1-2.pkl ->
+# model_LSTM_OD/LSTM_OD_1-2.done, .ckpt and .pred.npy
+MARKER_SUFFIX = ".done"
+CHECKPOINT_SUFFIX = ".ckpt"
+PREDICTION_SUFFIX = ".pred.npy"
+
+
+# torch.save through a temporary file renamed into place, a reader or a crashed run
+# never sees a half written model
+def save_model(state, file_name):
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    tmp_file = file_name + ".tmp." + str(os.getpid())
+    torch.save(state, tmp_file)
+    os.replace(tmp_file, file_name)
+
+
+def get_marker_name(model_name):
+    return os.path.splitext(model_name)[0] + MARKER_SUFFIX
+
+
+def get_checkpoint_name(model_name):
+    return os.path.splitext(model_name)[0] + CHECKPOINT_SUFFIX
+
+
+def get_prediction_name(model_name):
+    return os.path.splitext(model_name)[0] + PREDICTION_SUFFIX
+
+
+# the model of model_name was trained to the end by an earlier run
+def is_done(model_name):
+    return os.path.exists(get_marker_name(model_name))
+
+
+# completion marker of model_name, written once the model and its normalizer are saved,
+# holds the training report, the training checkpoint is not needed anymore
+def mark_done(model_name, report=None):
+    file_name = get_marker_name(model_name)
+    tmp_file = file_name + ".tmp." + str(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(report or {}, f)
+    os.replace(tmp_file, file_name)
+    checkpoint = get_checkpoint_name(model_name)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+# model and optimizer state after epoch, with any other state of the training loop
+def save_checkpoint(file_name, model, optimizer, epoch, **state):
+    state["model"] = model.state_dict()
+    state["optimizer"] = optimizer.state_dict()
+    state["epoch"] = epoch
+    save_model(state, file_name)
+
+
+# load the model and optimizer state of save_checkpoint, returns the whole state,
+# None when there is no checkpoint
+def load_checkpoint(file_name, model, optimizer):
+    if not os.path.exists(file_name):
+        return None
+    state = torch.load(file_name, map_location="cpu")
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    return state
+
+
+# test predictions of one OD, written as soon as they are computed
+def save_predictions(predictions, file_name):
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    tmp_file = file_name + ".tmp." + str(os.getpid()) + ".npy"
+    np.save(tmp_file, np.asarray(predictions, dtype=np.float64))
+    os.replace(tmp_file, file_name)
+
+
+# the predictions of save_predictions as a list, default if they were not written
+def load_predictions(file_name, default=None):
+    if os.path.exists(file_name):
+        return np.load(file_name).tolist()
+    return default
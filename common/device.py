@@ -0,0 +1,47 @@
+import os
+import torch
+
+
+# "cpu", "cuda", "cuda:1", ... overrides the default device of every model script
+DEVICE_ENV = "TM_DEVICE"
+
+# number of torch threads on the CPU, default torch's own (one per core)
+THREADS_ENV = "TM_THREADS"
+
+_CPU_READY = False
+
+
+def setup_cpu(threads=None):
+    '''
+    backend settings for training / inference on the CPU, done once per process
+    :param threads: torch intra-op threads, None for $TM_THREADS or torch's default
+    '''
+    global _CPU_READY
+    if threads is None and os.environ.get(THREADS_ENV):
+        threads = int(os.environ[THREADS_ENV])
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if _CPU_READY:
+        return
+    _CPU_READY = True
+    # oneDNN (mkldnn) kernels for the convolutions, LSTM and linear layers on x86
+    if torch.backends.mkldnn.is_available():
+        torch.backends.mkldnn.enabled = True
+    # denormal floats are slow on x86, normalized traffic never needs them
+    torch.set_flush_denormal(True)
+
+
+def get_device(device=None):
+    '''
+    the torch.device every model and tensor of a run lives on
+    :param device: "cpu", "cuda", a torch.device, or None for $TM_DEVICE, else cuda if a GPU is
+                   available and the CPU otherwise
+    '''
+    if device is None:
+        device = os.environ.get(DEVICE_ENV)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    if device.type == "cpu":
+        setup_cpu()
+    return device
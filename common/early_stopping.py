@@ -0,0 +1,153 @@
+import os
+import csv
+import time
+import torch
+import torch.nn as nn
+from common.device import get_device
+from common.checkpoint import save_checkpoint, load_checkpoint, CHECKPOINT_EVERY
+
+
+# share of the training span held out at its end to decide when to stop
+VALIDATION_FRACTION = 0.1
+
+# validations without an improvement of at least MIN_DELTA before training stops
+PATIENCE = 5
+MIN_DELTA = 0.0
+
+
+# length of the validation tail of train_len training windows, whole batches, at least one
+def get_validation_len(train_len, batch_size, fraction=VALIDATION_FRACTION):
+    return max(1, int(train_len * fraction / batch_size)) * batch_size
+
+
+class EarlyStopping():
+    '''
+    stop when the validation loss has not improved for patience validations, keeps a copy
+    of the weights of the best validation so training ends on the best checkpoint
+    :param patience: validations without improvement before stopping
+    :param min_delta: smallest decrease of the validation loss that counts as an improvement
+    '''
+    def __init__(self, patience=PATIENCE, min_delta=MIN_DELTA):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = None
+        self.best_epoch = 0
+        self.best_state = None
+        self.bad_count = 0
+
+    # record the validation loss after epoch, True when training should stop
+    def step(self, loss, model, epoch):
+        if self.best_loss is None or loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_epoch = epoch
+            self.best_state = {name: value.detach().clone() for name, value in model.state_dict().items()}
+            self.bad_count = 0
+        else:
+            self.bad_count += 1
+        return self.bad_count >= self.patience
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def state_dict(self):
+        return {"best_loss": self.best_loss, "best_epoch": self.best_epoch,
+                "best_state": self.best_state, "bad_count": self.bad_count}
+
+    def load_state_dict(self, state):
+        self.best_loss = state["best_loss"]
+        self.best_epoch = state["best_epoch"]
+        self.best_state = state["best_state"]
+        self.bad_count = state["bad_count"]
+
+
+# mean loss over the (x, y) batches of validation, y is reshaped like the prediction
+def evaluate(model, forward, validation, loss_func, device):
+    model.eval()
+    total = 0.0
+    count = 0
+    with torch.no_grad():
+        for x, y in validation:
+            prediction = forward(x.to(device))
+            y = y.to(device).reshape(prediction.shape)
+            total += loss_func(prediction, y).item() * y.shape[0]
+            count += y.shape[0]
+    model.train()
+    return total / count
+
+
+def train_early_stopping(model, data_loader, validation, epoch, optimizer, loss_func=None, forward=None,
+                         device=None, early_stopping=None, eval_every=1, checkpoint=None,
+                         checkpoint_every=CHECKPOINT_EVERY):
+    '''
+    the training loop of the model scripts with early stopping on a validation tail
+    at most epoch epochs, the validation loss is computed every eval_every epochs and the
+    model ends with the weights of its best validation
+    :param model: the model, trained in place
+    :param data_loader: (batch_x, batch_y) batches of the training windows without the tail
+    :param validation: (x, y) batches of the validation tail, e.g. [(x_data[a:b], y_data[a:b])]
+    :param optimizer: optimizer of the model parameters
+    :param loss_func: default nn.MSELoss(), batch_y is reshaped like the prediction
+    :param forward: forward(batch_x) -> prediction, for models whose input needs a reshape,
+                    default model.forward
+    :param device: see common.device.get_device
+    :param early_stopping: EarlyStopping, default EarlyStopping(PATIENCE, MIN_DELTA)
+    :param eval_every: epochs between validations
+    :param checkpoint: file of the training checkpoint, see common/checkpoint.py, the model,
+                       optimizer, early stopping and random state are saved there every
+                       checkpoint_every epochs and a restarted run continues after the last
+                       saved epoch, None disables it
+    :return: report of the training, {"epochs", "best_epoch", "validation_loss", "time"}
+    '''
+    device = get_device(device)
+    if loss_func is None:
+        loss_func = nn.MSELoss()
+    if forward is None:
+        forward = model.forward
+    if early_stopping is None:
+        early_stopping = EarlyStopping()
+
+    star_time = time.time()
+    first = 1
+    elapsed = 0.0
+    state = None if checkpoint is None else load_checkpoint(checkpoint, model, optimizer)
+    if state is not None:
+        print("resume from epoch", state["epoch"], "of", checkpoint)
+        first = state["epoch"] + 1
+        elapsed = state["time"]
+        early_stopping.load_state_dict(state["early_stopping"])
+        torch.set_rng_state(state["rng"])
+
+    e = first - 1
+    for e in range(first, epoch + 1):
+        for step, (batch_x, batch_y) in enumerate(data_loader):
+            batch_x = batch_x.to(device)
+            batch_y = batch_y.to(device)
+            prediction = forward(batch_x)
+            loss = loss_func(prediction, batch_y.reshape(prediction.shape))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if e % eval_every == 0 or e == epoch:
+            if early_stopping.step(evaluate(model, forward, validation, loss_func, device), model, e):
+                break
+        if checkpoint is not None and e % checkpoint_every == 0:
+            save_checkpoint(checkpoint, model, optimizer, e, early_stopping=early_stopping.state_dict(),
+                            time=elapsed + time.time() - star_time, rng=torch.get_rng_state())
+    early_stopping.restore(model)
+    return {"epochs": e, "best_epoch": early_stopping.best_epoch,
+            "validation_loss": early_stopping.best_loss, "time": elapsed + time.time() - star_time}
+
+
+# print the report of train_early_stopping for name (an OD, a model) and append it to a csv file
+def log_report(name, report, file_name=None):
+    print(name, "training time:", report["time"], "epochs:", report["epochs"],
+          "best epoch:", report["best_epoch"], "validation loss:", report["validation_loss"])
+    if file_name is None:
+        return
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'a+', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerow([name, report["epochs"], report["best_epoch"], report["validation_loss"], report["time"]])
@@ -0,0 +1,49 @@
+import torch
+
+
+def embed_unique(embed, frames):
+    '''
+    embed(frames) with every distinct frame embedded once
+    the windows of a batch of consecutive windows share K - 1 frames, so the frames are
+    deduplicated before the CNN and the embeddings are scattered back to every window,
+    the gradient of a shared frame is the sum over the windows it is in
+    in training mode BatchNorm sees every distinct frame once instead of once per window
+    and a shared frame has the same dropout mask in all of its windows
+    :param embed: embed(frames) -> (n, embed_dim), e.g. the CNN and middle_out of CNN_LSTM
+    :param frames: (batch_size * K, 1, N, N) frames of the windows, window after window
+    :return: (batch_size * K, embed_dim) embedding of every frame
+    '''
+    unique, inverse = torch.unique(frames.reshape(frames.shape[0], -1), dim=0, return_inverse=True)
+    if unique.shape[0] == frames.shape[0]:
+        return embed(frames)
+    return embed(unique.reshape((-1,) + frames.shape[1:]))[inverse]
+
+
+class FrameCache():
+    '''
+    rolling buffer of the embeddings of the frames of the last window, for step by step testing
+    the window of step t + 1 is the window of step t shifted by one frame, so only its new
+    last frame goes through the CNN, a window that does not continue the last one (the first
+    one, a gap in the stream) is embedded as a whole
+    the embedding of a frame must not depend on the other frames, the model is in eval mode
+    :param embed: embed(frames) -> (n, embed_dim)
+    :param k: frames per window
+    '''
+    def __init__(self, embed, k):
+        self.embed = embed
+        self.k = k
+        self.reset()
+
+    def reset(self):
+        self.frames = None
+        self.embeddings = None
+
+    # (k, embed_dim) embeddings of the k frames of window, (k, ...)
+    def get(self, window):
+        with torch.no_grad():
+            if self.frames is not None and torch.equal(window[:-1], self.frames[1:]):
+                self.embeddings = torch.cat((self.embeddings[1:], self.embed(window[-1:])))
+            else:
+                self.embeddings = self.embed(window)
+        self.frames = window
+        return self.embeddings
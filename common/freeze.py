@@ -0,0 +1,114 @@
+import os
+import csv
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+# calls timed per model by benchmark_models, after WARMUP_STEPS untimed ones
+BENCHMARK_STEPS = 200
+WARMUP_STEPS = 20
+
+
+# the layers of sequential for inference: every Conv2d followed by a BatchNorm2d becomes one
+# Conv2d with the BatchNorm folded into its weight and bias, Dropout is left out
+def fold_sequential(sequential):
+    layers = []
+    for layer in sequential:
+        if isinstance(layer, nn.Dropout) or isinstance(layer, nn.Dropout2d):
+            continue
+        if isinstance(layer, nn.BatchNorm2d) and layers and isinstance(layers[-1], nn.Conv2d):
+            layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+            continue
+        layers.append(layer)
+    return nn.Sequential(*layers)
+
+
+class ChannelsLast(nn.Module):
+    '''
+    runs a conv stack on channels_last (NHWC) tensors, the layout of the oneDNN convolutions,
+    the output is made contiguous again for the view / linear layers after it
+    :param module: the conv stack, its weights are converted to channels_last
+    '''
+    def __init__(self, module):
+        super(ChannelsLast, self).__init__()
+        self.module = module.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.module(x.contiguous(memory_format=torch.channels_last)).contiguous()
+
+
+# the TorchScript passes of freeze_model(script=True) in the installed torch, torch.jit.freeze is new
+# in torch 1.7 and torch.jit.optimize_for_inference in 1.9, requirements.txt pins 1.6.0
+def get_script_passes():
+    return [name for name in ["freeze", "optimize_for_inference"] if hasattr(torch.jit, name)]
+
+
+# name of the freeze_model(script=True) row of a benchmark, "torchscript" and the passes it ran
+def get_script_name():
+    return " ".join(["torchscript"] + get_script_passes())
+
+
+def freeze_model(model, names, channels_last=True, script=False, example=None):
+    '''
+    copy of a CNN model for CPU inference, the model itself is not changed
+    the conv stacks names (nn.Sequential attributes such as "conv1") get their BatchNorm folded
+    into the convolutions and their Dropout removed, so the copy is only valid in eval mode
+    :param model: the trained model
+    :param names: attribute names of the conv stacks to freeze
+    :param channels_last: run the conv stacks on channels_last tensors
+    :param script: TorchScript trace of every conv stack, frozen and optimized for inference,
+                   which also converts the convolutions to mkldnn tensors when oneDNN is available,
+                   the passes missing from the installed torch are skipped, see get_script_passes
+    :param example: example input of the conv stacks for the trace, (frames, 1, N, N)
+    :return: the frozen copy, in eval mode
+    '''
+    model = copy.deepcopy(model).eval()
+    for name in names:
+        stack = fold_sequential(getattr(model, name)).eval()
+        if channels_last:
+            stack = ChannelsLast(stack).eval()
+        if script:
+            with torch.no_grad():
+                stack = torch.jit.trace(stack, example)
+                for script_pass in get_script_passes():
+                    stack = getattr(torch.jit, script_pass)(stack)
+        setattr(model, name, stack)
+    return model
+
+
+def benchmark_models(models, run, steps=BENCHMARK_STEPS, file_name=None):
+    '''
+    latency of run(model) for every model, printed and written to a csv file
+    :param models: list of (name, model)
+    :param run: run(model) -> output, e.g. the prediction of one TM
+    :return: rows of [name, seconds per call, speedup over the first model, max difference of the
+             output to the output of the first model]
+    '''
+    rows = []
+    reference = None
+    for name, model in models:
+        with torch.no_grad():
+            for i in range(WARMUP_STEPS):
+                output = run(model)
+            star_time = time.time()
+            for i in range(steps):
+                run(model)
+            latency = (time.time() - star_time) / steps
+        if reference is None:
+            reference = (latency, output)
+        rows.append([name, latency, reference[0] / latency, (output - reference[1]).abs().max().item()])
+        print(name, "latency:", latency, ", speedup:", rows[-1][2], ", max difference:", rows[-1][3])
+    if file_name is None:
+        return rows
+
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'w', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerow(["model", "latency", "speedup", "max_difference"])
+        csvwriter.writerows(rows)
+    return rows
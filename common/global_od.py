@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+import torch.utils.data as Data
+from common.window import to_tensor
+from common.batch_loader import BatchLoader
+from common.device import get_device
+
+
+class ODWindowDataset(Data.Dataset):
+    '''
+    the windows of every OD of a TM series as one dataset, for one model shared by the ODs
+    sample i is window t = i // OD_num of OD i % OD_num, so the samples of a time step are
+    contiguous and OD_num consecutive samples make up one TM, its x row is
+    [x_t, ..., x_t+k-1, OD, week_day, hour] with the OD column index and the calendar of the
+    target step, the y is x_t+k
+    the series is kept once as a (time_step, OD_num) tensor, the windows are gathered per batch
+    :param data: (time_step, OD_num) normalized traffic of every OD
+    :param calendar: (time_step, 2) week_day and hour
+    :param k: window length, using first k data to predict the k+1 data
+    :param ODs: column indices of the ODs to use, default every column
+    '''
+    def __init__(self, data, calendar, k, ODs=None):
+        self.data = to_tensor(data)
+        self.calendar = to_tensor(calendar)
+        self.k = k
+        if ODs is None:
+            ODs = range(self.data.shape[1])
+        self.ODs = torch.as_tensor(list(ODs), dtype=torch.long)
+        self.start = 0
+        self.end = self.data.shape[0] - k
+
+    # number of time windows, every one has a sample per OD
+    def get_window_num(self):
+        return self.end - self.start
+
+    def __len__(self):
+        return self.get_window_num() * len(self.ODs)
+
+    # index can be an int, a slice or a LongTensor of sample indices
+    def __getitem__(self, index):
+        single = isinstance(index, int)
+        if isinstance(index, slice):
+            index = torch.arange(*index.indices(len(self)))
+        else:
+            index = torch.as_tensor(index, dtype=torch.long).reshape(-1) % len(self)
+        t = index // len(self.ODs) + self.start
+        OD = self.ODs[index % len(self.ODs)]
+        steps = t.unsqueeze(1) + torch.arange(self.k)
+        x = torch.cat((self.data[steps, OD.unsqueeze(1)], OD.unsqueeze(1).float(),
+                       self.calendar[t + self.k]), 1)
+        y = self.data[t + self.k, OD]
+        if single:
+            return x[0], y[0]
+        return x, y
+
+    # time windows [start, end) as a new dataset, still a view on the same series
+    def subset(self, start, end=None):
+        series = ODWindowDataset.__new__(ODWindowDataset)
+        series.__dict__.update(self.__dict__)
+        series.start = self.start + start
+        series.end = self.end if end is None else min(self.end, self.start + end)
+        return series
+
+    # train / test split at train_len time windows
+    def split(self, train_len):
+        return self.subset(0, train_len), self.subset(train_len)
+
+
+def predict(model, dataset, batch_size, device=None):
+    '''
+    predictions of model for every sample of dataset, in order
+    with an ODWindowDataset of every OD and batch_size a multiple of OD_num, every forward
+    is one batch of whole TMs
+    :return: numpy array of len(dataset) predictions
+    '''
+    device = get_device(device)
+    model.eval()
+    predictions = []
+    with torch.no_grad():
+        for x, y in BatchLoader(dataset, batch_size, shuffle=False):
+            predictions.append(model(x.to(device)).reshape(-1).cpu().numpy())
+    model.train()
+    return np.concatenate(predictions)
@@ -0,0 +1,180 @@
+import torch
+import torch.nn as nn
+from common.device import get_device
+
+
+# gates of one layer, in the order of the rows of weight_ih / weight_hh of nn.LSTM and nn.GRU
+CELLS = {"LSTM": 4, "GRU": 3}
+
+# the grouped parameters are registered under the per-OD state_dict name, "." is not
+# allowed in a parameter name
+SEPARATOR = "__"
+
+
+class GroupedRNN(nn.Module):
+    '''
+    group_num per-OD models evaluated as one batched model
+    every parameter of the per-OD model is stacked into one (group_num, ...) tensor, so
+    that a forward / backward over (group_num, batch, ...) inputs advances every OD model at
+    once, the groups do not share anything, so the gradient of group g is the gradient of
+    OD model g trained on its own
+    supports the RNN (LSTM / GRU + Linear) and EmbedRNN (week_day and hour embeddings +
+    LSTM / GRU + Linear) models of the per-OD scripts, with batch_first input
+    :param models: the per-OD models, same class and sizes, their current weights are copied
+    :param cell: "LSTM" or "GRU", the recurrent layer of the models
+    '''
+    def __init__(self, models, cell="LSTM"):
+        super(GroupedRNN, self).__init__()
+        if cell not in CELLS:
+            raise ValueError("unknown cell " + str(cell) + ", one of " + str(sorted(CELLS)))
+        self.cell = cell
+        self.group_num = len(models)
+        self.names = list(models[0].state_dict().keys())
+        self.num_layers = models[0].rnn.num_layers
+        self.time_step = getattr(models[0], "time_step", None)
+        self.embed = hasattr(models[0], "hour_embeds")
+
+        for name in self.names:
+            weight = torch.stack([model.state_dict()[name].detach().clone() for model in models])
+            self.register_parameter(name.replace(".", SEPARATOR), nn.Parameter(weight))
+
+    def weight(self, name):
+        return getattr(self, name.replace(".", SEPARATOR))
+
+    # state_dict of OD model g, loadable by the per-OD model class
+    def get_state_dict(self, g):
+        state_dict = {}
+        for name in self.names:
+            state_dict[name] = self.weight(name)[g].detach().cpu().clone()
+        return state_dict
+
+    # (group_num, batch, time_step, input) -> (group_num, batch, time_step, hidden) of the last layer
+    def rnn_forward(self, x):
+        group_num, batch_size, time_step = x.shape[0], x.shape[1], x.shape[2]
+        gate_num = CELLS[self.cell]
+        for layer in range(self.num_layers):
+            suffix = "_l" + str(layer)
+            weight_ih = self.weight("rnn.weight_ih" + suffix)
+            weight_hh = self.weight("rnn.weight_hh" + suffix)
+            bias_ih = self.weight("rnn.bias_ih" + suffix)
+            bias_hh = self.weight("rnn.bias_hh" + suffix)
+            hidden_size = weight_hh.shape[2]
+
+            # input projection of every time step at once
+            x_gates = torch.baddbmm(bias_ih.unsqueeze(1), x.reshape(group_num, batch_size * time_step, -1),
+                                    weight_ih.transpose(1, 2))
+            x_gates = x_gates.reshape(group_num, batch_size, time_step, gate_num * hidden_size)
+
+            h = x.new_zeros(group_num, batch_size, hidden_size)
+            c = x.new_zeros(group_num, batch_size, hidden_size)
+            outputs = []
+            for t in range(time_step):
+                h_gates = torch.baddbmm(bias_hh.unsqueeze(1), h, weight_hh.transpose(1, 2))
+                if self.cell == "LSTM":
+                    i, f, g, o = (x_gates[:, :, t] + h_gates).chunk(4, 2)
+                    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+                    h = torch.sigmoid(o) * torch.tanh(c)
+                else:
+                    x_r, x_z, x_n = x_gates[:, :, t].chunk(3, 2)
+                    h_r, h_z, h_n = h_gates.chunk(3, 2)
+                    r = torch.sigmoid(x_r + h_r)
+                    z = torch.sigmoid(x_z + h_z)
+                    n = torch.tanh(x_n + r * h_n)
+                    h = (1 - z) * n + z * h
+                outputs.append(h)
+            x = torch.stack(outputs, 2)
+        return x
+
+    # embedding of the (group_num, batch) indices with the embedding table of every group
+    def embed_forward(self, name, index):
+        weight = self.weight(name)
+        groups = torch.arange(self.group_num, device=index.device).unsqueeze(1)
+        return weight[groups, index]
+
+    # x: (group_num, batch, time_step, input_size), for EmbedRNN the last two steps are
+    # week_day and hour as in EmbedRNN.forward
+    def forward(self, x):
+        if self.embed:
+            x_traffic = x[:, :, 0:self.time_step, :]
+            features = [self.rnn_forward(x_traffic)[:, :, -1, :],
+                        self.embed_forward("week_day_embeds.weight", x[:, :, -2, 0].long()),
+                        self.embed_forward("hour_embeds.weight", x[:, :, -1, 0].long())]
+            out_input = torch.cat(features, 2)
+        else:
+            out_input = self.rnn_forward(x)[:, :, -1, :]
+        return torch.baddbmm(self.weight("out.bias").unsqueeze(1), out_input,
+                             self.weight("out.weight").transpose(1, 2))
+
+
+# sum of the MSELoss of every group, the gradient of each group is that of its own MSELoss
+def grouped_mse_loss(prediction, y):
+    return ((prediction - y) ** 2).reshape(prediction.shape[0], -1).mean(1).sum()
+
+
+class GroupedBatchLoader():
+    '''
+    mini batches of several ODs at once, every OD has its own shuffled order
+    the order of OD g is drawn from a generator seeded with seeds[g], so that
+    BatchLoader(dataset of OD g, batch_size, generator=seeded the same way) gives the
+    same batches when OD g is trained on its own
+    :param dataset: WindowDataset of the (time_step, group_num) series of the ODs, with
+                    optional extra columns shared by all ODs (week_day and hour)
+    :param batch_size: mini batch size
+    :param seeds: one seed per OD
+    :param shuffle: random order data
+    '''
+    def __init__(self, dataset, batch_size, seeds, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generators = []
+        for seed in seeds:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            self.generators.append(generator)
+
+        # (group_num, n, k) view of the windows and (group_num, n) targets
+        self.x_data = dataset.x_data.permute(2, 0, 1)
+        self.y_data = dataset.y_data.t()
+        self.extra = dataset.extra
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        group_num = len(self.generators)
+        if self.shuffle:
+            order = torch.stack([torch.randperm(n, generator=generator) for generator in self.generators])
+        else:
+            order = torch.arange(n).repeat(group_num, 1)
+        groups = torch.arange(group_num).unsqueeze(1)
+
+        for i in range(len(self)):
+            index = order[:, i * self.batch_size:(i + 1) * self.batch_size]
+            batch_x = self.x_data[groups, index]
+            if self.extra is not None:
+                batch_x = torch.cat((batch_x, self.extra[index]), 2)
+            # (group_num, batch, time_step, 1) and (group_num, batch, 1), input_size 1
+            yield batch_x.unsqueeze(3), self.y_data[groups, index].unsqueeze(2)
+
+
+# train the per-OD models as one GroupedRNN, returns it, the weights of OD g are get_state_dict(g)
+# the optimizer must work element-wise (Adagrad, Adam, SGD), like it does on the per-OD models
+# device: see common.device.get_device
+def train_grouped(models, cell, dataset, epoch, LR, batch_size, seeds, optimizer=torch.optim.Adagrad,
+                  device=None):
+    device = get_device(device)
+    model = GroupedRNN(models, cell).to(device)
+    optimizer = optimizer(model.parameters(), lr=LR)
+    data_loader = GroupedBatchLoader(dataset, batch_size, seeds)
+    for e in range(epoch):
+        for step, (batch_x, batch_y) in enumerate(data_loader):
+            batch_x = batch_x.to(device)
+            batch_y = batch_y.to(device)
+            prediction = model.forward(batch_x)
+            loss = grouped_mse_loss(prediction, batch_y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return model
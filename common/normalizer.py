@@ -0,0 +1,123 @@
+import os
+import numpy as np
+
+
+NORMALIZER_SUFFIX = ".norm.npz"
+
+
+class Normalizer():
+    '''
+    min-max or z-score scaling of traffic data
+    the constants are fitted once on the training span and applied to whole arrays,
+    they are saved next to the model so inference does not recompute them from the csv
+    :param method: "min-max" or "z-score"
+    :param axis: None for one pair of constants (a single OD), 0 for one pair per column
+                 (every OD of a TM series)
+    '''
+    METHODS = ("min-max", "z-score")
+
+    def __init__(self, method="min-max", axis=None):
+        if method not in Normalizer.METHODS:
+            raise ValueError("unknown normalization " + str(method) + ", one of " + str(Normalizer.METHODS))
+        self.method = method
+        self.axis = axis
+        self.reset()
+
+    # forget the fitted constants and the running statistics of partial_fit
+    def reset(self):
+        self.offset = None
+        self.scale = None
+        self.data_max = None
+        self.data_min = None
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        return self
+
+    def fit(self, data):
+        return self.reset().partial_fit(data)
+
+    # fit on one more chunk of the series, the constants after the last chunk are those
+    # fit() gives on all chunks at once, mean and variance are merged as in Chan et al.
+    def partial_fit(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        data_max = np.max(data, axis=self.axis)
+        data_min = np.min(data, axis=self.axis)
+        count = data.size if self.axis is None else data.shape[self.axis]
+        mean = np.mean(data, axis=self.axis)
+        m2 = np.sum(np.square(data - np.mean(data, axis=self.axis, keepdims=True)), axis=self.axis)
+
+        if self.count == 0:
+            self.data_max, self.data_min = data_max, data_min
+            self.mean, self.m2 = mean, m2
+        else:
+            self.data_max = np.maximum(self.data_max, data_max)
+            self.data_min = np.minimum(self.data_min, data_min)
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * count / total
+            self.m2 = self.m2 + m2 + np.square(delta) * self.count * count / total
+        self.count += count
+
+        if self.method == "min-max":
+            offset = self.data_min
+            scale = self.data_max - self.data_min
+        else:
+            offset = self.mean
+            scale = np.sqrt(self.m2 / self.count)
+
+        # constant columns, e.g. the O = D pairs that are always 0, are only shifted
+        self.offset = offset
+        self.scale = np.where(scale == 0, 1.0, scale)
+        return self
+
+    def transform(self, data):
+        return (np.asarray(data, dtype=np.float64) - self.offset) / self.scale
+
+    def fit_transform(self, data):
+        return self.fit(data).transform(data)
+
+    # absolute: flip negative model outputs first, traffic is never negative
+    def inverse_transform(self, data, absolute=False):
+        data = np.asarray(data, dtype=np.float64)
+        if absolute:
+            data = np.abs(data)
+        return data * self.scale + self.offset
+
+    # the fitted span has no traffic at all
+    def is_zero(self):
+        return bool(np.all(self.data_max == 0) and np.all(self.data_min == 0))
+
+    def save(self, file_name):
+        path = os.path.dirname(file_name)
+        if path and not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        axis = -1 if self.axis is None else self.axis
+        tmp_file = file_name + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, method=np.array(self.method), axis=np.array(axis), offset=self.offset,
+                     scale=self.scale, data_max=self.data_max, data_min=self.data_min)
+        os.replace(tmp_file, file_name)
+
+    @staticmethod
+    def load(file_name):
+        with np.load(file_name) as f:
+            axis = int(f["axis"])
+            normalizer = Normalizer(str(f["method"]), None if axis == -1 else axis)
+            normalizer.offset = f["offset"]
+            normalizer.scale = f["scale"]
+            normalizer.data_max = f["data_max"]
+            normalizer.data_min = f["data_min"]
+        return normalizer
+
+
+# model_LSTM_OD/LSTM_OD_1-2.pkl -> model_LSTM_OD/LSTM_OD_1-2.norm.npz
+def get_normalizer_name(model_name):
+    return os.path.splitext(model_name)[0] + NORMALIZER_SUFFIX
+
+
+# the normalizer saved with a model, default if the model was trained without one
+def load_normalizer(file_name, default=None):
+    if os.path.exists(file_name):
+        return Normalizer.load(file_name)
+    return default
@@ -0,0 +1,167 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+CACHE_DIR = ".cache"
+
+# rows of the csv parsed at a time when a cache is built
+BUILD_CHUNK_SIZE = 10000
+
+# one cache per csv file and process, shared by every PridictTM of a run
+_OD_CACHES = {}
+
+# calendar features derived from the time column, in this column order
+CALENDAR_COLUMNS = ["week_day", "hour"]
+
+
+# week_day (Monday = 0, as datetime.weekday()) and hour of every time stamp, shape (time_step, 2)
+def get_calendar(time_data):
+    seconds = np.asarray(time_data).astype("datetime64[s]").astype(np.int64)
+    days = seconds // 86400
+    # 1970-01-01 was a Thursday
+    week_day = (days + 3) % 7
+    hour = (seconds // 3600) % 24
+    return np.stack((week_day, hour), axis=1).astype(np.float64)
+
+
+class ODCache():
+    '''
+    columnar cache of an OD_pair csv file
+    the csv is parsed once and stored as a column-major .npy next to it, later runs
+    memory-map the .npy instead of calling pd.read_csv again
+    the cache is rebuilt when the mtime or size of the csv changes
+    the week_day and hour calendar features are derived from the time column and cached
+    with it, so the embedding models can read the plain OD_pair csv
+    :param file_name: the OD_pair csv file, first column is time, the others are OD_x-y
+    :param cache_dir: where to keep the .npy/.json files, default <csv dir>/.cache/
+    '''
+    def __init__(self, file_name, cache_dir=None):
+        self.file_name = file_name
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_name)), CACHE_DIR)
+        self.cache_dir = cache_dir
+
+        base_name = os.path.splitext(os.path.basename(file_name))[0]
+        self.data_file = os.path.join(cache_dir, base_name + ".npy")
+        self.time_file = os.path.join(cache_dir, base_name + "_time.npy")
+        self.calendar_file = os.path.join(cache_dir, base_name + "_calendar.npy")
+        self.meta_file = os.path.join(cache_dir, base_name + ".json")
+
+        if not self.is_valid():
+            self.build()
+        self.load()
+
+    def source_stamp(self):
+        stat = os.stat(self.file_name)
+        return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+    def is_valid(self):
+        if not (os.path.exists(self.meta_file) and os.path.exists(self.data_file)
+                and os.path.exists(self.time_file) and os.path.exists(self.calendar_file)):
+            return False
+        with open(self.meta_file, 'r') as f:
+            meta = json.load(f)
+        return meta.get("source") == self.source_stamp()
+
+    # parse the csv and write the cache files, tmp file + rename so that
+    # a crashed run never leaves a half written cache behind
+    # the csv is parsed BUILD_CHUNK_SIZE rows at a time straight into the memory-mapped
+    # .npy, so building the cache of a large topology does not hold the whole csv in memory
+    def build(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        time_data = pd.to_datetime(pd.read_csv(self.file_name, usecols=["time"])["time"])
+        time_data = time_data.values.astype("datetime64[s]")
+        columns = pd.read_csv(self.file_name, nrows=0).columns.values.tolist()
+        columns.remove("time")
+        shape = (time_data.shape[0], len(columns))
+
+        # Fortran order, so that every OD column is contiguous on disk
+        tmp_file = self.data_file + ".tmp"
+        if shape[0] == 0:
+            self._atomic_save(self.data_file, np.zeros(shape, order='F'))
+        else:
+            data = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float64, shape=shape, fortran_order=True)
+            start = 0
+            for df in pd.read_csv(self.file_name, chunksize=BUILD_CHUNK_SIZE):
+                del df["time"]
+                data[start:start + len(df)] = df.values
+                start += len(df)
+            data.flush()
+            del data
+            os.replace(tmp_file, self.data_file)
+
+        self._atomic_save(self.time_file, time_data)
+        self._atomic_save(self.calendar_file, get_calendar(time_data))
+
+        meta = {"source": self.source_stamp(), "columns": columns, "shape": list(shape)}
+        tmp_file = self.meta_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self.meta_file)
+
+    def _atomic_save(self, file_name, array):
+        tmp_file = file_name + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_file, file_name)
+
+    def load(self):
+        with open(self.meta_file, 'r') as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.column_index = {}
+        for i in range(len(self.columns)):
+            self.column_index[self.columns[i]] = i
+
+        # OD columns only, in csv order, i.e. the row major order of the TM
+        self.OD_list = [column for column in self.columns if column.startswith("OD_")]
+        self.OD_index = [self.column_index[OD] for OD in self.OD_list]
+        self.node_num = int(round(np.sqrt(len(self.OD_list))))
+
+        self.data = np.load(self.data_file, mmap_mode='r')
+        self.time = np.load(self.time_file)
+        self.calendar = np.load(self.calendar_file)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def get_OD_list(self):
+        return list(self.OD_list)
+
+    # one column of the csv, a read only view on the memory-mapped cache
+    # week_day and hour come from the time column when the csv does not have them
+    def get_column(self, column):
+        if column not in self.column_index and column in CALENDAR_COLUMNS:
+            return self.calendar[:, CALENDAR_COLUMNS.index(column)]
+        return self.data[:, self.column_index[column]]
+
+    # (time_step, 2) array of week_day and hour
+    def get_calendar(self):
+        return np.stack([self.get_column(column) for column in CALENDAR_COLUMNS], axis=1)
+
+    def get_OD(self, OD):
+        return self.get_column(OD)
+
+    # all OD columns as a (time_step, OD_num) array
+    def get_values(self):
+        if self.OD_index == list(range(len(self.OD_index))):
+            return np.array(self.data[:, :len(self.OD_index)])
+        return np.array(self.data[:, self.OD_index])
+
+    # the TM of one time step as a (node_num, node_num) array
+    def get_TM(self, t):
+        row = np.array(self.data[t, self.OD_index])
+        return row.reshape(self.node_num, self.node_num)
+
+
+def load_OD_cache(file_name, cache_dir=None):
+    key = (os.path.abspath(file_name), cache_dir)
+    cache = _OD_CACHES.get(key)
+    if cache is None or not cache.is_valid():
+        cache = ODCache(file_name, cache_dir)
+        _OD_CACHES[key] = cache
+    return cache
@@ -0,0 +1,60 @@
+import os
+import csv
+import numpy as np
+from sklearn.cluster import KMeans
+
+
+# 5 minute samples of one day
+STEPS_PER_DAY = 288
+
+
+# mean normalized traffic at every time of day over the whole days of data
+def get_daily_profile(data, steps_per_day=STEPS_PER_DAY):
+    days = int(len(data) / steps_per_day)
+    if days == 0:
+        raise ValueError("a daily profile needs at least " + str(steps_per_day) + " time steps")
+    return np.asarray(data[:days * steps_per_day], dtype=np.float64).reshape(days, steps_per_day).mean(axis=0)
+
+
+def group_ODs(profiles, group_num, seed=0):
+    '''
+    k-means clustering of the daily profiles of the ODs, ODs with the same diurnal shape
+    share a group and so a model
+    :param profiles: list of get_daily_profile of every OD
+    :param group_num: number of groups, at most the number of ODs
+    :param seed: random state of KMeans
+    :return: numpy array of the group of every OD, 0 to group_num - 1
+    '''
+    kmeans_cls = KMeans(min(group_num, len(profiles)), random_state=seed, n_init=10)
+    return kmeans_cls.fit_predict(np.stack(profiles))
+
+
+# the ODs of every group, [[OD, ...] of group 0, ...]
+def get_group_members(ODs, groups):
+    return [[ODs[i] for i in range(len(ODs)) if groups[i] == g] for g in range(int(np.max(groups)) + 1)]
+
+
+# one row per OD, OD,group
+def save_groups(ODs, groups, file_name):
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'w', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerows([[ODs[i], int(groups[i])] for i in range(len(ODs))])
+
+
+# accuracy and training time of the groupings, rows of [group_num, models, time, test_loss],
+# printed and written to a csv file
+def log_grouping(rows, file_name=None):
+    for row in rows:
+        print("groups:", row[0], ", models:", row[1], ", training time:", row[2], ", mean test loss:", row[3])
+    if file_name is None:
+        return
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'w', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerow(["group_num", "models", "time", "test_loss"])
+        csvwriter.writerows(rows)
@@ -0,0 +1,295 @@
+import os
+import re
+import glob
+import numpy as np
+import torch
+from common.od_cache import ODCache
+from common.tm_history import TMHistory
+from common.window import WindowDataset
+from common.batch_loader import BatchLoader, prefetch_batches
+
+
+# one week of 5 minute samples
+CHUNK_SIZE = 2016
+
+# bytes held per value of a chunk: the float64 block read from the cache, its normalized
+# copy and the float32 tensor of the windows, with room for the batches gathered from it
+CHUNK_BYTES_PER_VALUE = 32
+
+DATE_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+# the date stamp of an OD_pair csv, Abilene-OD_pair_2004-08-01.csv -> 2004-08-01, None if it has none
+def get_file_date(file_name):
+    dates = DATE_PATTERN.findall(os.path.basename(file_name))
+    if not dates:
+        return None
+    return dates[-1]
+
+
+# the OD_pair csv files matching a glob pattern, in date order
+# start_date / end_date: "YYYY-MM-DD", both included, None for no bound
+def get_OD_files(pattern, start_date=None, end_date=None):
+    files = []
+    for file in glob.glob(pattern):
+        date = get_file_date(file)
+        if start_date is not None or end_date is not None:
+            if date is None:
+                continue
+            if start_date is not None and date < start_date:
+                continue
+            if end_date is not None and date > end_date:
+                continue
+        files.append(file)
+    return sorted(files, key=lambda file: (get_file_date(file) or "", os.path.basename(file)))
+
+
+# the largest chunk_size whose chunks of column_num columns stay below memory_limit bytes
+def get_chunk_size(memory_limit, column_num, k):
+    chunk_size = int(memory_limit / (CHUNK_BYTES_PER_VALUE * column_num)) - k
+    if chunk_size <= k:
+        raise ValueError("memory_limit " + str(memory_limit) + " is too small for windows of " +
+                         str(k) + " time steps of " + str(column_num) + " columns")
+    return chunk_size
+
+
+class ODStream():
+    '''
+    one time series over many OD_pair csv files, read chunk by chunk
+    the files are read in order through their columnar caches, every chunk holds at most
+    chunk_size new time steps plus the last k time steps of the previous chunk, so the
+    windows ending in a chunk are complete even across file boundaries and memory is
+    bounded by chunk_size instead of by the length of the history
+    this is also the out-of-core mode of the TM models: the data stays in the memory-mapped
+    caches on disk and only one chunk of windows is materialized, memory_limit sizes the
+    chunks for topologies whose whole history does not fit in memory
+    :param files: list of csv files in time order, a glob pattern (see get_OD_files), or a
+                  TMHistory store, whose time ranges are picked with subset(*get_row_range(...))
+    :param k: window length, using first k data to predict the k+1 data
+    :param chunk_size: number of new time steps per chunk
+    :param columns: columns to read, default every OD column, a single column such as
+                    ["OD_1-2"] is read as a 1-d series like read_data of the per-OD models
+    :param calendar: add week_day and hour to the windows, for a single OD those of the target
+                     step are appended to the window (EKM models), for a TM they are two more,
+                     not predicted, columns of every time step (LSTM TM embedding model)
+    :param memory_limit: bytes of traffic data a chunk may take, overrides chunk_size
+    '''
+    def __init__(self, files, k, chunk_size=CHUNK_SIZE, columns=None, calendar=False, memory_limit=None):
+        self.history = None
+        if isinstance(files, TMHistory):
+            self.history = files
+            files = [files.path]
+        elif isinstance(files, str):
+            pattern = files
+            files = get_OD_files(pattern)
+            if not files:
+                raise ValueError("no OD_pair csv file matches " + pattern)
+        self.files = list(files)
+        self.k = k
+        self.calendar = calendar
+
+        self.lengths = []
+        if self.history is not None:
+            if columns is None:
+                columns = self.history.get_OD_list()
+            self.lengths.append(len(self.history))
+        for file in self.files if self.history is None else []:
+            cache = ODCache(file)
+            if columns is None:
+                columns = cache.get_OD_list()
+            self.lengths.append(len(cache))
+        self.columns = list(columns)
+
+        if memory_limit is not None:
+            chunk_size = get_chunk_size(memory_limit, len(self.columns) + (2 if calendar else 0), k)
+        if chunk_size <= k:
+            raise ValueError("chunk_size " + str(chunk_size) + " must be larger than k " + str(k))
+        self.chunk_size = chunk_size
+
+        # rows [start, end) of the concatenated files
+        self.start = 0
+        self.end = int(np.sum(self.lengths))
+
+    def __len__(self):
+        return self.end - self.start
+
+    # the time steps [start, end) as a new stream, 0 based on this stream
+    def subset(self, start, end=None):
+        stream = ODStream.__new__(ODStream)
+        stream.__dict__.update(self.__dict__)
+        stream.start = self.start + start
+        stream.end = self.end if end is None else min(self.end, self.start + end)
+        return stream
+
+    # train / test split at train_len windows, the test stream starts k steps early
+    # so that its first window is window train_len of the whole series
+    def split(self, train_len):
+        return self.subset(0, train_len + self.k), self.subset(train_len)
+
+    # number of windows of every chunk, without reading them
+    def get_window_lengths(self):
+        lengths = []
+        for start in range(0, len(self), self.chunk_size):
+            lengths.append(min(self.chunk_size, len(self) - start))
+        if lengths:
+            lengths[0] -= self.k
+        return [length for length in lengths if length > 0]
+
+    # blocks of at most chunk_size rows, (values, calendar), in time order
+    def read(self):
+        if self.history is not None:
+            for start in range(self.start, self.end, self.chunk_size):
+                stop = min(start + self.chunk_size, self.end)
+                values = self.history.get_rows(start, stop, self.columns)
+                if values.shape[1] == 1:
+                    values = values[:, 0]
+                yield values, self.history.get_calendar(start, stop)
+            return
+
+        offset = 0
+        for i in range(len(self.files)):
+            begin = max(self.start - offset, 0)
+            end = min(self.end - offset, self.lengths[i])
+            offset += self.lengths[i]
+            if begin >= end:
+                continue
+
+            cache = ODCache(self.files[i])
+            index = [cache.column_index[column] for column in self.columns]
+            if len(index) == 1:
+                index = index[0]
+            for start in range(begin, end, self.chunk_size):
+                stop = min(start + self.chunk_size, end)
+                yield np.asarray(cache.data[start:stop, index]), cache.calendar[start:stop]
+
+    # (values, calendar) chunks with chunk_size new rows each, the first k rows of every
+    # chunk after the first one are the last k rows of the chunk before
+    # context: False for chunks without the k rows of the chunk before, every row once
+    def chunks(self, context=True):
+        k = self.k if context else 0
+        context = None
+        blocks = []
+        size = 0
+        for block in self.read():
+            blocks.append(block)
+            size += block[0].shape[0]
+            if size < self.chunk_size:
+                continue
+            # blocks are at most chunk_size rows, so at most one chunk is ready here
+            values = np.concatenate([block[0] for block in blocks])
+            calendar = np.concatenate([block[1] for block in blocks])
+            blocks = [(values[self.chunk_size:], calendar[self.chunk_size:])]
+            size -= self.chunk_size
+            chunk = self.add_context(context, values[:self.chunk_size], calendar[:self.chunk_size])
+            if k > 0:
+                context = (chunk[0][-k:], chunk[1][-k:])
+            yield chunk
+
+        if size > 0:
+            values = np.concatenate([block[0] for block in blocks])
+            calendar = np.concatenate([block[1] for block in blocks])
+            chunk = self.add_context(context, values, calendar)
+            if chunk[0].shape[0] > k:
+                yield chunk
+
+    def add_context(self, context, values, calendar):
+        if context is None:
+            return values, calendar
+        return np.concatenate((context[0], values)), np.concatenate((context[1], calendar))
+
+    # WindowDataset of every chunk, the windows of all chunks are the windows of the series
+    def windows(self, normalizer=None):
+        for values, calendar in self.chunks():
+            if normalizer is not None:
+                values = normalizer.transform(values)
+            if not self.calendar:
+                yield WindowDataset(values, self.k)
+            elif values.ndim == 1:
+                yield WindowDataset(values, self.k, extra=calendar)
+            else:
+                yield WindowDataset(np.concatenate((values, calendar), axis=1), self.k, target=values)
+
+    # every (x, y) window one by one in time order, for step by step testing
+    def samples(self, normalizer=None):
+        for dataset in self.windows(normalizer):
+            for i in range(len(dataset)):
+                yield dataset[i]
+
+    # fit a Normalizer on the whole stream one block at a time
+    def fit(self, normalizer):
+        normalizer.reset()
+        for values, calendar in self.read():
+            normalizer.partial_fit(values)
+        return normalizer
+
+
+class StreamLoader():
+    '''
+    shuffled mini batches over an ODStream, only one chunk of windows is in memory
+    the windows are shuffled within their chunk and the chunks are visited in time order,
+    batches that straddle two chunks are completed with windows of the next chunk, so
+    every batch but the last one has batch_size windows as with BatchLoader
+    :param stream: ODStream, usually the training part of ODStream.split
+    :param batch_size: mini batch size
+    :param shuffle: random order data within a chunk
+    :param drop_last: drop the last incomplete batch
+    :param normalizer: fitted Normalizer applied to every chunk, None for raw values
+    :param prefetch: number of batches gathered ahead by a background thread, 0 disables it,
+                     the next chunk is then read while the current one is trained on, so two
+                     chunks can be in memory
+    :param contiguous: every batch is batch_size consecutive windows, only the order of the
+                       batches is shuffled, consecutive windows share k - 1 time steps
+    '''
+    def __init__(self, stream, batch_size, shuffle=True, drop_last=False, normalizer=None, prefetch=0,
+                 contiguous=False):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.normalizer = normalizer
+        self.prefetch = prefetch
+        self.contiguous = contiguous
+
+    def __len__(self):
+        n = int(np.sum(self.stream.get_window_lengths()))
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return prefetch_batches(self.batches(), self.prefetch)
+        return self.batches()
+
+    def batches(self):
+        rest = None
+        for dataset in self.stream.windows(self.normalizer):
+            loader = BatchLoader(dataset, self.batch_size, shuffle=self.shuffle)
+            n = len(dataset)
+            if self.shuffle and self.contiguous:
+                starts = torch.randperm((n + self.batch_size - 1) // self.batch_size) * self.batch_size
+                order = torch.cat([torch.arange(start, min(start + self.batch_size, n)) for start in starts.tolist()])
+            elif self.shuffle:
+                order = torch.randperm(n)
+            else:
+                order = torch.arange(n)
+
+            start = 0
+            if rest is not None:
+                start = min(self.batch_size - rest[0].shape[0], n)
+                batch = loader.gather(order[:start])
+                rest = tuple(torch.cat((rest[j], batch[j])) for j in range(len(batch)))
+                if rest[0].shape[0] < self.batch_size:
+                    continue
+                yield rest
+                rest = None
+
+            for i in range(start, n, self.batch_size):
+                batch = loader.gather(order[i:i + self.batch_size])
+                if batch[0].shape[0] < self.batch_size:
+                    rest = batch
+                else:
+                    yield batch
+
+        if rest is not None and not self.drop_last:
+            yield rest
@@ -0,0 +1,68 @@
+import os
+import time
+import multiprocessing
+import torch
+
+
+# torch threads of every worker, workers * THREADS should not exceed the cores
+THREADS = 1
+
+# the function of the pool, set once per worker by init_worker
+_FUNCTION = None
+
+
+def init_worker(function, threads):
+    global _FUNCTION
+    _FUNCTION = function
+    # one worker per core, intra-op threads of torch and of the OpenMP libraries
+    # (sklearn KMeans) would only compete with the other workers
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    torch.set_num_threads(threads)
+
+
+def run_OD(item):
+    i, OD = item
+    return i, _FUNCTION(OD)
+
+
+# number of workers that keeps workers * threads within the cores
+def get_worker_num(threads=THREADS):
+    return max(1, (os.cpu_count() or 1) // threads)
+
+
+def map_ODs(function, OD_list, workers=None, threads=THREADS):
+    '''
+    function(OD) for every OD on a pool of worker processes, one OD model per task
+    the function is handed to every worker once, with the fork start method it and the state
+    it refers to (the PridictTM, the memory-mapped OD cache) are shared copy-on-write instead
+    of being pickled, the csv caches are memory-mapped so every worker reads the same pages
+    :param function: function(OD) -> result, e.g. PridictTM.train_OD, must save its models
+                     atomically (common.checkpoint.save_model), workers can be killed at any time
+    :param OD_list: the ODs, the results are returned in this order
+    :param workers: number of processes, default get_worker_num(threads), 1 runs in this process
+    :param threads: torch threads per worker
+    '''
+    if workers is None:
+        workers = get_worker_num(threads)
+    results = [None] * len(OD_list)
+    star_time = time.time()
+    if workers == 1:
+        for i in range(len(OD_list)):
+            results[i] = function(OD_list[i])
+        return results
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    pool = context.Pool(workers, initializer=init_worker, initargs=(function, threads))
+    try:
+        done = 0
+        for i, result in pool.imap_unordered(run_OD, list(enumerate(OD_list))):
+            results[i] = result
+            done += 1
+            print("Finished", OD_list[i], done, "/", len(OD_list), "in", time.time() - star_time)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
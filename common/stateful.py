@@ -0,0 +1,101 @@
+import torch
+import torch.nn as nn
+from common.window import to_tensor
+from common.device import get_device
+
+
+class SequenceLoader():
+    '''
+    contiguous chunks of a series for stateful training
+    the series is cut into batch_size streams of equal length, batch i holds steps
+    [i * bptt, (i + 1) * bptt) of every stream and its targets one step later, so the
+    state at the end of batch i is the state at the start of batch i + 1 and every time
+    step is fed to the model once per epoch
+    :param data: time series, shape (time_step,) for a single OD or (time_step, input_size)
+    :param batch_size: number of parallel streams
+    :param bptt: time steps per chunk, the length back propagation is truncated at
+    '''
+    def __init__(self, data, batch_size, bptt):
+        data = to_tensor(data)
+        if data.dim() == 1:
+            data = data.unsqueeze(1)
+        self.batch_size = batch_size
+        self.bptt = bptt
+        self.length = (data.shape[0] - 1) // batch_size
+        if self.length < 1:
+            raise ValueError("series of " + str(data.shape[0]) + " steps is too short for " +
+                             str(batch_size) + " streams")
+
+        # (batch_size, length, input_size), stream b starts at step b * length
+        size = self.length * batch_size
+        self.x_data = data[:size].reshape(batch_size, self.length, -1)
+        self.y_data = data[1:size + 1].reshape(batch_size, self.length, -1)
+
+    def __len__(self):
+        return (self.length + self.bptt - 1) // self.bptt
+
+    def __iter__(self):
+        for start in range(0, self.length, self.bptt):
+            yield self.x_data[:, start:start + self.bptt], self.y_data[:, start:start + self.bptt]
+
+
+# cut the graph behind a hidden state, (h, c) of an LSTM or h of a GRU
+def detach_state(state):
+    if isinstance(state, tuple):
+        return tuple(s.detach() for s in state)
+    return state.detach()
+
+
+# the prediction of every step of x and the state after the last one, for the RNN models of
+# the per-OD scripts (batch_first rnn + out Linear), state None is the zero state
+def stateful_forward(model, x, state=None):
+    r_out, state = model.rnn(x, state)
+    return model.out(r_out), state
+
+
+def train_stateful(model, data, epoch, LR, batch_size, bptt, optimizer=torch.optim.Adagrad, device=None):
+    '''
+    truncated BPTT training over the contiguous series instead of k-length windows
+    the state is carried across the chunks of an epoch and reset at the start of the next
+    one, the look back is the whole history seen so far while memory and the gradient are
+    bounded by bptt steps, compute per epoch is O(time_step) instead of O(time_step * k)
+    :param model: RNN of the per-OD scripts, trained in place and returned
+    :param data: normalized training span, shape (time_step,) or (time_step, input_size)
+    :param batch_size: number of parallel streams, see SequenceLoader
+    :param bptt: truncation length in time steps
+    :param device: see common.device.get_device
+    '''
+    device = get_device(device)
+    model.to(device)
+    optimizer = optimizer(model.parameters(), lr=LR)
+    loss_func = nn.MSELoss()
+    data_loader = SequenceLoader(data, batch_size, bptt)
+    for e in range(epoch):
+        state = None
+        for step, (batch_x, batch_y) in enumerate(data_loader):
+            batch_x = batch_x.to(device)
+            batch_y = batch_y.to(device)
+            prediction, state = stateful_forward(model, batch_x, state)
+            state = detach_state(state)
+            loss = loss_func(prediction, batch_y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return model
+
+
+# one pass over the whole series, prediction[t] is the prediction of step t + 1 from steps
+# [0, t], shape (time_step, input_size), numpy
+def predict_stateful(model, data, device=None, chunk_size=2016):
+    device = get_device(device)
+    data = to_tensor(data)
+    if data.dim() == 1:
+        data = data.unsqueeze(1)
+    predictions = []
+    state = None
+    with torch.no_grad():
+        for start in range(0, data.shape[0], chunk_size):
+            x = data[start:start + chunk_size].unsqueeze(0).to(device)
+            prediction, state = stateful_forward(model, x, state)
+            predictions.append(prediction[0].cpu())
+    return torch.cat(predictions).numpy()
@@ -0,0 +1,159 @@
+import os
+import csv
+import math
+import time
+import random
+import shutil
+import itertools
+from common.parallel_od import map_ODs, THREADS
+
+
+# every rung of successive halving keeps 1 / ETA of its trials and gives them ETA times the epochs
+ETA = 3
+
+# epochs of the first rung
+MIN_EPOCH = 4
+
+# ODs every trial is trained on, a trial of one model per OD on every OD would cost a whole run
+SWEEP_OD_NUM = 8
+
+
+def get_configs(space, num=None, seed=0):
+    '''
+    configurations of the constructor arguments of a PridictTM
+    :param space: {argument: [values]}, e.g. {"hidden_size": [30, 100], "LR": [0.01, 0.065]}
+    :param num: number of configurations drawn at random from the grid, default the whole grid
+    :param seed: seed of the draw
+    :return: list of {argument: value}
+    '''
+    names = sorted(space)
+    configs = [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+    if num is None or num >= len(configs):
+        return configs
+    return random.Random(seed).sample(configs, num)
+
+
+# name of a configuration, "LR-0.01_hidden_size-30"
+def get_config_name(config):
+    return "_".join([name + "-" + str(config[name]) for name in sorted(config)])
+
+
+# num ODs drawn at random from OD_list, the O = D pairs are left out, in the order of OD_list
+def get_sweep_ODs(OD_list, num=SWEEP_OD_NUM, seed=0):
+    ODs = [OD for OD in OD_list if OD.split('_')[1].split('-')[0] != OD.split('_')[1].split('-')[1]]
+    if num >= len(ODs):
+        return ODs
+    chosen = set(random.Random(seed).sample(ODs, num))
+    return [OD for OD in ODs if OD in chosen]
+
+
+# a new directory model_path + "run-<time>-<pid>/" for the trial checkpoints of one sweep, the finished
+# checkpoints of an earlier sweep are never resumed by the trials of this one
+def get_run_path(model_path):
+    return model_path + "run-" + time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + "/"
+
+
+# delete the checkpoints in path, of a trial after its last rung or of a whole sweep
+def remove_checkpoints(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+# validation loss of a trial result for ranking, a diverged trial is the worst
+def get_loss(result):
+    loss = result["loss"]
+    if loss is None or math.isnan(loss):
+        return float("inf")
+    return loss
+
+
+def successive_halving(trial, configs, min_epoch, max_epoch, eta=ETA, workers=None, threads=THREADS,
+                       prefix="trial_", path=None):
+    '''
+    successive halving: every configuration is trained for min_epoch epochs, the best 1 / eta of them
+    by validation loss go on to eta times the epochs and so on up to max_epoch, the trials of a rung
+    run in parallel on the worker processes of common/parallel_od.py
+    :param trial: trial(config, epoch, name) -> {"loss", "test_loss", "epochs", "time"}, trains the
+                  configuration for epoch epochs in total, name is the same at every rung so the
+                  trial can continue from its checkpoint of the rung before
+    :param configs: list of {argument: value}, see get_configs
+    :param prefix: prefix of the trial names, prefix + get_config_name(config)
+    :param path: directory of the trial checkpoints, see get_run_path, path + name of a trial is
+                 deleted after its last rung, None keeps them
+    :return: one result per configuration, the trial result with its "name", "config" and the
+             epochs of its last rung as "budget"
+    '''
+    names = [prefix + get_config_name(config) for config in configs]
+    config_of = dict(zip(names, configs))
+    results = {}
+    alive = names
+    epoch = min_epoch
+    while True:
+        budget = min(epoch, max_epoch)
+        print("rung of", len(alive), "trials,", budget, "epochs")
+        outputs = map_ODs(lambda name: trial(config_of[name], budget, name), alive, workers, threads)
+        for name, output in zip(alive, outputs):
+            results[name] = dict(output, name=name, config=config_of[name], budget=budget)
+        if budget >= max_epoch:
+            dropped = alive
+            alive = []
+        else:
+            ranked = sorted(alive, key=lambda name: get_loss(results[name]))
+            alive = ranked[:max(1, len(alive) // eta)]
+            dropped = ranked[len(alive):]
+        if path is not None:
+            for name in dropped:
+                remove_checkpoints(path + name)
+        if not alive:
+            break
+        # the last trial left is trained to the end
+        epoch = max_epoch if len(alive) == 1 else epoch * eta
+    return [results[name] for name in names]
+
+
+def hyperband(trial, space, min_epoch, max_epoch, eta=ETA, workers=None, threads=THREADS, seed=0, path=None):
+    '''
+    Hyperband: successive halving brackets from many configurations with few epochs to a few
+    configurations with max_epoch epochs, the configurations of a bracket are drawn from space
+    :param path: directory of the trial checkpoints, see successive_halving
+    :return: the results of successive_halving of every bracket, see successive_halving
+    '''
+    s_max = int(math.log(max_epoch / min_epoch, eta) + 1e-9)
+    results = []
+    for s in range(s_max, -1, -1):
+        num = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        configs = get_configs(space, num, seed + s)
+        print("bracket", s, "of", len(configs), "configurations")
+        results.extend(successive_halving(trial, configs, max(1, int(round(max_epoch / eta ** s))), max_epoch,
+                                          eta, workers, threads, "bracket_" + str(s) + "_", path))
+    return results
+
+
+def save_ranking(results, file_name=None):
+    '''
+    rank the trial results, the ones trained for the most epochs first, then by validation loss,
+    printed and written to a csv file with the test loss and the training time of every trial
+    :param results: results of successive_halving or hyperband
+    :return: the ranked results
+    '''
+    ranking = sorted(results, key=lambda result: (-result["budget"], get_loss(result)))
+    names = sorted(set([name for result in ranking for name in result["config"]]))
+    rows = []
+    for rank in range(len(ranking)):
+        result = ranking[rank]
+        rows.append([rank + 1, result["name"]] + [result["config"].get(name, "") for name in names] +
+                    [result["budget"], result["epochs"], result["loss"], result["test_loss"], result["time"]])
+    for row in rows[:10]:
+        print("rank:", row[0], ", config:", ranking[row[0] - 1]["config"], ", epochs:", row[-4],
+              ", validation loss:", row[-3], ", test loss:", row[-2], ", training time:", row[-1])
+    print("sweep training time:", sum([result["time"] for result in results]))
+    if file_name is None:
+        return ranking
+
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'w', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerow(["rank", "trial"] + names + ["budget", "epochs", "validation_loss", "test_loss", "time"])
+        csvwriter.writerows(rows)
+    return ranking
@@ -0,0 +1,45 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from common.tcn_stream import get_conv_weight
+
+
+# plain Conv1d without padding with the weight the forward of conv computes (weight_norm baked in)
+def bake_conv(conv):
+    weight = get_conv_weight(conv).detach()
+    baked = nn.Conv1d(weight.shape[1], weight.shape[0], conv.kernel_size[0], dilation=conv.dilation[0])
+    baked.weight.data.copy_(weight)
+    baked.bias.data.copy_(conv.bias.detach())
+    return baked
+
+
+class FoldedTemporalBlock(nn.Module):
+    '''
+    a TemporalBlock (TCN/tcn.py) for inference, with the outputs of the block in eval mode
+    - weight_norm is baked into the conv weights, it is not computed again on every forward
+    - the input of every conv is padded on the left only, (kernel_size - 1) * dilation steps,
+      so the output already has the input length and there is no Chomp1d and its copy
+    - dropout is left out
+    - the ReLUs and the residual add work in place on the conv outputs, no new tensor is made
+      between conv2 and the block output
+    :param block: the TemporalBlock, its weights are copied
+    '''
+    def __init__(self, block):
+        super(FoldedTemporalBlock, self).__init__()
+        self.padding1 = (block.conv1.kernel_size[0] - 1) * block.conv1.dilation[0]
+        self.padding2 = (block.conv2.kernel_size[0] - 1) * block.conv2.dilation[0]
+        self.conv1 = bake_conv(block.conv1)
+        self.conv2 = bake_conv(block.conv2)
+        self.downsample = copy.deepcopy(block.downsample)
+
+    def forward(self, x):
+        out = torch.relu_(self.conv1(F.pad(x, (self.padding1, 0))))
+        out = torch.relu_(self.conv2(F.pad(out, (self.padding2, 0))))
+        out += x if self.downsample is None else self.downsample(x)
+        return torch.relu_(out)
+
+
+# the TemporalConvNet tcn as an nn.Sequential of FoldedTemporalBlock, for inference only
+def fold_tcn(tcn):
+    return nn.Sequential(*[FoldedTemporalBlock(block) for block in tcn.network]).eval()
@@ -0,0 +1,52 @@
+import time
+import warnings
+import torch
+from common.freeze import BENCHMARK_STEPS, WARMUP_STEPS
+from common.tcn_stream import get_level_receptive_fields
+
+
+# levels of tcn up to the first one whose receptive field covers a window of k steps, the levels
+# after it add no input step to the last output, their taps before the window read the padding
+def get_window_levels(tcn, k):
+    fields = get_level_receptive_fields(tcn)
+    for i in range(len(fields)):
+        if fields[i] >= k:
+            return i + 1
+    return len(fields)
+
+
+def fit_window(tcn, k, trim=False):
+    '''
+    check the receptive field of a TemporalConvNet against the window of k steps of its input,
+    warns when there are levels after the window is covered, see get_window_levels
+    :param tcn: the TemporalConvNet, its levels are dropped in place when trim is set
+    :param k: steps of the input window
+    :param trim: keep only get_window_levels(tcn, k) levels
+    :return: the number of levels of tcn, after the trim
+    the kept level is the first one that covers the window, so its receptive field is > k unless
+    it is exactly k, and the TM test then streams the TCN only with stream=True of PridictTM,
+    which is not the forward of the window, see TCN_predict_TM.py
+    '''
+    fields = get_level_receptive_fields(tcn)
+    levels = get_window_levels(tcn, k)
+    if levels == len(fields):
+        return levels
+    message = "receptive field " + str(fields[-1]) + " of " + str(len(fields)) + " TCN levels > k = " + str(k)
+    if not trim:
+        warnings.warn(message + ", " + str(levels) + " levels cover the window, see trim")
+        return len(fields)
+    tcn.network = tcn.network[:levels]
+    warnings.warn(message + ", trimmed to " + str(levels) + " levels of receptive field " + str(fields[levels - 1]))
+    return levels
+
+
+# seconds per call of model(x) in eval mode, after WARMUP_STEPS untimed calls
+def get_latency(model, x, steps=BENCHMARK_STEPS):
+    model.eval()
+    with torch.no_grad():
+        for i in range(WARMUP_STEPS):
+            model(x)
+        star_time = time.time()
+        for i in range(steps):
+            model(x)
+    return (time.time() - star_time) / steps
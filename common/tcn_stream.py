@@ -0,0 +1,108 @@
+import torch
+import torch.nn.functional as F
+
+
+# the conv weight as the forward of the model computes it, weight_norm keeps weight_g and weight_v
+# and only sets weight in a forward pre-hook
+def get_conv_weight(conv):
+    if hasattr(conv, "weight_g") and hasattr(conv, "weight_v"):
+        return torch._weight_norm(conv.weight_v, conv.weight_g, 0)
+    return conv.weight
+
+
+# time steps of input one output of every level of a TemporalConvNet depends on, every
+# TemporalBlock has two causal convolutions of (kernel_size - 1) * dilation steps each
+def get_level_receptive_fields(tcn):
+    fields = []
+    field = 1
+    for block in tcn.network:
+        for conv in (block.conv1, block.conv2):
+            field += (conv.kernel_size[0] - 1) * conv.dilation[0]
+        fields.append(field)
+    return fields
+
+
+# time steps of input one output of a TemporalConvNet depends on
+def get_receptive_field(tcn):
+    return get_level_receptive_fields(tcn)[-1]
+
+
+class CausalConvStream():
+    '''
+    one dilated causal Conv1d one time step at a time
+    a ring buffer keeps the last (kernel_size - 1) * dilation + 1 input columns, the kernel_size
+    taps of the new output column are read from it, so a step costs one output column instead
+    of a convolution over the whole window
+    :param conv: the Conv1d (stride 1), its weights are read once
+    '''
+    def __init__(self, conv):
+        kernel_size = conv.kernel_size[0]
+        dilation = conv.dilation[0]
+        weight = get_conv_weight(conv).detach()
+        self.weight = weight.reshape(weight.shape[0], -1)
+        self.bias = None if conv.bias is None else conv.bias.detach()
+        self.in_channels = weight.shape[1]
+        self.length = (kernel_size - 1) * dilation + 1
+        # tap j is the input dilation * (kernel_size - 1 - j) steps before the newest one
+        self.offsets = torch.arange(kernel_size) * dilation - (kernel_size - 1) * dilation
+        self.buffer = None
+
+    # zeros, the causal padding of the batch forward before the first step
+    def reset(self, batch_size, device):
+        self.buffer = torch.zeros(batch_size, self.in_channels, self.length, device=device, dtype=self.weight.dtype)
+        self.offsets = self.offsets.to(device)
+
+    # x: (batch, in_channels) input column of step t, returns the (batch, out_channels) output column
+    def step(self, x, t):
+        self.buffer[:, :, t % self.length] = x
+        taps = self.buffer[:, :, (self.offsets + t) % self.length]
+        return F.linear(taps.reshape(taps.shape[0], -1), self.weight, self.bias)
+
+
+class StreamingTCN():
+    '''
+    incremental inference of a TemporalConvNet (TCN/tcn.py) in eval mode
+    every convolution of every TemporalBlock keeps a ring buffer sized to its dilation, see
+    CausalConvStream, and step() turns the input column of a new time step into the output
+    column of the last level, which is y1[:, :, -1] of the batch forward over every step fed
+    since reset(), the steps before the first one are the zero padding of the batch forward
+    the batch forward of a window of k steps is matched when k >= get_receptive_field(tcn),
+    for a shorter window its outputs depend on the zero padding at the start of the window
+    the weights are read once, build a new StreamingTCN after loading other weights
+    :param tcn: the TemporalConvNet
+    '''
+    def __init__(self, tcn):
+        self.levels = []
+        for block in tcn.network:
+            downsample = None
+            if block.downsample is not None:
+                weight = block.downsample.weight.detach()
+                downsample = (weight.reshape(weight.shape[0], -1), block.downsample.bias.detach())
+            self.levels.append((CausalConvStream(block.conv1), CausalConvStream(block.conv2), downsample))
+        self.receptive_field = get_receptive_field(tcn)
+        self.t = None
+
+    def reset(self):
+        self.t = None
+
+    # x: (batch, channels) input column of the next time step, returns (batch, num_channels[-1])
+    def step(self, x):
+        with torch.no_grad():
+            if self.t is None:
+                self.t = 0
+                for conv1, conv2, downsample in self.levels:
+                    conv1.reset(x.shape[0], x.device)
+                    conv2.reset(x.shape[0], x.device)
+            for conv1, conv2, downsample in self.levels:
+                out = F.relu(conv1.step(x, self.t))
+                out = F.relu(conv2.step(out, self.t))
+                res = x if downsample is None else F.linear(x, downsample[0], downsample[1])
+                x = F.relu(out + res)
+            self.t += 1
+        return x
+
+    # every column of x, (batch, channels, steps), returns the output column of the last step
+    def extend(self, x):
+        for i in range(x.shape[2]):
+            out = self.step(x[:, :, i])
+        return out
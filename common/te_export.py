@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from common.tm_archive import load_TM_run
+
+
+MANIFEST = ".export.json"
+
+
+# dense TM for the OSPF / hybrid SOTE tools, one row per line, " v1 v2 ... vN"
+def format_ospf(TM):
+    rows = np.asarray(TM).astype(str)
+    return "\n".join([" " + " ".join(row) for row in rows])
+
+
+# sparse "src dst traffic" lines with 1 based node ids, the format of the TM_result text files
+def format_sparse(TM):
+    TM = np.asarray(TM)
+    src, dst = np.nonzero(TM)
+    lines = zip((src + 1).astype(str), (dst + 1).astype(str), TM[src, dst].astype(str))
+    return "".join([" ".join(line) + "\n" for line in lines])
+
+
+# demand list for the CPLEX multi-commodity flow model, 0 based node ids like the flow files
+# it writes back (OD-src OD-dst link-src link-dst link-value), self demands are left out
+def format_cplex(TM):
+    TM = np.asarray(TM)
+    src, dst = np.nonzero(TM)
+    keep = src != dst
+    src, dst = src[keep], dst[keep]
+    lines = zip(src.astype(str), dst.astype(str), TM[src, dst].astype(str))
+    return "NUM-DEMANDS: " + str(src.shape[0]) + "\n" + \
+           "".join(["DEMAND: " + " ".join(line) + "\n" for line in lines])
+
+
+FORMATS = {"ospf": format_ospf, "sparse": format_sparse, "cplex": format_cplex}
+
+
+def TM_digest(TM, fmt):
+    md5 = hashlib.md5(fmt.encode("utf-8"))
+    md5.update(np.ascontiguousarray(TM).tobytes())
+    return md5.hexdigest()
+
+
+def load_manifest(out_path):
+    file_name = os.path.join(out_path, MANIFEST)
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(out_path, manifest):
+    file_name = os.path.join(out_path, MANIFEST)
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, file_name)
+
+
+def write_file(file_name, text):
+    with open(file_name, 'w') as f:
+        f.write(text)
+
+
+class TMExporter():
+    '''
+    batch writer of TE solver inputs from in-memory TMs
+    every TM of a run is formatted with numpy and written by a thread pool, a file is only
+    rewritten when its TM changed since the last export (md5 kept in <out_path>/.export.json)
+    :param workers: number of writer threads shared by all runs
+    '''
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # queue the TMs of one run, written as <out_path>/<name>_<i + 1>.txt
+    def export(self, TMs, out_path, name, fmt="ospf"):
+        if fmt not in FORMATS:
+            raise ValueError("unknown TE export format " + fmt + ", one of " + str(sorted(FORMATS)))
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+
+        manifest = load_manifest(out_path)
+        futures = []
+        skipped = 0
+        for i in range(len(TMs)):
+            TM = np.asarray(TMs[i])
+            file = name + "_" + str(i + 1) + ".txt"
+            digest = TM_digest(TM, fmt)
+            if manifest.get(file) == digest and os.path.exists(os.path.join(out_path, file)):
+                skipped += 1
+                continue
+            manifest[file] = digest
+            futures.append(self.pool.submit(self.write_TM, TM, os.path.join(out_path, file), fmt))
+        self.jobs.append((out_path, manifest, futures))
+        return len(futures), skipped
+
+    def write_TM(self, TM, file_name, fmt):
+        write_file(file_name, FORMATS[fmt](TM))
+
+    # wait for the queued files, the manifests are only saved once all their files are written
+    def wait(self):
+        written = 0
+        for out_path, manifest, futures in self.jobs:
+            for future in futures:
+                future.result()
+            written += len(futures)
+            save_manifest(out_path, manifest)
+        self.jobs = []
+        return written
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.wait()
+        self.pool.shutdown()
+        self.pool = None
+
+
+# export TM runs in one go, jobs is a list of (in_path, out_path) or (in_path, out_path, fmt)
+# where in_path is a TM_result text directory or its TM archive
+def export_runs(jobs, node_num, fmt="ospf", workers=8, topology=""):
+    written = 0
+    skipped = 0
+    with TMExporter(workers) as exporter:
+        for job in jobs:
+            in_path, out_path = job[0], job[1]
+            job_fmt = job[2] if len(job) > 2 else fmt
+            TMs = load_TM_run(in_path, node_num, topology)
+            name = os.path.basename(os.path.normpath(in_path))
+            n_written, n_skipped = exporter.export(TMs.TMs, out_path, name, job_fmt)
+            print(name + " -> " + out_path + ": " + str(n_written) + " written, " + str(n_skipped) + " unchanged")
+            written += n_written
+            skipped += n_skipped
+    return written, skipped
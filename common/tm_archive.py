@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import numpy as np
+
+
+MAGIC = b"TMARCH01"
+HEADER_SIZE = 4096
+ARCHIVE_SUFFIX = ".tma"
+NAT = np.iinfo(np.int64).min
+
+
+def record_dtype(node_num):
+    return np.dtype([("time", "<i8"), ("TM", "<f4", (node_num, node_num))])
+
+
+def read_header(f):
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a TM archive: " + str(f.name))
+    return json.loads(header[len(MAGIC):].decode("utf-8").strip())
+
+
+def write_header(f, meta):
+    header = MAGIC + json.dumps(meta).encode("utf-8")
+    if len(header) > HEADER_SIZE:
+        raise ValueError("TM archive header too large")
+    f.seek(0)
+    f.write(header.ljust(HEADER_SIZE, b" "))
+
+
+class TMArchiveWriter():
+    '''
+    append writer of a TM archive, one file holding a whole run of (node_num, node_num)
+    float32 TMs plus a json header with model, topology and node_num
+    every record is (timestamp, TM), records are buffered and written chunk_size at a time
+    :param file_name: archive file, usually <TM_result dir>/<model>.tma
+    :param node_num: number of nodes of the topology
+    :param model: model name, e.g. LSTM_OD_pair
+    :param topology: topology name, e.g. Abilene
+    :param chunk_size: number of TMs buffered before they are written
+    :param append: keep the TMs already in file_name and append after them
+    '''
+    def __init__(self, file_name, node_num, model="", topology="", chunk_size=256, append=False):
+        self.file_name = file_name
+        self.node_num = node_num
+        self.chunk_size = chunk_size
+        self.dtype = record_dtype(node_num)
+        self.buffer = []
+
+        path = os.path.dirname(file_name)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+
+        if append and os.path.exists(file_name):
+            self.f = open(file_name, "r+b")
+            self.meta = read_header(self.f)
+            if self.meta["node_num"] != node_num:
+                raise ValueError("node_num " + str(node_num) + " does not match archive " + file_name)
+            # drop a partially written record left by a crash
+            self.meta["count"] = (os.path.getsize(file_name) - HEADER_SIZE) // self.dtype.itemsize
+            self.f.truncate(HEADER_SIZE + self.meta["count"] * self.dtype.itemsize)
+        else:
+            self.f = open(file_name, "w+b")
+            self.meta = {"version": 1, "model": model, "topology": topology,
+                         "node_num": node_num, "count": 0}
+            write_header(self.f, self.meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.meta["count"] + len(self.buffer)
+
+    # time: np.datetime64 or seconds since epoch, None if unknown
+    def append(self, TM, time=None):
+        self.buffer.append((TM, time))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, TMs, times=None):
+        self.flush()
+        TMs = np.asarray(TMs).reshape(-1, self.node_num, self.node_num)
+        records = np.empty(TMs.shape[0], dtype=self.dtype)
+        records["TM"] = TMs
+        records["time"] = to_seconds(times, TMs.shape[0])
+        self.write(records)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        records = np.empty(len(self.buffer), dtype=self.dtype)
+        for i in range(len(self.buffer)):
+            TM, time = self.buffer[i]
+            records["TM"][i] = np.asarray(TM).reshape(self.node_num, self.node_num)
+            records["time"][i] = to_seconds([time], 1)[0]
+        self.buffer = []
+        self.write(records)
+
+    def write(self, records):
+        self.f.seek(HEADER_SIZE + self.meta["count"] * self.dtype.itemsize)
+        self.f.write(records.tobytes())
+        self.meta["count"] += records.shape[0]
+        write_header(self.f, self.meta)
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f = None
+
+
+def to_seconds(times, length):
+    if times is None:
+        return np.full(length, NAT, dtype=np.int64)
+    if isinstance(times, np.ndarray) and np.issubdtype(times.dtype, np.datetime64):
+        return times.astype("datetime64[s]").astype(np.int64)
+    result = np.empty(length, dtype=np.int64)
+    for i in range(length):
+        time = times[i]
+        if time is None:
+            result[i] = NAT
+        elif isinstance(time, np.datetime64):
+            result[i] = time.astype("datetime64[s]").astype(np.int64)
+        else:
+            result[i] = int(time)
+    return result
+
+
+class TMArchive():
+    '''
+    random access reader of a TM archive, the records are memory-mapped so opening
+    a run is O(1) and archive[i] only touches the pages of TM i
+    :param file_name: archive file written by TMArchiveWriter
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as f:
+            self.meta = read_header(f)
+        self.model = self.meta["model"]
+        self.topology = self.meta["topology"]
+        self.node_num = self.meta["node_num"]
+
+        dtype = record_dtype(self.node_num)
+        # trust the file size over the header count, a crashed writer may not have updated it
+        count = (os.path.getsize(file_name) - HEADER_SIZE) // dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(file_name, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    # the i-th TM of the run, 0 based, file TM_<i + 1>.txt of the text format
+    def __getitem__(self, i):
+        return self.records["TM"][i]
+
+    # all TMs as a (count, node_num, node_num) float32 array
+    @property
+    def TMs(self):
+        return self.records["TM"]
+
+    @property
+    def times(self):
+        return self.records["time"].view("datetime64[s]")
+
+
+# read one sparse text TM, lines of "src dst traffic" with 1 based node ids
+def read_TM_file(TM_file, node_num):
+    TM = np.zeros(shape=(node_num, node_num))
+    with open(TM_file, 'r') as f:
+        text = f.read().split()
+    if text:
+        values = np.array(text, dtype=np.float64).reshape(-1, 3)
+        TM[values[:, 0].astype(int) - 1, values[:, 1].astype(int) - 1] = values[:, 2]
+    return TM
+
+
+# a TM given either as a text file or as an array
+def load_TM(TM, node_num=None):
+    if isinstance(TM, str):
+        return read_TM_file(TM, node_num)
+    return np.asarray(TM)
+
+
+def get_TM_number(file_name):
+    return int(re.findall(r"_(\d+)\.txt$", file_name)[0])
+
+
+# convert a directory of <model>_<i>.txt text TMs into one archive
+def convert_TM_dir(in_path, out_file, node_num, model=None, topology="", chunk_size=256):
+    if model is None:
+        model = os.path.basename(os.path.normpath(in_path))
+    files = [file for file in os.listdir(in_path) if re.search(r"_(\d+)\.txt$", file)]
+    files = sorted(files, key=get_TM_number)
+
+    with TMArchiveWriter(out_file, node_num, model=model, topology=topology, chunk_size=chunk_size) as writer:
+        for file in files:
+            writer.append(read_TM_file(os.path.join(in_path, file), node_num))
+    return TMArchive(out_file)
+
+
+# archive path of a TM_result run directory, ../TM_result/Abilene/LSTM/ -> ../TM_result/Abilene/LSTM.tma
+def get_archive_name(run_path):
+    return os.path.normpath(run_path) + ARCHIVE_SUFFIX
+
+
+def get_dir_mtime(path):
+    mtime = os.path.getmtime(path)
+    for entry in os.scandir(path):
+        mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+# open the archive of a run, converting its text directory first if the archive
+# does not exist yet or is older than the text files
+def load_TM_run(run_path, node_num=None, topology=""):
+    archive_name = get_archive_name(run_path)
+    if os.path.isdir(run_path):
+        if not os.path.exists(archive_name) or \
+                os.path.getmtime(archive_name) < get_dir_mtime(run_path):
+            if node_num is None:
+                raise ValueError("node_num is needed to convert " + run_path)
+            return convert_TM_dir(run_path, archive_name, node_num, topology=topology)
+    return TMArchive(archive_name)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert TM_result text directories into TM archives')
+    parser.add_argument('paths', nargs='+',
+                        help='text TM directories, e.g. ../TM_result/Abilene/LSTM_OD_pair/')
+    parser.add_argument('--node_num', type=int, required=True,
+                        help='number of nodes of the topology (Abilene 12, CERNET 14, GEANT 23)')
+    parser.add_argument('--topology', type=str, default="",
+                        help='topology name stored in the archive header')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        archive = convert_TM_dir(path, get_archive_name(path), args.node_num, topology=args.topology)
+        print(path + " -> " + archive.file_name + ", " + str(len(archive)) + " TMs")
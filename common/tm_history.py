@@ -0,0 +1,351 @@
+import os
+import json
+import zlib
+import numpy as np
+from common.od_cache import ODCache, get_calendar
+
+
+HISTORY_SUFFIX = ".tmh"
+META_FILE = "meta.json"
+INDEX_FILE = "index.npy"
+TIME_FILE = "time.bin"
+DATA_FILE = "data.bin"
+
+# one week of 5 minute samples
+HISTORY_CHUNK_SIZE = 2016
+# OD columns compressed together, a per-OD query decompresses one block per chunk
+HISTORY_BLOCK_SIZE = 32
+
+
+# group the bytes of every value by significance, the high bytes of traffic values are
+# nearly constant and compress much better that way
+def shuffle_bytes(data):
+    return np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(buffer, dtype, shape):
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+    return np.ascontiguousarray(data).view(dtype).reshape(shape)
+
+
+# (rows, columns) float block -> compressed bytes
+# precision None: lossless float64, else values are rounded to multiples of precision and
+# stored as the int64 difference to the previous time step of the same OD
+def encode_block(block, precision, level):
+    if precision is None:
+        data = np.asarray(block, dtype=np.float64)
+    else:
+        data = np.round(np.asarray(block, dtype=np.float64) / precision).astype(np.int64)
+        data = np.diff(data, axis=0, prepend=np.zeros((1, data.shape[1]), dtype=np.int64))
+    return zlib.compress(shuffle_bytes(data), level)
+
+
+def decode_block(buffer, precision, shape):
+    if precision is None:
+        return unshuffle_bytes(zlib.decompress(buffer), np.float64, shape)
+    data = unshuffle_bytes(zlib.decompress(buffer), np.int64, shape)
+    return np.cumsum(data, axis=0) * precision
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def atomic_write(file_name, write):
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        write(f)
+    os.replace(tmp_file, file_name)
+
+
+class TMHistoryWriter():
+    '''
+    append writer of a compressed TM history store
+    the rows (time steps) are cut into chunks of chunk_size rows and the OD columns of every
+    chunk into blocks of block_size columns, every block is compressed on its own, so a
+    time range or an OD can be read back without decompressing the whole history
+    the store is a directory: meta.json, index.npy (offset and length of every block),
+    time.bin (int64 seconds of every row) and data.bin (the compressed blocks)
+    :param path: store directory, usually <name>.tmh
+    :param columns: OD column names, e.g. ODCache.get_OD_list()
+    :param chunk_size: rows per chunk
+    :param block_size: columns per block
+    :param precision: None for lossless storage, else the quantization step of the traffic values
+    :param level: zlib compression level
+    :param append: keep the rows already in path and append after them
+    '''
+    def __init__(self, path, columns=None, chunk_size=HISTORY_CHUNK_SIZE, block_size=HISTORY_BLOCK_SIZE,
+                 precision=None, level=6, append=False):
+        self.path = path
+        self.level = level
+        self.buffer = []
+        self.time_buffer = []
+        self.buffer_size = 0
+        # int64 seconds of the last row appended, None for an empty store
+        self.last_time = None
+
+        if append and os.path.exists(os.path.join(path, META_FILE)):
+            self.meta = read_meta(path)
+            self.index = np.load(os.path.join(path, INDEX_FILE))
+            self.reopen()
+        else:
+            if columns is None:
+                raise ValueError("columns are needed to create " + path)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.meta = {"version": 1, "columns": list(columns), "chunk_size": chunk_size,
+                         "block_size": block_size, "precision": precision, "count": 0}
+            self.index = np.zeros((0, self.get_block_num(), 2), dtype=np.int64)
+            open(os.path.join(path, DATA_FILE), 'wb').close()
+            open(os.path.join(path, TIME_FILE), 'wb').close()
+            self.save_index()
+
+        self.columns = self.meta["columns"]
+        self.chunk_size = self.meta["chunk_size"]
+        self.block_size = self.meta["block_size"]
+        self.precision = self.meta["precision"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.meta["count"] + self.buffer_size
+
+    def get_block_num(self):
+        return (len(self.meta["columns"]) + self.meta["block_size"] - 1) // self.meta["block_size"]
+
+    # drop what a crashed writer left after the last saved chunk, and read a partial
+    # last chunk back into the buffer so that it is completed by the next rows
+    def reopen(self):
+        count = self.meta["count"]
+        chunk_num = (count + self.meta["chunk_size"] - 1) // self.meta["chunk_size"]
+        self.index = self.index[:chunk_num]
+        times = np.fromfile(os.path.join(self.path, TIME_FILE), dtype=np.int64)[:count]
+        if count > 0:
+            self.last_time = int(times[-1])
+
+        rows = count - (chunk_num - 1) * self.meta["chunk_size"] if chunk_num > 0 else 0
+        if 0 < rows < self.meta["chunk_size"]:
+            history = TMHistory(self.path)
+            self.buffer.append(history.get_rows(count - rows, count))
+            self.time_buffer.append(times[count - rows:])
+            self.buffer_size = rows
+            self.index = self.index[:-1]
+            count -= rows
+            self.meta["count"] = count
+
+        end = int(self.index[-1, -1, 0] + self.index[-1, -1, 1]) if self.index.shape[0] > 0 else 0
+        with open(os.path.join(self.path, DATA_FILE), 'r+b') as f:
+            f.truncate(end)
+        with open(os.path.join(self.path, TIME_FILE), 'r+b') as f:
+            f.truncate(count * 8)
+        self.save_index()
+
+    # values: (time_step, OD_num) rows, times: np.datetime64 array of the rows
+    def append(self, values, times):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self.meta["columns"]))
+        times = np.asarray(times).astype("datetime64[s]").astype(np.int64)
+        if times.shape[0] != values.shape[0]:
+            raise ValueError("got " + str(times.shape[0]) + " times for " + str(values.shape[0]) + " rows")
+        # a partial chunk written by flush() is read back and completed
+        if self.meta["count"] % self.meta["chunk_size"] != 0:
+            self.reopen()
+        self.buffer.append(values)
+        self.time_buffer.append(times)
+        self.buffer_size += values.shape[0]
+        if times.shape[0] > 0:
+            self.last_time = int(times[-1])
+        if self.buffer_size >= self.meta["chunk_size"]:
+            self.flush(full_only=True)
+
+    # compress and write the buffered rows, full_only keeps a partial last chunk buffered
+    def flush(self, full_only=False):
+        if self.buffer_size == 0:
+            return
+        chunk_size = self.meta["chunk_size"]
+        values = np.concatenate(self.buffer)
+        times = np.concatenate(self.time_buffer)
+        end = (values.shape[0] // chunk_size) * chunk_size if full_only else values.shape[0]
+
+        chunks = []
+        with open(os.path.join(self.path, DATA_FILE), 'ab') as f:
+            offset = f.tell()
+            for start in range(0, end, chunk_size):
+                chunk = values[start:start + chunk_size]
+                entry = np.zeros((self.get_block_num(), 2), dtype=np.int64)
+                for j in range(entry.shape[0]):
+                    block = chunk[:, j * self.meta["block_size"]:(j + 1) * self.meta["block_size"]]
+                    buffer = encode_block(block, self.meta["precision"], self.level)
+                    f.write(buffer)
+                    entry[j] = (offset, len(buffer))
+                    offset += len(buffer)
+                chunks.append(entry)
+        with open(os.path.join(self.path, TIME_FILE), 'ab') as f:
+            f.write(times[:end].tobytes())
+
+        if chunks:
+            self.index = np.concatenate((self.index, np.stack(chunks)))
+        self.meta["count"] += end
+        self.buffer = [values[end:]] if end < values.shape[0] else []
+        self.time_buffer = [times[end:]] if end < values.shape[0] else []
+        self.buffer_size = values.shape[0] - end
+        self.save_index()
+
+    # index first, then meta, the row count in meta.json is what readers trust
+    def save_index(self):
+        atomic_write(os.path.join(self.path, INDEX_FILE), lambda f: np.save(f, self.index))
+        text = json.dumps(self.meta).encode("utf-8")
+        atomic_write(os.path.join(self.path, META_FILE), lambda f: f.write(text))
+
+    def close(self):
+        if self.buffer is None:
+            return
+        self.flush()
+        self.buffer = None
+
+
+class TMHistory():
+    '''
+    reader of a compressed TM history store
+    time ranges are found by binary search on the memory-mapped time column, only the
+    chunks of the range and the blocks of the requested OD columns are decompressed
+    :param path: store directory written by TMHistoryWriter
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.columns = self.meta["columns"]
+        self.column_index = {}
+        for i in range(len(self.columns)):
+            self.column_index[self.columns[i]] = i
+        self.chunk_size = self.meta["chunk_size"]
+        self.block_size = self.meta["block_size"]
+        self.precision = self.meta["precision"]
+        self.node_num = int(round(np.sqrt(len(self.columns))))
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+
+        count = self.meta["count"]
+        if count > 0:
+            self.time_data = np.memmap(os.path.join(path, TIME_FILE), dtype=np.int64, mode="r", shape=(count,))
+        else:
+            self.time_data = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    @property
+    def times(self):
+        return self.time_data.view("datetime64[s]")
+
+    def get_OD_list(self):
+        return list(self.columns)
+
+    # rows [start, end) of the given columns, default all, as a (end - start, column_num) array
+    def get_rows(self, start, end=None, columns=None):
+        if end is None or end > len(self):
+            end = len(self)
+        if columns is None:
+            column_index = np.arange(len(self.columns))
+        else:
+            column_index = np.array([self.column_index[column] for column in columns], dtype=np.int64)
+        result = np.empty((max(end - start, 0), column_index.shape[0]))
+        if start >= end:
+            return result
+
+        blocks = np.unique(column_index // self.block_size)
+        with open(os.path.join(self.path, DATA_FILE), 'rb') as f:
+            for chunk in range(start // self.chunk_size, (end - 1) // self.chunk_size + 1):
+                chunk_start = chunk * self.chunk_size
+                rows = min(self.chunk_size, len(self) - chunk_start)
+                begin, stop = max(start, chunk_start) - chunk_start, min(end, chunk_start + rows) - chunk_start
+                for block in blocks:
+                    offset, length = self.index[chunk, block]
+                    f.seek(offset)
+                    first = block * self.block_size
+                    width = min(self.block_size, len(self.columns) - first)
+                    data = decode_block(f.read(length), self.precision, (rows, width))
+                    mask = (column_index // self.block_size) == block
+                    result[chunk_start + begin - start:chunk_start + stop - start, mask] = \
+                        data[begin:stop, column_index[mask] - first]
+        return result
+
+    # rows of the time steps start_time <= time < end_time, None for no bound
+    def get_row_range(self, start_time=None, end_time=None):
+        start = 0
+        end = len(self)
+        if start_time is not None:
+            start = int(np.searchsorted(self.time_data, to_second(start_time), side="left"))
+        if end_time is not None:
+            end = int(np.searchsorted(self.time_data, to_second(end_time), side="left"))
+        return start, max(start, end)
+
+    # (times, values) of a time range, values is (time_step, column_num)
+    def get_range(self, start_time=None, end_time=None, columns=None):
+        start, end = self.get_row_range(start_time, end_time)
+        return self.times[start:end], self.get_rows(start, end, columns)
+
+    # one OD as a 1-d series over a time range
+    def get_OD(self, OD, start_time=None, end_time=None):
+        return self.get_range(start_time, end_time, [OD])[1][:, 0]
+
+    # (time_step, node_num, node_num) TMs of a time range
+    def get_TMs(self, start_time=None, end_time=None):
+        return self.get_range(start_time, end_time)[1].reshape(-1, self.node_num, self.node_num)
+
+    def get_calendar(self, start=0, end=None):
+        return get_calendar(self.times[start:end])
+
+
+def to_second(time):
+    return np.datetime64(time).astype("datetime64[s]").astype(np.int64)
+
+
+# store path of a run name, ../OD_pair/Abilene -> ../OD_pair/Abilene.tmh
+def get_history_name(name):
+    return os.path.normpath(name) + HISTORY_SUFFIX
+
+
+# append OD_pair csv files, in time order, to a history store through their columnar caches
+# rows not later than the last stored time step are skipped, so a day can be re-added safely
+def add_OD_files(path, files, chunk_size=HISTORY_CHUNK_SIZE, block_size=HISTORY_BLOCK_SIZE, precision=None):
+    writer = None
+    try:
+        for file in files:
+            cache = ODCache(file)
+            if writer is None:
+                writer = TMHistoryWriter(path, cache.get_OD_list(), chunk_size, block_size, precision, append=True)
+            if cache.get_OD_list() != writer.columns:
+                raise ValueError(file + " does not have the OD columns of " + path)
+            start = 0
+            if writer.last_time is not None:
+                start = int(np.searchsorted(cache.time.astype(np.int64), writer.last_time, side="right"))
+            for i in range(start, len(cache), chunk_size):
+                end = min(i + chunk_size, len(cache))
+                writer.append(np.asarray(cache.data[i:end, cache.OD_index]), cache.time[i:end])
+            print(file + " -> " + path + ", " + str(len(cache) - start) + " time steps")
+    finally:
+        if writer is not None:
+            writer.close()
+    return TMHistory(path)
+
+
+if __name__ == "__main__":
+    import argparse
+    from common.od_stream import get_OD_files
+    parser = argparse.ArgumentParser(description='Add OD_pair csv files to a compressed TM history store')
+    parser.add_argument('path', help='store directory, e.g. ../OD_pair/Abilene.tmh')
+    parser.add_argument('pattern', help='csv files, e.g. "../OD_pair/Abilene-OD_pair_*.csv"')
+    parser.add_argument('--start_date', type=str, default=None, help='first day, YYYY-MM-DD')
+    parser.add_argument('--end_date', type=str, default=None, help='last day, YYYY-MM-DD')
+    parser.add_argument('--precision', type=float, default=None,
+                        help='quantization step of the traffic values, lossless if not given')
+    args = parser.parse_args()
+
+    history = add_OD_files(args.path, get_OD_files(args.pattern, args.start_date, args.end_date),
+                           precision=args.precision)
+    print(args.path + ": " + str(len(history)) + " time steps")
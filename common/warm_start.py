@@ -0,0 +1,112 @@
+import os
+import csv
+import numpy as np
+import torch
+import torch.utils.data as Data
+from common.batch_loader import BatchLoader
+from common.early_stopping import train_early_stopping, log_report
+from common.checkpoint import CHECKPOINT_EVERY
+from common.device import get_device
+
+
+# epochs of a warm started model, it starts from the daily pattern shared by the ODs
+# so a few epochs of fine-tuning replace the full training from a random initialization
+FINE_TUNE_EPOCH = 10
+
+# training windows pooled for pretraining, drawn evenly from the ODs
+PRETRAIN_WINDOWS = 100000
+
+
+class WindowPool():
+    '''
+    normalized windows of many ODs pooled into one dataset to pretrain a shared initializer,
+    every OD adds at most max_windows / OD_num random windows, so memory does not grow
+    with the number of ODs
+    :param OD_num: number of ODs that will be added
+    :param max_windows: windows of the pooled training set
+    :param seed: seed of the window sampling
+    '''
+    def __init__(self, OD_num, max_windows=PRETRAIN_WINDOWS, seed=0):
+        self.size = max(1, int(max_windows / max(1, OD_num)))
+        self.generator = torch.Generator().manual_seed(seed)
+        self.train = []
+        self.validation = []
+
+    # at most size windows of dataset (TensorDataset or WindowDataset) as a tuple of tensors
+    def sample(self, dataset):
+        if len(dataset) > self.size:
+            return dataset[torch.randperm(len(dataset), generator=self.generator)[:self.size]]
+        return dataset[:]
+
+    # the training windows and the validation tail of one OD
+    def add(self, train_set, validation_set):
+        self.train.append(self.sample(train_set))
+        self.validation.append(self.sample(validation_set))
+
+    def get_train_set(self):
+        return Data.TensorDataset(*[torch.cat(tensors) for tensors in zip(*self.train)])
+
+    def get_validation_set(self):
+        return Data.TensorDataset(*[torch.cat(tensors) for tensors in zip(*self.validation)])
+
+
+def fit(model, train_set, validation_set, epoch, LR, batch_size, forward=None, optimizer=torch.optim.Adagrad,
+        device=None, checkpoint=None, checkpoint_every=CHECKPOINT_EVERY):
+    '''
+    train model on train_set with early stopping on validation_set, see common/early_stopping.py
+    :param model: the model, trained in place on device
+    :param train_set: training windows, TensorDataset or WindowDataset
+    :param validation_set: validation windows, evaluated as one batch
+    :param forward: forward(batch_x) -> prediction, default model.forward
+    :param checkpoint: training checkpoint of train_early_stopping, a later fit continues from it
+    :return: report of train_early_stopping
+    '''
+    device = get_device(device)
+    model.to(device)
+    data_loader = BatchLoader(train_set, batch_size, shuffle=True)
+    return train_early_stopping(model, data_loader, [validation_set[:]], epoch,
+                                optimizer(model.parameters(), lr=LR), forward=forward, device=device,
+                                checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+
+
+# train the shared initializer on the windows of a WindowPool, returns the report of fit
+def pretrain(model, pool, epoch, LR, batch_size, forward=None, optimizer=torch.optim.Adagrad, device=None):
+    return fit(model, pool.get_train_set(), pool.get_validation_set(), epoch, LR, batch_size, forward,
+               optimizer, device)
+
+
+def compare_warm_start(cold, warm, pretrain_report, file_name=None):
+    '''
+    wall time and test loss of the cold and the warm started models, the warm time counts
+    the pretraining once, printed and written to a csv file, one row per OD and a total row
+    :param cold: {OD: (report, test_loss)} of the models trained from a random initialization
+    :param warm: {OD: (report, test_loss)} of the fine-tuned models
+    :param pretrain_report: report of pretrain
+    '''
+    rows = []
+    for OD in warm:
+        cold_report, cold_loss = cold[OD]
+        warm_report, warm_loss = warm[OD]
+        rows.append([OD, cold_report["epochs"], cold_report["time"], cold_loss,
+                     warm_report["epochs"], warm_report["time"], warm_loss])
+
+    cold_time = sum([row[2] for row in rows])
+    warm_time = pretrain_report["time"] + sum([row[5] for row in rows])
+    cold_loss = float(np.mean([row[3] for row in rows]))
+    warm_loss = float(np.mean([row[6] for row in rows]))
+    log_report("pretrain", pretrain_report)
+    print("cold start time:", cold_time, ", mean test loss:", cold_loss)
+    print("warm start time:", warm_time, ", mean test loss:", warm_loss)
+    print("speedup:", cold_time / warm_time)
+    if file_name is None:
+        return
+
+    path = os.path.dirname(file_name)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open(file_name, 'w', newline="") as datacsv:
+        csvwriter = csv.writer(datacsv, dialect=("excel"))
+        csvwriter.writerow(["OD", "cold_epochs", "cold_time", "cold_test_loss",
+                            "warm_epochs", "warm_time", "warm_test_loss"])
+        csvwriter.writerows(rows)
+        csvwriter.writerow(["total", "", cold_time, cold_loss, pretrain_report["epochs"], warm_time, warm_loss])
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+import torch.utils.data as Data
+
+
+def to_tensor(data):
+    if isinstance(data, torch.Tensor):
+        return data.float()
+    return torch.from_numpy(np.ascontiguousarray(data)).float()
+
+
+# number of training windows, the first 80% of the windows rounded down to whole batches
+def get_train_len(length, batch_size=50):
+    return int(int(length * 0.8) / batch_size) * batch_size
+
+
+class WindowDataset(Data.Dataset):
+    '''
+    sliding window view on a time series, sample i is ([x_i, ..., x_i+k-1], x_i+k)
+    the windows are a strided view on the series, so memory is O(T) instead of O(T * k)
+    :param data: time series, shape (time_step, ...), a single OD or a whole TM per step
+    :param k: window length, using first k data to predict the k+1 data
+    :param extra: optional (time_step, m) columns of the target step appended to every
+                  window, e.g. week_day and hour for the embedding models
+    :param target: optional (time_step, ...) series to predict, default is data itself
+    '''
+    def __init__(self, data, k, extra=None, target=None):
+        data = to_tensor(data)
+        self.k = k
+        length = data.shape[0] - k
+
+        # (length, k, ...) view, window i starts at row i of data
+        size = (length, k) + tuple(data.shape[1:])
+        stride = (data.stride(0),) + tuple(data.stride())
+        self.x_data = data.as_strided(size, stride, data.storage_offset())
+
+        if target is None:
+            target = data
+        self.y_data = to_tensor(target)[k:k + length]
+
+        self.extra = None
+        if extra is not None:
+            self.extra = to_tensor(extra)[k:k + length]
+
+    def __len__(self):
+        return self.x_data.shape[0]
+
+    # index can be an int, a slice or a LongTensor of sample indices
+    def __getitem__(self, index):
+        x = self.x_data[index]
+        if self.extra is not None:
+            x = torch.cat((x, self.extra[index]), -1)
+        return x, self.y_data[index]
+
+    # samples [start, end) as a new dataset, still a view on the same series
+    def subset(self, start, end=None):
+        series = WindowDataset.__new__(WindowDataset)
+        series.k = self.k
+        series.x_data = self.x_data[start:end]
+        series.y_data = self.y_data[start:end]
+        series.extra = None if self.extra is None else self.extra[start:end]
+        return series
+
+    # train / test split at train_len
+    def split(self, train_len):
+        return self.subset(0, train_len), self.subset(train_len)